@@ -0,0 +1,78 @@
+import time
+from threading import Lock
+
+from cachetools import TTLCache
+from django.conf import settings
+
+from api.metrics import track_outbound
+
+APPLE_ISSUER = "https://appleid.apple.com"
+APPLE_KEYS_URL = "https://appleid.apple.com/auth/keys"
+# an unknown kid forces a refetch (Apple rotated keys), but not more often than this
+APPLE_KEYS_MIN_REFRESH_INTERVAL = 60  # seconds
+
+# holds a single entry: kid -> public key
+_keys_cache = TTLCache(maxsize=1, ttl=settings.APPLE_KEYS_TTL)
+_keys_lock = Lock()
+_last_fetch = 0.0
+
+
+class InvalidAppleToken(Exception):
+    pass
+
+
+def fetch_apple_keys() -> dict:
+    import jwt
+    import requests
+
+    with track_outbound("apple"):
+        response = requests.get(APPLE_KEYS_URL, timeout=5)
+    response.raise_for_status()
+    return {jwk.key_id: jwk.key for jwk in jwt.PyJWKSet.from_dict(response.json()).keys}
+
+
+def _refresh_keys() -> dict:
+    global _last_fetch
+    keys = fetch_apple_keys()
+    _keys_cache["keys"] = keys
+    _last_fetch = time.monotonic()
+    return keys
+
+
+def get_apple_signing_key(kid: str):
+    with _keys_lock:
+        keys = _keys_cache.get("keys")
+        if keys is None:
+            keys = _refresh_keys()
+        elif kid not in keys and time.monotonic() - _last_fetch > APPLE_KEYS_MIN_REFRESH_INTERVAL:
+            keys = _refresh_keys()
+    if kid not in keys:
+        raise InvalidAppleToken("Unknown signing key")
+    return keys[kid]
+
+
+def verify_apple_identity_token(identity_token: str, user_id: str) -> dict:
+    """
+    Verify a Sign in with Apple identity token locally against Apple's (cached) public keys.
+    Returns the token's claims; raises InvalidAppleToken if it is not a valid token for this user.
+    """
+    # PyJWT pulls in cryptography, which only the Apple sign-in endpoints need
+    import jwt
+    import requests
+
+    try:
+        kid = jwt.get_unverified_header(identity_token).get("kid")
+        key = get_apple_signing_key(kid)
+        claims = jwt.decode(
+            identity_token,
+            key,
+            algorithms=["RS256"],
+            audience=settings.APPLE_CLIENT_ID,
+            issuer=APPLE_ISSUER,
+        )
+    except (jwt.PyJWTError, requests.RequestException) as e:
+        raise InvalidAppleToken(str(e))
+
+    if claims.get("sub") != user_id:
+        raise InvalidAppleToken("Token does not belong to this user")
+    return claims
@@ -0,0 +1,77 @@
+from threading import Lock
+
+from cachetools import TTLCache
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+# token key -> (user, token); LRU-bounded, and the TTL bounds how long another worker can serve a revoked token
+_token_cache = TTLCache(maxsize=settings.TOKEN_CACHE_SIZE, ttl=settings.TOKEN_CACHE_TTL)
+# user id -> keys of their cached tokens, so a User save doesn't scan the whole cache. Keys that expired out of
+# _token_cache are only dropped when the index is rebuilt (see remember_token), which keeps it bounded.
+_user_token_keys: dict[int, set[str]] = {}
+# cachetools caches aren't thread safe; guards both
+_token_cache_lock = Lock()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication that remembers recently seen tokens in-process,
+    so most requests skip the authtoken_token/auth_user join entirely.
+    """
+
+    def authenticate_credentials(self, key):
+        with _token_cache_lock:
+            cached = _token_cache.get(key)
+        if cached is not None:
+            return cached
+
+        user, token = super().authenticate_credentials(key)
+        remember_token(key, user, token)
+        return user, token
+
+
+def remember_token(key: str, user: User, token: Token) -> None:
+    with _token_cache_lock:
+        _token_cache[key] = (user, token)
+        _user_token_keys.setdefault(user.id, set()).add(key)
+        if len(_user_token_keys) > 2 * _token_cache.maxsize:
+            rebuilt = {}
+            for cached_key, (cached_user, cached_token) in _token_cache.items():
+                rebuilt.setdefault(cached_user.id, set()).add(cached_key)
+            _user_token_keys.clear()
+            _user_token_keys.update(rebuilt)
+
+
+def invalidate_token(key: str) -> None:
+    with _token_cache_lock:
+        cached = _token_cache.pop(key, None)
+        if cached is not None:
+            _user_token_keys.get(cached[0].id, set()).discard(key)
+
+
+def invalidate_user_tokens(user_id: int) -> None:
+    with _token_cache_lock:
+        for key in _user_token_keys.pop(user_id, ()):
+            _token_cache.pop(key, None)
+
+
+def clear() -> None:
+    with _token_cache_lock:
+        _token_cache.clear()
+        _user_token_keys.clear()
+
+
+# ----------------------
+# SIGNALS TO INVALIDATE CACHED TOKENS
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    invalidate_token(instance.key)
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, **kwargs):
+    # covers deactivation as well as any other change to the cached user (name, permissions, etc.)
+    invalidate_user_tokens(instance.id)
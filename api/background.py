@@ -0,0 +1,28 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+# small shared pool for work that shouldn't hold up the response (image variants, etc.)
+executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="api-background")
+
+
+def _run(fn, *args, **kwargs):
+    try:
+        fn(*args, **kwargs)
+    except Exception as e:
+        print("Background task " + fn.__name__ + " failed: ", e)
+    finally:
+        # worker threads get their own db connections, don't leave them open
+        close_old_connections()
+
+
+def run_in_background(fn, *args, **kwargs) -> None:
+    """
+    Run fn on the background pool once the current transaction commits, so it sees the rows the request wrote.
+    With BACKGROUND_TASKS_INLINE (tests, local scripts) it runs right away in the calling thread instead.
+    """
+    if settings.BACKGROUND_TASKS_INLINE:
+        transaction.on_commit(lambda: fn(*args, **kwargs))
+    else:
+        transaction.on_commit(lambda: executor.submit(_run, fn, *args, **kwargs))
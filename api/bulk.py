@@ -0,0 +1,44 @@
+import io
+import json
+
+from django.db import connection
+from django.db.models.fields import AutoFieldMixin
+
+
+def copy_value(value) -> str:
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    # escapes for COPY's text format
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def copy_rows(model, rows: list) -> None:
+    """
+    Postgres COPY, several times faster than INSERTs for large batches. Values are taken as-is from the
+    instances, so anything normally filled in on save (auto_now_add, etc.) has to be set beforehand.
+    """
+    if not rows:
+        return
+    fields = [field for field in model._meta.concrete_fields if not isinstance(field, AutoFieldMixin)]
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(copy_value(getattr(row, field.attname)) for field in fields) + "\n")
+    buffer.seek(0)
+    columns = ", ".join(connection.ops.quote_name(field.column) for field in fields)
+    with connection.cursor() as cursor:
+        cursor.copy_expert(f"COPY {connection.ops.quote_name(model._meta.db_table)} ({columns}) FROM STDIN", buffer)
+
+
+def insert_rows(model, rows: list, batch_size: int = None) -> None:
+    """
+    Insert new rows with COPY on Postgres and bulk_create elsewhere. Like bulk_create, no signals are sent;
+    unlike it, there is no conflict handling, so only use it for rows that can't already exist.
+    """
+    if connection.vendor == "postgresql":
+        copy_rows(model, rows)
+    else:
+        model.objects.bulk_create(rows, batch_size=batch_size)
@@ -0,0 +1,68 @@
+from datetime import timedelta
+from typing import Callable, Optional
+
+from django.db import transaction
+from django.utils import timezone
+
+from api.image_storage import delete_unreferenced_image
+from api.models import Food, IdempotencyKey, StoredImage, Tombstone
+
+
+def abandoned_foods(retention: timedelta):
+    """
+    Estimates from LogFood the user never kept with SaveFood, older than retention (served by food_archived_created).
+    """
+    return Food.objects.filter(archived=True, created_at__lt=timezone.now() - retention)
+
+
+def delete_abandoned_foods(retention: timedelta, batch_size: int,
+                           on_batch: Optional[Callable[[int], None]] = None) -> int:
+    """
+    Delete abandoned foods batch_size at a time, each batch in its own short transaction so LogFood/SaveFood
+    are never blocked for long. The usual delete signals run for every food: meal_items links go with it, its image
+    reference is released (and the blob deleted from Firebase after commit once nothing else uses it), the
+    user's data_version moves on and a Tombstone is left for synced clients. Returns how many foods were deleted.
+    """
+    deleted = 0
+    while True:
+        with transaction.atomic():
+            # skip rows someone else has locked, e.g. a SaveFood keeping that food right now
+            ids = list(abandoned_foods(retention).order_by("created_at").select_for_update(skip_locked=True)
+                       .values_list("id", flat=True)[:batch_size])
+            if not ids:
+                return deleted
+            # archived is checked again in the delete itself
+            count, by_model = Food.objects.filter(id__in=ids, archived=True).delete()
+            batch_deleted = by_model.get(Food._meta.label, 0)
+        deleted += batch_deleted
+        if on_batch:
+            on_batch(batch_deleted)
+
+
+def delete_unreferenced_images() -> int:
+    """
+    Delete stored images nothing references, left behind when a worker died between releasing the last
+    reference and the delete that runs after commit. Returns how many were looked at.
+    """
+    content_hashes = list(StoredImage.objects.filter(reference_count=0).values_list("content_hash", flat=True))
+    for content_hash in content_hashes:
+        delete_unreferenced_image(content_hash)
+    return len(content_hashes)
+
+
+def delete_old_tombstones(max_age: timedelta) -> int:
+    """
+    Delete tombstones older than max_age (served by tombstone_deleted_at). Sync tokens expire at the same age,
+    so no client can still need them.
+    """
+    count, by_model = Tombstone.objects.filter(deleted_at__lt=timezone.now() - max_age).delete()
+    return count
+
+
+def delete_expired_idempotency_keys(ttl: timedelta) -> int:
+    """
+    Delete Idempotency-Key records older than ttl (served by idempotency_key_created); a retry with one of those
+    keys runs as a new request.
+    """
+    count, by_model = IdempotencyKey.objects.filter(created_at__lt=timezone.now() - ttl).delete()
+    return count
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import time
+from datetime import timedelta
+from threading import Event, Lock
+from typing import Callable
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from api.metrics import OPENAI_CALLS, OPENAI_CALLS_COALESCED
+from api.models import CompletionRequest
+
+# how often a caller checks whether another worker's call has finished
+POLL_SECONDS = 0.25
+
+
+def request_fingerprint(request: dict) -> str:
+    return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class Flight:
+    """
+    A call this process is making; the threads that want the same result wait on done.
+    """
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+# fingerprint -> Flight
+_flights = {}
+_flights_lock = Lock()
+
+
+def coalesced(fingerprint: str, call: Callable[[], str]) -> str:
+    """
+    call()'s result, shared with every identical call (same fingerprint) made at the same time: other threads of
+    this process wait for the one making it, and other workers find it through its CompletionRequest row.
+    Threads waiting here get the same exception if it fails.
+    """
+    with _flights_lock:
+        flight = _flights.get(fingerprint)
+        leader = flight is None
+        if leader:
+            flight = _flights[fingerprint] = Flight()
+    if not leader:
+        flight.done.wait()
+        OPENAI_CALLS_COALESCED.inc(("local",))
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        flight.result = shared_call(fingerprint, call)
+        return flight.result
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[fingerprint]
+        flight.done.set()
+
+
+def shared_call(fingerprint: str, call: Callable[[], str]) -> str:
+    """
+    call(), unless another worker is making the identical call (or just made it): then its response, once it has one.
+    The unique fingerprint decides who makes the call; the others poll its row.
+    """
+    stale = timedelta(seconds=settings.OPENAI_COALESCE_STALE_SECONDS)
+    now = timezone.now()
+    # finished calls are only kept for OPENAI_COALESCE_RESULT_SECONDS, and one still running after stale never will
+    CompletionRequest.objects.filter(
+        Q(response__isnull=False, updated_at__lt=now - timedelta(seconds=settings.OPENAI_COALESCE_RESULT_SECONDS))
+        | Q(updated_at__lt=now - stale)).delete()
+    while True:
+        try:
+            with transaction.atomic():
+                record = CompletionRequest.objects.create(fingerprint=fingerprint)
+        except IntegrityError:
+            pass
+        else:
+            return make_call(record, call)
+
+        record = CompletionRequest.objects.filter(fingerprint=fingerprint).first()
+        if record is None:
+            # it failed (or was pruned) meanwhile, try to make it ourselves
+            continue
+        if record.response is not None:
+            OPENAI_CALLS_COALESCED.inc(("shared",))
+            return record.response
+        if record.updated_at < timezone.now() - stale:
+            # the worker making it died; take over, unless another caller just did
+            if CompletionRequest.objects.filter(pk=record.pk, response__isnull=True, updated_at=record.updated_at) \
+                    .update(updated_at=timezone.now()):
+                return make_call(record, call)
+        time.sleep(POLL_SECONDS)
+
+
+def make_call(record: CompletionRequest, call: Callable[[], str]) -> str:
+    OPENAI_CALLS.inc()
+    try:
+        response = call()
+    except Exception:
+        # whoever is waiting makes the call again itself
+        CompletionRequest.objects.filter(pk=record.pk).delete()
+        raise
+    CompletionRequest.objects.filter(pk=record.pk).update(response=response, updated_at=timezone.now())
+    return response
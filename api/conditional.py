@@ -0,0 +1,55 @@
+import hashlib
+from datetime import datetime
+
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+from api.models import UserProfile
+
+
+class NotModified(Exception):
+    """
+    Raised from ConditionalGetMixin.initial to skip the handler when the client's copy is current.
+    """
+    pass
+
+
+class ConditionalGetMixin:
+    """
+    ETag / If-None-Match for per-user GET views. The ETag comes from the user's data_version,
+    which is bumped whenever one of their Foods or Meals changes, so an unchanged collection
+    gets a 304 before any of the view's queries or serialization run.
+    """
+    etag = None
+
+    def get_etag(self, request):
+        data_version = UserProfile.objects.filter(user_id=request.user.id) \
+            .values_list('data_version', flat=True).first()
+        if data_version is None:
+            return None
+        # the url covers query params that change the output (?image_size, etc.),
+        # and the date covers views that only show meals up to today
+        key = "|".join([str(request.user.id), str(data_version), request.get_full_path(),
+                        datetime.now().strftime("%Y-%m-%d")])
+        return quote_etag(hashlib.md5(key.encode()).hexdigest())
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method == 'GET' and request.user.is_authenticated:
+            self.etag = self.get_etag(request)
+            if self.etag and self.etag in parse_etags(request.headers.get('If-None-Match', '')):
+                raise NotModified()
+
+    def handle_exception(self, exc):
+        if isinstance(exc, NotModified):
+            return Response(status=status.HTTP_304_NOT_MODIFIED)
+        return super().handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if self.etag and response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            response['ETag'] = self.etag
+            patch_vary_headers(response, ['Authorization'])
+        return response
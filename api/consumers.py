@@ -0,0 +1,54 @@
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from rest_framework.exceptions import AuthenticationFailed
+
+from api.authentication import CachedTokenAuthentication
+from api.events import user_group_name
+
+
+@database_sync_to_async
+def get_user_for_token(key: str):
+    try:
+        user, token = CachedTokenAuthentication().authenticate_credentials(key)
+    except AuthenticationFailed:
+        return None
+    return user
+
+
+class MealUpdatesConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Pushes Food and Meal changes to all of a user's devices, so clients don't have to poll meals/
+    (a changed food comes whole, a changed meal as its id, date, meal_type and revision, see api/events.py).
+    Authenticate with an "Authorization: Token <key>" header or a ?token=<key> query parameter.
+    """
+
+    async def connect(self):
+        key = self.get_token_key()
+        self.user = await get_user_for_token(key) if key else None
+        if not self.user:
+            await self.close(code=4401)
+            return
+        self.group_name = user_group_name(self.user.id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, code):
+        if getattr(self, "group_name", None):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    def get_token_key(self):
+        for name, value in self.scope.get("headers", []):
+            if name == b"authorization":
+                keyword, _, key = value.decode().partition(" ")
+                if keyword == "Token":
+                    return key
+        token = parse_qs(self.scope.get("query_string", b"").decode()).get("token")
+        return token[0] if token else None
+
+    async def food_changed(self, event):
+        await self.send_json(event)
+
+    async def meal_changed(self, event):
+        await self.send_json(event)
@@ -0,0 +1,72 @@
+from contextvars import ContextVar
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework.permissions import SAFE_METHODS
+
+from api.models import UserProfile
+
+REPLICA_DB = 'replica'
+
+# set for the duration of a replica-safe view, see ReplicaReadMixin
+_use_replica = ContextVar("use_replica", default=False)
+
+
+def replica_configured() -> bool:
+    return REPLICA_DB in settings.DATABASES
+
+
+def user_is_sticky(user) -> bool:
+    """
+    Whether the user wrote something in the last REPLICA_STICKY_SECONDS, so their reads should go to the primary
+    to see their own writes even if the replica is lagging behind. Every write sets UserProfile.last_write_at
+    (see touch_user_data), and it is read from the primary, so this holds whichever worker served the write.
+    """
+    if not user.is_authenticated:
+        return False
+    since = timezone.now() - timedelta(seconds=settings.REPLICA_STICKY_SECONDS)
+    return UserProfile.objects.using('default').filter(user_id=user.id, last_write_at__gte=since).exists()
+
+
+class ReplicaRouter:
+    """
+    Sends reads to the replica, but only inside views that opted in with ReplicaReadMixin;
+    everything else (writes, auth, admin) stays on the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        if _use_replica.get() and replica_configured():
+            return REPLICA_DB
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # both aliases hold the same data
+        return True
+
+
+class ReplicaReadMixin:
+    """
+    For read-only APIViews: their queries go to the replica, unless the user wrote something in the last
+    REPLICA_STICKY_SECONDS (read-your-writes). replica_methods lists the HTTP methods that only read.
+    """
+    replica_methods = SAFE_METHODS
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if replica_configured() and request.method in self.replica_methods and not user_is_sticky(request.user):
+            self._replica_token = _use_replica.set(True)
+
+    def dispatch(self, request, *args, **kwargs):
+        # reset here rather than in finalize_response, which an exception DRF doesn't handle skips; the flag
+        # would otherwise stay set for every later request on this thread
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            replica_token = getattr(self, '_replica_token', None)
+            if replica_token:
+                _use_replica.reset(replica_token)
+                self._replica_token = None
@@ -0,0 +1,43 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+from api.models import Food, Meal
+
+
+def user_group_name(user_id: int) -> str:
+    return "user_" + str(user_id)
+
+
+def send_to_user(user_id: int, event: dict) -> None:
+    """
+    Push an event to every websocket the user has open (see api/consumers.py).
+    Sent after commit so devices never hear about rows they can't read yet.
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+
+    def send():
+        try:
+            async_to_sync(channel_layer.group_send)(user_group_name(user_id), event)
+        except Exception as e:
+            # a missed push only means the client falls back to polling
+            print("Error sending event to user " + str(user_id) + ": ", e)
+
+    transaction.on_commit(send)
+
+
+def food_changed(food: Food, meal: Meal = None) -> None:
+    """
+    The food is sent whole, it's already in memory. The meal is only named: its totals would take a query and a
+    serialization on every write, whether or not any of the user's devices is listening, so clients that care
+    fetch it (meals/ with If-None-Match, or sync/).
+    """
+    # imported here, the serializers module is only needed once there is something to send
+    from api.serializers import FoodSerializer
+
+    send_to_user(food.user_id, {"type": "food.changed", "food": FoodSerializer(food).data})
+    if meal:
+        send_to_user(meal.user_id, {"type": "meal.changed", "meal": {
+            "id": str(meal.id), "date": meal.date, "meal_type": meal.meal_type, "revision": meal.revision}})
@@ -0,0 +1,130 @@
+import csv
+import json
+import zlib
+from typing import Iterable, Iterator
+
+from django.conf import settings
+from django.db import router
+from django.http import StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+
+from api.models import Food, Meal, Conversation
+from api.renderers import FastJSONRenderer
+from api.serializers import FoodSerializer, MealSerializer, ConversationSerializer
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+# rows are gathered into blocks of about this many bytes before they are written (and gzip-flushed)
+EXPORT_BLOCK_BYTES = 64 * 1024
+
+
+def food_export_queryset(user):
+    return Food.objects.filter(user=user).order_by("id")
+
+
+def meal_export_queryset(user):
+    # every total_* field walks meal_items; iterator(chunk_size) prefetches them one chunk at a time
+    return Meal.objects.filter(user=user).order_by("date", "meal_type").prefetch_related("meal_items")
+
+
+def conversation_export_queryset(user):
+    return Conversation.objects.filter(meal__user=user).order_by("created_at")
+
+
+EXPORT_KINDS = {
+    "foods": (food_export_queryset, FoodSerializer),
+    "meals": (meal_export_queryset, MealSerializer),
+    "conversations": (conversation_export_queryset, ConversationSerializer),
+}
+
+
+def export_rows(request, kind: str) -> tuple[list[str], Iterator[dict]]:
+    """
+    The field names and a lazy stream of the user's rows, in the same shape the API returns them.
+    Rows are read with .iterator(), so only EXPORT_CHUNK_SIZE model instances are alive at a time
+    (server-side cursors on Postgres; with DB_PGBOUNCER_TRANSACTION_MODE psycopg2 buffers the result instead).
+    """
+    get_queryset, serializer_class = EXPORT_KINDS[kind]
+    queryset = get_queryset(request.user)
+    # the rows are read after the view has returned, so pin the database the view would have read from
+    queryset = queryset.using(router.db_for_read(queryset.model))
+    # one serializer for the whole export: its fields are only built once
+    serializer = serializer_class(context={"request": request})
+
+    def rows():
+        for instance in queryset.iterator(chunk_size=settings.EXPORT_CHUNK_SIZE):
+            yield serializer.to_representation(instance)
+
+    return list(serializer.fields), rows()
+
+
+def ndjson_lines(rows: Iterable[dict]) -> Iterator[bytes]:
+    renderer = FastJSONRenderer()
+    for row in rows:
+        yield renderer.render(row) + b"\n"
+
+
+class _Echo:
+    # csv.writer wants a file; this one hands each formatted line straight back
+    def write(self, value):
+        return value
+
+
+def csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        return ";".join(str(item) for item in value)
+    if isinstance(value, dict):
+        return json.dumps(value)
+    return value
+
+
+def csv_lines(fields: list[str], rows: Iterable[dict]) -> Iterator[bytes]:
+    writer = csv.writer(_Echo())
+    yield writer.writerow(fields).encode()
+    for row in rows:
+        yield writer.writerow([csv_value(row[field]) for field in fields]).encode()
+
+
+def blocks(lines: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Join lines into blocks of about EXPORT_BLOCK_BYTES, so the response isn't written (or compressed) a line at a time.
+    """
+    block, size = [], 0
+    for line in lines:
+        block.append(line)
+        size += len(line)
+        if size >= EXPORT_BLOCK_BYTES:
+            yield b"".join(block)
+            block, size = [], 0
+    if block:
+        yield b"".join(block)
+
+
+def gzip_blocks(data: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)  # gzip container
+    for block in data:
+        # flush each block so the client gets data as it is produced instead of when the buffer fills
+        yield compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def export_response(request, kind: str, file_format: str) -> StreamingHttpResponse:
+    fields, rows = export_rows(request, kind)
+    lines = ndjson_lines(rows) if file_format == "ndjson" else csv_lines(fields, rows)
+    content = blocks(lines)
+
+    compress = "gzip" in request.META.get("HTTP_ACCEPT_ENCODING", "")
+    if compress:
+        content = gzip_blocks(content)
+
+    response = StreamingHttpResponse(content, content_type=EXPORT_FORMATS[file_format])
+    response["Content-Disposition"] = f'attachment; filename="munch-{kind}.{file_format}"'
+    if compress:
+        response["Content-Encoding"] = "gzip"
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response
@@ -1,34 +1,77 @@
-from io import BytesIO
+from threading import Lock
+from typing import BinaryIO, Optional
 
-import firebase_admin
-from firebase_admin import credentials, storage
 import json
 import base64
 from food_tracker_backend.settings import env
 
-# Path to your service account key file
-# service_account_path = env('SERVICE_ACCOUNT_PATH', default='/app/api/serviceAccountKey.json')
-encoded_key = env('FIREBASE_SERVICE_ACCOUNT')
+from api.metrics import track_outbound
 
-# Decode the base64 string
-decoded_key = base64.b64decode(encoded_key)
+_init_lock = Lock()
 
-# Load the key as a JSON object
-service_account_info = json.loads(decoded_key)
 
-# Initialize Firebase app with the decoded service account info
-cred = credentials.Certificate(service_account_info)
-firebase_admin.initialize_app(cred, {
-    'storageBucket': 'munch-f2d84.appspot.com'
-})
+def _bucket():
+    """
+    Default storage bucket. firebase_admin (and the google-cloud clients under it) is slow to import,
+    so the app is only initialized the first time a worker actually touches storage.
+    """
+    import firebase_admin
+    from firebase_admin import credentials, storage
 
-def upload_image_to_firebase(image_file: BytesIO, filename: str) -> str:
+    with _init_lock:
+        try:
+            firebase_admin.get_app()
+        except ValueError:
+            # no default app yet
+            # Path to your service account key file
+            # service_account_path = env('SERVICE_ACCOUNT_PATH', default='/app/api/serviceAccountKey.json')
+            encoded_key = env('FIREBASE_SERVICE_ACCOUNT')
+
+            # Decode the base64 string
+            decoded_key = base64.b64decode(encoded_key)
+
+            # Load the key as a JSON object
+            service_account_info = json.loads(decoded_key)
+
+            # Initialize Firebase app with the decoded service account info
+            cred = credentials.Certificate(service_account_info)
+            firebase_admin.initialize_app(cred, {
+                'storageBucket': 'munch-f2d84.appspot.com'
+            })
+    return storage.bucket()
+
+# Resumable uploads send the file in chunks of this size (must be a multiple of 256 KB)
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+def upload_image_to_firebase(image_file: BinaryIO, filename: str, content_type: Optional[str] = None) -> str:
     # Get the default bucket
-    bucket = storage.bucket()
-    # Create a new blob and upload the file's content
-    blob = bucket.blob(filename)
-    blob.upload_from_file(image_file)
-    # Make the blob publicly viewable
-    blob.make_public()
+    bucket = _bucket()
+    # Create a new blob and stream the file's content with a resumable upload,
+    # so only one chunk is held in memory at a time
+    blob = bucket.blob(filename, chunk_size=UPLOAD_CHUNK_SIZE)
+    image_file.seek(0)
+    with track_outbound("firebase"):
+        blob.upload_from_file(image_file, content_type=content_type)
+        # Make the blob publicly viewable
+        blob.make_public()
     # Return the public url
-    return blob.public_url
\ No newline at end of file
+    return blob.public_url
+
+def public_url_for(filename: str) -> str:
+    return _bucket().blob(filename).public_url
+
+def image_exists_in_firebase(filename: str) -> bool:
+    with track_outbound("firebase"):
+        return _bucket().blob(filename).exists()
+
+def download_image_from_firebase(filename: str, destination: BinaryIO) -> None:
+    blob = _bucket().blob(filename, chunk_size=UPLOAD_CHUNK_SIZE)
+    with track_outbound("firebase"):
+        blob.download_to_file(destination)
+    destination.seek(0)
+
+def delete_image_from_firebase(filename: str) -> None:
+    blob = _bucket().blob(filename)
+    with track_outbound("firebase"):
+        if blob.exists():
+            blob.delete()
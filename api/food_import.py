@@ -0,0 +1,217 @@
+import csv
+import hashlib
+import io
+import json
+from datetime import datetime
+from itertools import batched, islice
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional
+
+from django.db import transaction
+from django.utils import timezone
+
+from api.bulk import insert_rows
+from api.models import Food, Meal, MealTypes, FoodImport, touch_user_data
+
+IMPORT_FORMATS = ("csv", "json", "ndjson")
+
+# nutrient names without the _min/_max suffix, e.g. "calories", "protein"
+NUTRIENTS = [field.name[:-len("_min")] for field in Food._meta.get_fields() if field.name.endswith("_min")]
+
+# only the first few bad rows are kept on the FoodImport, the rest are just counted
+MAX_RECORDED_ERRORS = 100
+
+
+class InvalidImportRow(ValueError):
+    pass
+
+
+class ImportConflict(Exception):
+    """
+    The import's checkpoint moved under us: the same file is being imported by another request or process.
+    """
+
+
+def import_format_for(filename: str, default: str = "csv") -> str:
+    extension = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+    return extension if extension in IMPORT_FORMATS else default
+
+
+def read_rows(source: BinaryIO, file_format: str) -> Iterator[Optional[dict]]:
+    """
+    Rows of a CSV file (header row required), a JSON array or NDJSON. Only the JSON array is read all at once.
+    Unparseable NDJSON lines come through as None, so they are reported as bad rows instead of stopping the import.
+    """
+    text = io.TextIOWrapper(source, encoding="utf-8-sig", newline="")
+    if file_format == "csv":
+        yield from csv.DictReader(text)
+    elif file_format == "ndjson":
+        for line in text:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+    else:
+        rows = json.load(text)
+        if not isinstance(rows, list):
+            raise InvalidImportRow("A JSON import must be an array of rows")
+        yield from rows
+
+
+def parse_amount(row: dict, key: str) -> Optional[float]:
+    value = row.get(key)
+    if value is None or value == "":
+        return None
+    try:
+        amount = float(value)
+    except (TypeError, ValueError):
+        raise InvalidImportRow(f"{key} is not a number: {value!r}")
+    if amount < 0:
+        raise InvalidImportRow(f"{key} can't be negative")
+    return amount
+
+
+def clean_row(row) -> dict:
+    """
+    Validate one row and return the Food and Meal fields it describes. Nutrients can be given as a range
+    (calories_min, calories_max) or a single value (calories); missing nutrients are 0.
+    """
+    if not isinstance(row, dict):
+        raise InvalidImportRow("Row is not an object")
+
+    try:
+        # Meal.date is matched as text, so "2024-5-1" has to become "2024-05-01" to land on the right meal
+        date = datetime.strptime(str(row.get("date") or "").strip(), "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        raise InvalidImportRow("date must be YYYY-MM-DD")
+
+    meal_type = str(row.get("meal_type") or "").strip().lower()
+    if meal_type not in MealTypes.values:
+        raise InvalidImportRow(f"meal_type must be one of {', '.join(MealTypes.values)}")
+
+    name = str(row.get("name") or "").strip()[:255]
+    description = str(row.get("description") or row.get("initial_description") or "").strip()
+    if not name and not description:
+        raise InvalidImportRow("A row needs a name or a description")
+
+    food = {"name": name, "initial_description": description or None}
+    for nutrient in NUTRIENTS:
+        single = parse_amount(row, nutrient)
+        low = parse_amount(row, nutrient + "_min")
+        high = parse_amount(row, nutrient + "_max")
+        low = low if low is not None else (single if single is not None else high or 0)
+        high = high if high is not None else (single if single is not None else low)
+        if low > high:
+            raise InvalidImportRow(f"{nutrient}_min is bigger than {nutrient}_max")
+        food[nutrient + "_min"] = low
+        food[nutrient + "_max"] = high
+
+    return {"date": date, "meal_type": meal_type, "meal_name": str(row.get("meal_name") or "").strip()[:255],
+            "food": food}
+
+
+def import_batch(job: FoodImport, rows: list[tuple[int, dict]]) -> None:
+    """
+    Write one batch of numbered rows: the Foods, the Meals that don't exist yet and the meal_items links
+    (COPY on Postgres, bulk_create elsewhere), then the checkpoint, all in a single transaction.
+    Rows landing on an existing (meal_type, date, user) meal are added to it, the way LogFood does.
+    """
+    cleaned, errors = [], []
+    for number, row in rows:
+        try:
+            cleaned.append(clean_row(row))
+        except InvalidImportRow as e:
+            errors.append({"row": number, "error": str(e)})
+
+    with transaction.atomic():
+        checkpoint = FoodImport.objects.select_for_update().get(pk=job.pk)
+        if checkpoint.rows_done != job.rows_done:
+            raise ImportConflict("This file is already being imported")
+
+        # bulk writes skip save(), so the rows get their revision here (see SyncedModel)
+        revision = touch_user_data(job.user_id)
+        foods = [Food(user_id=job.user_id, revision=revision, **row["food"]) for row in cleaned]
+        insert_rows(Food, foods)
+
+        rows_by_meal = {}
+        for row, food in zip(cleaned, foods):
+            rows_by_meal.setdefault((row["meal_type"], row["date"]), []).append((row, food))
+
+        meals = existing_meals(job.user_id, rows_by_meal.keys())
+        new_meals = [Meal(user_id=job.user_id, meal_type=meal_type, date=date,
+                          name=next((row["meal_name"] for row, food in meal_rows if row["meal_name"]), ""),
+                          description=describe(meal_rows), revision=revision)
+                     for (meal_type, date), meal_rows in rows_by_meal.items() if (meal_type, date) not in meals]
+        if new_meals:
+            # a LogFood for the same meal may have slipped in since the lookup; its meal wins and is appended to below
+            Meal.objects.bulk_create(new_meals, ignore_conflicts=True)
+            meals = existing_meals(job.user_id, rows_by_meal.keys())
+
+        new_meal_ids = {meal.id for meal in new_meals}
+        appended = []
+        for key, meal_rows in rows_by_meal.items():
+            meal = meals[key]
+            if meal.id in new_meal_ids:
+                continue
+            description = describe(meal_rows)
+            if description:
+                meal.description = (meal.description + " " + description) if meal.description else description
+            # new meal_items change the meal's totals even without a description
+            meal.revision, meal.updated_at = revision, timezone.now()
+            appended.append(meal)
+        Meal.objects.bulk_update(appended, ["description", "revision", "updated_at"])
+
+        MealItem = Meal.meal_items.through
+        insert_rows(MealItem, [MealItem(meal_id=meals[key].id, food_id=food.id)
+                               for key, meal_rows in rows_by_meal.items() for row, food in meal_rows])
+
+        job.rows_done += len(rows)
+        job.rows_skipped += len(errors)
+        job.foods_created += len(foods)
+        job.meals_created += sum(1 for meal in meals.values() if meal.id in new_meal_ids)
+        job.errors = (job.errors + errors)[:MAX_RECORDED_ERRORS]
+        job.save()
+
+
+def existing_meals(user_id: int, keys: Iterable[tuple[str, str]]) -> dict[tuple[str, str], Meal]:
+    keys = set(keys)
+    meals = Meal.objects.filter(user_id=user_id, meal_type__in={meal_type for meal_type, date in keys},
+                                date__in={date for meal_type, date in keys}).only("id", "meal_type", "date", "description")
+    return {(meal.meal_type, meal.date): meal for meal in meals if (meal.meal_type, meal.date) in keys}
+
+
+def describe(meal_rows) -> str:
+    return " ".join(row["food"]["initial_description"] for row, food in meal_rows if row["food"]["initial_description"])
+
+
+def start_import(user, source: BinaryIO, source_name: str = "") -> FoodImport:
+    """
+    The FoodImport for this file: a new one, or the one left behind by an earlier attempt with the same content.
+    """
+    source.seek(0)
+    source_hash = hashlib.file_digest(source, "sha256").hexdigest()
+    source.seek(0)
+    job, created = FoodImport.objects.get_or_create(user=user, source_hash=source_hash,
+                                                    defaults={"source_name": source_name[:255]})
+    return job
+
+
+def run_import(job: FoodImport, source: BinaryIO, file_format: str, batch_size: int,
+               on_progress: Optional[Callable[[FoodImport], None]] = None) -> FoodImport:
+    """
+    Import the rows of source that the job hasn't done yet, batch_size rows per transaction.
+    """
+    if job.status == "completed":
+        return job
+
+    source.seek(0)
+    rows = enumerate(read_rows(source, file_format), start=1)
+    for batch in batched(islice(rows, job.rows_done, None), batch_size):
+        import_batch(job, list(batch))
+        if on_progress:
+            on_progress(job)
+
+    job.status = "completed"
+    job.save(update_fields=["status", "updated_at"])
+    return job
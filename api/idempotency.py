@@ -0,0 +1,144 @@
+import hashlib
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException, ParseError
+from rest_framework.response import Response
+
+from api.models import IdempotencyKey
+
+# how often a retry checks whether the original request has finished
+POLL_SECONDS = 0.25
+MAX_KEY_LENGTH = 255
+
+
+class Replay(Exception):
+    """
+    Raised from IdempotentMixin.initial to skip the handler and answer with the stored response.
+    """
+
+    def __init__(self, record: IdempotencyKey):
+        self.record = record
+
+
+class IdempotencyKeyReused(APIException):
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_detail = "This Idempotency-Key was already used for a different request."
+    default_code = "idempotency_key_reused"
+
+
+class RequestInProgress(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = "A request with this Idempotency-Key is still being processed, try again shortly."
+    default_code = "request_in_progress"
+
+
+def request_fingerprint(request) -> str:
+    """
+    sha256 of the method, path, data and uploaded files. Form data is hashed field by field rather than as the raw
+    body, whose multipart boundary can differ between a request and its retry.
+    """
+    digest = hashlib.sha256(f"{request.method} {request.path}\n".encode())
+    data = request.data
+    if hasattr(data, "lists"):
+        data = {key: [value for value in values if not isinstance(value, UploadedFile)] for key, values in data.lists()}
+    digest.update(json.dumps(data, sort_keys=True, cls=DjangoJSONEncoder).encode())
+    for name, uploads in sorted(request.FILES.lists()):
+        for upload in uploads:
+            digest.update(b"\n" + name.encode() + b"\n")
+            for chunk in upload.chunks():
+                digest.update(chunk)
+            upload.seek(0)
+    return digest.hexdigest()
+
+
+def claim(user, key: str, fingerprint: str) -> IdempotencyKey:
+    """
+    The IdempotencyKey for a request that should run now. Otherwise raises Replay with the response of the earlier
+    request that used the key, IdempotencyKeyReused if that was a different request, or RequestInProgress if it is
+    still running after IDEMPOTENCY_WAIT_SECONDS. A retry that comes in while the original is running waits here.
+    """
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        record, created = IdempotencyKey.objects.get_or_create(user=user, key=key,
+                                                               defaults={"fingerprint": fingerprint})
+        if created:
+            return record
+        now = timezone.now()
+        if record.status == "completed" and record.created_at < now - timedelta(hours=settings.IDEMPOTENCY_KEY_TTL_HOURS):
+            # expired, cleanup just hasn't got to it yet
+            record.delete()
+            continue
+        if record.fingerprint != fingerprint:
+            raise IdempotencyKeyReused()
+        if record.status == "completed":
+            raise Replay(record)
+        if record.updated_at < now - timedelta(seconds=settings.IDEMPOTENCY_STALE_SECONDS):
+            # the worker running it died; take over, unless another retry just did
+            if IdempotencyKey.objects.filter(pk=record.pk, status="running", updated_at=record.updated_at) \
+                    .update(updated_at=now):
+                return record
+        if time.monotonic() >= deadline:
+            raise RequestInProgress()
+        time.sleep(POLL_SECONDS)
+
+
+def finish(record: IdempotencyKey, response) -> None:
+    """
+    Store the response for retries. Server errors are not stored: the key is released so a retry runs again.
+    """
+    if response.status_code >= 500:
+        release(record)
+        return
+    record.status = "completed"
+    record.response_status = response.status_code
+    record.response_data = response.data
+    record.save(update_fields=["status", "response_status", "response_data", "updated_at"])
+
+
+def release(record: IdempotencyKey) -> None:
+    IdempotencyKey.objects.filter(pk=record.pk).delete()
+
+
+class IdempotentMixin:
+    """
+    Idempotency-Key for POST views whose retries are expensive or would duplicate data. The first request with a key
+    runs and its response is stored; a retry with the same key gets that response (with Idempotent-Replayed: true)
+    instead of running again, waiting for the original if it hasn't finished yet.
+    """
+    idempotency_record = None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        key = request.headers.get("Idempotency-Key")
+        if request.method == "POST" and key:
+            if len(key) > MAX_KEY_LENGTH:
+                raise ParseError(f"Idempotency-Key can be at most {MAX_KEY_LENGTH} characters")
+            self.idempotency_record = claim(request.user, key, request_fingerprint(request))
+
+    def handle_exception(self, exc):
+        if isinstance(exc, Replay):
+            response = Response(exc.record.response_data, status=exc.record.response_status)
+            response["Idempotent-Replayed"] = "true"
+            return response
+        try:
+            return super().handle_exception(exc)
+        except Exception:
+            # unhandled, so finalize_response won't run; let a retry try again
+            if self.idempotency_record is not None:
+                release(self.idempotency_record)
+                self.idempotency_record = None
+            raise
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if self.idempotency_record is not None:
+            finish(self.idempotency_record, response)
+            self.idempotency_record = None
+        return response
@@ -0,0 +1,164 @@
+import hashlib
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from typing import BinaryIO, Optional
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from api.background import run_in_background
+from api.firebase_setup import upload_image_to_firebase, image_exists_in_firebase, delete_image_from_firebase, \
+    download_image_from_firebase, public_url_for, UPLOAD_CHUNK_SIZE
+from api.models import StoredImage, Food, touch_user_data
+
+# longest edge in pixels for each variant; list screens use "small", detail screens "medium"/"large"
+IMAGE_VARIANT_SIZES = {
+    "small": 160,
+    "medium": 480,
+    "large": 1080,
+}
+# every size is made in each format, WebP first; JPEG is for clients that can't decode WebP
+IMAGE_VARIANT_FORMATS = {
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+}
+IMAGE_VARIANT_QUALITY = 80
+
+
+def variant_name(size_name: str, image_format: str = "webp") -> str:
+    """
+    The key of a variant in image_variants: the size name for WebP, e.g. "small", and "small_jpeg" for JPEG.
+    """
+    return size_name if image_format == "webp" else size_name + "_" + image_format
+
+
+def variant_filename(content_hash: str, name: str) -> str:
+    image_format = name.partition("_")[2] or "webp"
+    return content_hash + "_" + name + "." + image_format
+
+
+def hash_image(image_file: BinaryIO) -> str:
+    """
+    sha256 of the file's content, read in chunks so large uploads are never held in memory.
+    """
+    digest = hashlib.sha256()
+    image_file.seek(0)
+    for chunk in iter(lambda: image_file.read(UPLOAD_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    image_file.seek(0)
+    return digest.hexdigest()
+
+
+def store_image(image_file: BinaryIO, extension: str = ".png", content_type: Optional[str] = None) -> StoredImage:
+    """
+    Content-addressed upload: identical bytes map to the same blob, so a repeat image skips
+    upload_from_file and make_public entirely. The local index is checked first, then the bucket.
+
+    The caller gets a reference to the image and has to release_image it once whatever uses the image holds its
+    own (a Food takes one when it's created, see retain_food_image), or when it fails before getting that far.
+    """
+    content_hash = hash_image(image_file)
+    filename = content_hash + extension
+    while True:
+        # waits for a delete_unreferenced_image of the same bytes to finish, then finds no row and uploads again
+        with transaction.atomic():
+            if StoredImage.objects.filter(content_hash=content_hash).update(reference_count=F("reference_count") + 1):
+                return StoredImage.objects.get(content_hash=content_hash)
+
+        if image_exists_in_firebase(filename):
+            url = public_url_for(filename)
+        else:
+            url = upload_image_to_firebase(image_file, filename, content_type)
+        try:
+            with transaction.atomic():
+                stored_image = StoredImage.objects.create(content_hash=content_hash, filename=filename, url=url,
+                                                          reference_count=1)
+        except IntegrityError:
+            # a concurrent request stored the same image first, take a reference to theirs
+            continue
+        run_in_background(generate_image_variants, content_hash)
+        return stored_image
+
+
+def generate_image_variants(content_hash: str) -> dict[str, str]:
+    """
+    Make the fixed-size WebP and JPEG copies of a stored image and save their urls on the StoredImage and its Foods.
+    The original is fetched from the bucket so this doesn't depend on the request's temporary upload.
+    """
+    from PIL import Image, ImageOps
+
+    stored_image = StoredImage.objects.filter(content_hash=content_hash).first()
+    if not stored_image:
+        return {}
+
+    variants = {}
+    with SpooledTemporaryFile(max_size=UPLOAD_CHUNK_SIZE) as original:
+        download_image_from_firebase(stored_image.filename, original)
+        with Image.open(original) as image:
+            # phone photos are often rotated through EXIF only, bake that in before resizing
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGB")
+            for size_name, size in IMAGE_VARIANT_SIZES.items():
+                variant = image.copy()
+                variant.thumbnail((size, size))
+                for image_format, (pil_format, content_type) in IMAGE_VARIANT_FORMATS.items():
+                    buffer = BytesIO()
+                    # JPEG has no alpha channel
+                    (variant if pil_format != "JPEG" else variant.convert("RGB")).save(
+                        buffer, pil_format, quality=IMAGE_VARIANT_QUALITY)
+                    name = variant_name(size_name, image_format)
+                    variants[name] = upload_image_to_firebase(buffer, variant_filename(content_hash, name), content_type)
+
+    StoredImage.objects.filter(content_hash=content_hash).update(variants=variants)
+    # an identical image can be shared by several users' foods; each user's sync needs to pick up the change
+    foods = Food.objects.filter(image_url=stored_image.url)
+    for user_id in foods.values_list("user_id", flat=True).distinct():
+        with transaction.atomic():
+            foods.filter(user_id=user_id).update(image_variants=variants, revision=touch_user_data(user_id),
+                                                 updated_at=timezone.now())
+    return variants
+
+
+def image_filenames(stored_image: StoredImage) -> list[str]:
+    return [stored_image.filename] + [
+        variant_filename(stored_image.content_hash, name) for name in stored_image.variants
+    ]
+
+
+def release_image(url: str) -> None:
+    """
+    Drop one reference to the image at this url, deleting it after commit once nothing uses it.
+    """
+    with transaction.atomic():
+        stored_image = StoredImage.objects.select_for_update().filter(url=url).first()
+        if not stored_image:
+            # not content-addressed (uploaded before StoredImage existed), leave it alone
+            return
+        stored_image.reference_count = max(stored_image.reference_count - 1, 0)
+        stored_image.save(update_fields=["reference_count"])
+    if stored_image.reference_count == 0:
+        transaction.on_commit(lambda: delete_unreferenced_image(stored_image.content_hash))
+
+
+def delete_unreferenced_image(content_hash: str) -> None:
+    """
+    Delete the image's blobs and row, unless a store_image took a reference since it was released. The row stays
+    locked until the blobs are gone, so a store_image of the same bytes waits and then uploads them again
+    instead of pointing at a deleted blob.
+    """
+    with transaction.atomic():
+        stored_image = StoredImage.objects.select_for_update().filter(content_hash=content_hash,
+                                                                      reference_count=0).first()
+        if not stored_image:
+            return
+        filenames = image_filenames(stored_image)
+        stored_image.delete()
+        for filename in filenames:
+            try:
+                delete_image_from_firebase(filename)
+            except Exception as e:
+                # the row goes either way: a leftover blob only costs storage, a row pointing at a deleted one
+                # would hand out broken urls
+                print("Could not delete image " + filename + ": ", e)
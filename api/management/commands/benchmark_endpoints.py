@@ -0,0 +1,153 @@
+import json
+import statistics
+import subprocess
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, setup_databases, teardown_databases
+from rest_framework.test import APIClient
+
+from api import meal_cache
+from api.models import Food, Meal, MealTypes
+
+BATCH_SIZE = 5000
+MEAL_TYPES = [MealTypes.BREAKFAST, MealTypes.LUNCH, MealTypes.DINNER, MealTypes.SNACK]
+
+
+def seed_user(rows: int) -> tuple[User, Meal]:
+    """
+    A user with `rows` foods, three to a meal, four meals a day going back from today.
+    Written with bulk_create so 100k rows take seconds.
+    """
+    user = User.objects.create(username=f"benchmark-{rows}")
+    foods = [Food(user=user, name=f"food {i}", initial_description="a plausible food description",
+                  calories_min=300, calories_max=400, protein_min=10, protein_max=15) for i in range(rows)]
+    Food.objects.bulk_create(foods, batch_size=BATCH_SIZE)
+
+    today = date.today()
+    meal_count = (rows + 2) // 3
+    meals = [Meal(user=user, name="meal", meal_type=MEAL_TYPES[i % 4], description="",
+                  date=(today - timedelta(days=i // 4)).strftime("%Y-%m-%d")) for i in range(meal_count)]
+    Meal.objects.bulk_create(meals, batch_size=BATCH_SIZE)
+
+    meal_item = Meal.meal_items.through
+    meal_item.objects.bulk_create(
+        [meal_item(meal_id=meals[i // 3].id, food_id=food.id) for i, food in enumerate(foods)],
+        batch_size=BATCH_SIZE
+    )
+    return user, meals[0]
+
+
+def clear_caches() -> None:
+    """
+    Forget every cached response, including this process's local meal_cache tier, so each measured request runs
+    the endpoint's queries rather than timing a cache hit.
+    """
+    cache.clear()
+    meal_cache.clear()
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=settings.BASE_DIR).stdout.strip()
+    except OSError:
+        return ""
+
+
+class Command(BaseCommand):
+    help = ("Measure latency, peak memory and query counts of the meals, foods and totals endpoints, caches cleared, "
+            "on seeded data in a throwaway test database, and append the results to a JSON lines file.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="10,1000,100000", help="comma-separated food rows per user")
+        parser.add_argument("--repeat", type=int, default=5, help="timed runs per endpoint")
+        parser.add_argument("--output", default=str(settings.BASE_DIR / "benchmarks" / "results.jsonl"))
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options["sizes"].split(",")]
+        old_config = setup_databases(verbosity=0, interactive=False, aliases={"default"})
+        try:
+            results = [result for rows in sizes for result in self.run_size(rows, options["repeat"])]
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        self.report(results, options["output"])
+
+    def run_size(self, rows: int, repeat: int) -> list[dict]:
+        start = time.perf_counter()
+        user, meal = seed_user(rows)
+        self.stdout.write(f"seeded {rows} rows in {time.perf_counter() - start:.1f}s")
+
+        client = APIClient()
+        client.force_authenticate(user)
+        endpoints = [
+            ("meals", lambda: client.get("/api/meals/")),
+            ("foods", lambda: client.get("/api/get-foods/")),
+            ("totals", lambda: client.post("/api/meals/", {"meal_id": str(meal.id)}, format="json")),
+        ]
+        results = []
+        for name, request in endpoints:
+            request()  # warm up
+
+            timings = []
+            for _ in range(repeat):
+                clear_caches()
+                start = time.perf_counter()
+                response = request()
+                timings.append((time.perf_counter() - start) * 1000)
+                if response.status_code != 200:
+                    raise CommandError(f"{name} returned {response.status_code}: {response.content[:200]}")
+
+            # separate runs, tracing and query capture both slow the request down
+            clear_caches()
+            tracemalloc.start()
+            request()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            clear_caches()
+            with CaptureQueriesContext(connection) as queries:
+                request()
+
+            results.append({
+                "rows": rows,
+                "endpoint": name,
+                "median_ms": round(statistics.median(timings), 2),
+                "min_ms": round(min(timings), 2),
+                "max_ms": round(max(timings), 2),
+                "peak_memory_kb": round(peak / 1024, 1),
+                "queries": len(queries),
+                "response_kb": round(len(response.content) / 1024, 1),
+            })
+        return results
+
+    def report(self, results: list[dict], output: str):
+        previous = {}
+        try:
+            with open(output) as f:
+                for line in f:
+                    result = json.loads(line)
+                    previous[(result["rows"], result["endpoint"])] = result
+        except FileNotFoundError:
+            pass
+
+        self.stdout.write(f"{'rows':>8} {'endpoint':<8}{'median ms':>11}{'peak KB':>11}{'queries':>9}{'vs last':>10}")
+        for result in results:
+            last = previous.get((result["rows"], result["endpoint"]))
+            change = f"{(result['median_ms'] / last['median_ms'] - 1) * 100:+.0f}%" if last else "-"
+            self.stdout.write(f"{result['rows']:>8} {result['endpoint']:<8}{result['median_ms']:>11.2f}"
+                              f"{result['peak_memory_kb']:>11.1f}{result['queries']:>9}{change:>10}")
+
+        run = {"timestamp": datetime.now().isoformat(timespec="seconds"), "git_revision": git_revision(),
+               "database": connection.vendor}
+        (settings.BASE_DIR / "benchmarks").mkdir(exist_ok=True)
+        with open(output, "a") as f:
+            for result in results:
+                f.write(json.dumps({**run, **result}) + "\n")
+        self.stdout.write(f"results appended to {output}")
@@ -0,0 +1,86 @@
+import base64
+import io
+import json
+import os
+import random
+import timeit
+import uuid
+
+from django.core.management.base import BaseCommand
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from api.models import Food, MealTypes
+from api.renderers import FastJSONParser, FastJSONRenderer, orjson
+from api.serializers import FoodSerializer
+
+
+def make_food(rng: random.Random) -> Food:
+    food = Food(id=uuid.uuid4(), user_id=1, name="Chicken burrito bowl", archived=False,
+                initial_description="burrito bowl with chicken, rice, black beans and guacamole",
+                response="Estimated from a standard chipotle-style bowl. " * 4,
+                follow_up="Did the bowl include cheese or sour cream?",
+                image_url="https://storage.googleapis.com/munch-f2d84.appspot.com/" + uuid.uuid4().hex + ".png")
+    for field in ["calories", "protein", "total_fat", "saturated_fat", "carbohydrates", "sugar", "fiber",
+                  "cholesterol", "sodium_grams"]:
+        low = rng.uniform(0, 500)
+        setattr(food, field + "_min", low)
+        setattr(food, field + "_max", low * 1.2)
+    return food
+
+
+def make_meal(rng: random.Random, foods: list[dict]) -> dict:
+    # the shape MealSerializer produces, built by hand so no database is needed
+    meal = {
+        "id": str(uuid.uuid4()),
+        "meal_items": [food["id"] for food in foods],
+        "meal_type": rng.choice(MealTypes.values),
+        "name": "Lunch",
+        "description": " ".join(food["initial_description"] for food in foods),
+        "most_recent_follow_up": None,
+        "date": "2024-05-12",
+        "user": 1,
+    }
+    for key in [k for k in foods[0] if k.endswith("_min") or k.endswith("_max")]:
+        prefix, bound = key.rsplit("_", 1)
+        meal["total_" + bound + "_" + prefix] = sum(food[key] for food in foods)
+    return meal
+
+
+class Command(BaseCommand):
+    help = "Compare the stdlib and orjson DRF renderer/parser on realistic API payloads."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--foods", type=int, default=1000, help="foods in the get-foods/ payload")
+        parser.add_argument("--meals", type=int, default=1000, help="meals in the meals/ payload")
+        parser.add_argument("--image-kb", type=int, default=3000, help="size of the image in the log-food/ body")
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        if orjson is None:
+            self.stderr.write("orjson is not installed, both columns measure the stdlib path")
+
+        rng = random.Random(options["seed"])
+        foods = FoodSerializer([make_food(rng) for _ in range(options["foods"])], many=True).data
+        meals = [make_meal(rng, [foods[rng.randrange(len(foods))] for _ in range(3)])
+                 for _ in range(options["meals"])]
+        log_food_body = json.dumps({
+            "description": "lunch from the campus cafeteria",
+            "meal_type": "lunch",
+            "date": "2024-05-12",
+            "image": base64.b64encode(os.urandom(options["image_kb"] * 1024)).decode(),
+        }).encode()
+
+        cases = [
+            ("render get-foods/", lambda r, p: r.render(foods)),
+            ("render meals/", lambda r, p: r.render(meals)),
+            ("parse log-food/ body", lambda r, p: p.parse(io.BytesIO(log_food_body))),
+        ]
+        self.stdout.write(f"{'payload':<24}{'stdlib ms':>12}{'orjson ms':>12}{'speedup':>10}")
+        for name, case in cases:
+            times = []
+            for renderer, parser in [(JSONRenderer(), JSONParser()), (FastJSONRenderer(), FastJSONParser())]:
+                best = min(timeit.repeat(lambda: case(renderer, parser), number=1, repeat=options["repeat"]))
+                times.append(best * 1000)
+            self.stdout.write(f"{name:<24}{times[0]:>12.2f}{times[1]:>12.2f}{times[0] / times[1]:>9.1f}x")
@@ -0,0 +1,35 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.cleanup import abandoned_foods, delete_abandoned_foods, delete_unreferenced_images
+
+
+class Command(BaseCommand):
+    help = ("Delete foods LogFood created but the user never saved, once they are older than the retention period, "
+            "along with their meal links and stored images, then any stored images nothing references. "
+            "Meant to run on a schedule (e.g. daily).")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--retention-days", type=int, default=settings.ARCHIVED_FOOD_RETENTION_DAYS)
+        parser.add_argument("--batch-size", type=int, default=settings.ARCHIVED_FOOD_CLEANUP_BATCH_SIZE)
+        parser.add_argument("--dry-run", action="store_true", help="only count what would be deleted")
+
+    def handle(self, *args, **options):
+        retention = timedelta(days=options["retention_days"])
+        if options["dry_run"]:
+            self.stdout.write(f"{abandoned_foods(retention).count()} abandoned foods would be deleted")
+            return
+
+        total = 0
+
+        def progress(batch_deleted):
+            nonlocal total
+            total += batch_deleted
+            self.stdout.write(f"deleted {total} foods")
+
+        deleted = delete_abandoned_foods(retention, options["batch_size"], on_batch=progress)
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {deleted} abandoned foods older than {options['retention_days']} days"))
+        self.stdout.write(f"Checked {delete_unreferenced_images()} unreferenced stored images")
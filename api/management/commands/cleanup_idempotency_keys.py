@@ -0,0 +1,15 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.cleanup import delete_expired_idempotency_keys
+
+
+class Command(BaseCommand):
+    help = ("Delete the stored responses of requests sent with an Idempotency-Key once they are older than "
+            "IDEMPOTENCY_KEY_TTL_HOURS. Meant to run on a schedule (e.g. hourly).")
+
+    def handle(self, *args, **options):
+        deleted = delete_expired_idempotency_keys(timedelta(hours=settings.IDEMPOTENCY_KEY_TTL_HOURS))
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} idempotency keys"))
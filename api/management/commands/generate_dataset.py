@@ -0,0 +1,141 @@
+import random
+import time
+import uuid
+from datetime import date, timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from api.bulk import copy_rows
+from api.models import Conversation, Food, Meal, MealTypes, UserProfile
+
+# name, description, and per-serving calories, protein, total fat, saturated fat, carbohydrates, sugar,
+# fiber (grams), cholesterol (grams), sodium (grams)
+FOOD_CATALOG = [
+    ("Oatmeal with berries", "a bowl of oatmeal topped with blueberries", 250, 8, 5, 1, 45, 12, 6, 0, 0.15),
+    ("Scrambled eggs", "two scrambled eggs with butter", 220, 13, 17, 6, 2, 1, 0, 0.37, 0.34),
+    ("Cappuccino", "a medium cappuccino with whole milk", 130, 7, 7, 4, 10, 10, 0, 0.02, 0.1),
+    ("Chicken burrito bowl", "rice, chicken, black beans and salsa", 650, 42, 20, 7, 75, 5, 12, 0.12, 1.8),
+    ("Caesar salad", "romaine, parmesan, croutons and caesar dressing", 420, 12, 32, 7, 20, 3, 4, 0.03, 0.9),
+    ("Pepperoni pizza slice", "one large slice of pepperoni pizza", 310, 13, 13, 5, 35, 4, 2, 0.03, 0.76),
+    ("Salmon with rice", "grilled salmon fillet with white rice", 560, 38, 18, 4, 55, 1, 1, 0.09, 0.35),
+    ("Spaghetti bolognese", "spaghetti with meat sauce", 700, 32, 22, 8, 90, 12, 7, 0.08, 1.1),
+    ("Apple", "one medium apple", 95, 0.5, 0.3, 0, 25, 19, 4, 0, 0),
+    ("Greek yogurt", "a cup of plain greek yogurt with honey", 190, 17, 5, 3, 20, 19, 0, 0.02, 0.07),
+    ("Protein bar", "a chocolate protein bar", 210, 20, 7, 3, 23, 6, 3, 0.01, 0.2),
+    ("Cheeseburger and fries", "a cheeseburger with a side of fries", 950, 35, 50, 17, 90, 10, 6, 0.1, 1.6),
+]
+NUTRIENTS = ["calories", "protein", "total_fat", "saturated_fat", "carbohydrates", "sugar", "fiber",
+             "cholesterol", "sodium_grams"]
+DAILY_MEAL_TYPES = [MealTypes.BREAKFAST, MealTypes.LUNCH, MealTypes.DINNER]
+
+
+class Command(BaseCommand):
+    help = ("Generate synthetic users, profiles, foods, meals and conversations for scale testing. "
+            "Rows are written with bulk_create in batches, so memory stays flat however many are made.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=10)
+        parser.add_argument("--days", type=int, default=30, help="days of history per user, ending today")
+        parser.add_argument("--foods-per-meal", type=int, default=3)
+        parser.add_argument("--snack-rate", type=float, default=0.5, help="chance of a snack on any given day")
+        parser.add_argument("--conversation-rate", type=float, default=0.2,
+                            help="chance a meal has a follow-up conversation")
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--seed", type=int, default=0, help="same seed, same dataset")
+        parser.add_argument("--prefix", default="synthetic", help="username prefix")
+        parser.add_argument("--no-copy", action="store_true",
+                            help="use bulk_create even on Postgres, where COPY is used by default")
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options["seed"])
+        self.batch_size = options["batch_size"]
+        self.pending = {Food: [], Meal: [], Meal.meal_items.through: [], Conversation: []}
+        self.counts = {model: 0 for model in self.pending}
+        self.start = time.perf_counter()
+        self.use_copy = connection.vendor == "postgresql" and not options["no_copy"]
+        self.now = timezone.now()
+
+        users = self.create_users(options["users"], options["prefix"], options["seed"])
+        first_day = date.today() - timedelta(days=options["days"] - 1)
+        for user in users:
+            for day in range(options["days"]):
+                date_str = (first_day + timedelta(days=day)).strftime("%Y-%m-%d")
+                meal_types = list(DAILY_MEAL_TYPES)
+                if self.rng.random() < options["snack_rate"]:
+                    meal_types.append(MealTypes.SNACK)
+                for meal_type in meal_types:
+                    self.add_meal(user, meal_type, date_str, options["foods_per_meal"],
+                                  options["conversation_rate"])
+        self.flush()
+
+        elapsed = time.perf_counter() - self.start
+        total = sum(self.counts.values()) + len(users) * 2
+        self.stdout.write(self.style.SUCCESS(
+            f"created {len(users)} users, {self.counts[Food]} foods, {self.counts[Meal]} meals, "
+            f"{self.counts[Conversation]} conversations in {elapsed:.1f}s ({total / elapsed:.0f} rows/s)"
+        ))
+
+    def make_uuid(self) -> uuid.UUID:
+        # drawn from the seeded rng so the same seed gives the same ids
+        return uuid.UUID(int=self.rng.getrandbits(128), version=4)
+
+    def create_users(self, count: int, prefix: str, seed: int) -> list[User]:
+        # bulk_create skips the post_save signal, so profiles are created here too
+        password = make_password(None)
+        users = []
+        for offset in range(0, count, self.batch_size):
+            batch = [User(username=f"{prefix}-{seed}-{i}", password=password, email=f"{prefix}-{seed}-{i}@example.com")
+                     for i in range(offset, min(offset + self.batch_size, count))]
+            with transaction.atomic():
+                batch = User.objects.bulk_create(batch)
+                UserProfile.objects.bulk_create([
+                    UserProfile(user=user, height=self.rng.uniform(150, 195), weight=self.rng.uniform(50, 110),
+                                age=self.rng.randint(18, 75)) for user in batch
+                ])
+            users += batch
+        return users
+
+    def add_meal(self, user: User, meal_type: str, date_str: str, foods_per_meal: int, conversation_rate: float):
+        foods = [self.make_food(user) for _ in range(self.rng.randint(1, foods_per_meal))]
+        meal = Meal(id=self.make_uuid(), user=user, meal_type=meal_type, date=date_str, name=meal_type.capitalize(),
+                    description=" ".join(food.initial_description for food in foods))
+        self.pending[Food] += foods
+        self.pending[Meal].append(meal)
+        self.pending[Meal.meal_items.through] += [Meal.meal_items.through(meal_id=meal.id, food_id=food.id)
+                                                  for food in foods]
+        if self.rng.random() < conversation_rate:
+            self.pending[Conversation] += [
+                # user is normally copied from the meal in save(), which bulk writes skip
+                Conversation(record_id=self.make_uuid(), user=user, meal=meal, created_at=self.now, sender="bot", text="Did that include any sauce or dressing?"),
+                Conversation(record_id=self.make_uuid(), user=user, meal=meal, created_at=self.now, sender="user", text=self.rng.choice(["Yes, a little.", "No sauce."])),
+            ]
+        if len(self.pending[Meal.meal_items.through]) >= self.batch_size:
+            self.flush()
+
+    def make_food(self, user: User) -> Food:
+        name, description, *per_serving = self.rng.choice(FOOD_CATALOG)
+        portion = self.rng.uniform(0.5, 2)
+        food = Food(id=self.make_uuid(), user=user, name=name, initial_description=description,
+                    archived=self.rng.random() < 0.05)
+        for nutrient, value in zip(NUTRIENTS, per_serving):
+            # same +/- 10% spread the model is asked for
+            setattr(food, nutrient + "_min", round(value * portion * 0.9, 2))
+            setattr(food, nutrient + "_max", round(value * portion * 1.1, 2))
+        return food
+
+    def flush(self):
+        # foods and meals before the m2m rows and conversations that point at them
+        with transaction.atomic():
+            for model, rows in self.pending.items():
+                if self.use_copy:
+                    copy_rows(model, rows)
+                else:
+                    model.objects.bulk_create(rows, batch_size=self.batch_size)
+                self.counts[model] += len(rows)
+                rows.clear()
+        self.stdout.write(f"{self.counts[Food]} foods, {self.counts[Meal]} meals "
+                          f"({time.perf_counter() - self.start:.1f}s)")
@@ -0,0 +1,54 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from api.food_import import start_import, run_import, import_format_for, ImportConflict, IMPORT_FORMATS
+
+
+class Command(BaseCommand):
+    help = ("Bulk import a user's food history from a CSV, JSON or NDJSON file that already has nutrients. "
+            "Running it again on the same file resumes from the last checkpoint.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("username")
+        parser.add_argument("path")
+        parser.add_argument("--format", choices=IMPORT_FORMATS, help="default: from the file extension, else csv")
+        parser.add_argument("--batch-size", type=int, default=settings.IMPORT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=options["username"]).first()
+        if not user:
+            raise CommandError("No user named " + options["username"])
+        file_format = options["format"] or import_format_for(options["path"])
+
+        with open(options["path"], "rb") as source:
+            job = start_import(user, source, options["path"])
+            if job.status == "completed":
+                self.stdout.write(f"{options['path']} was already imported as {job.id}")
+                return
+            if job.rows_done:
+                self.stdout.write(f"Resuming import {job.id} after row {job.rows_done}")
+
+            started, resumed_at = time.perf_counter(), job.rows_done
+
+            def progress(job):
+                elapsed = time.perf_counter() - started
+                rate = (job.rows_done - resumed_at) / elapsed if elapsed else 0
+                self.stdout.write(f"{job.rows_done} rows, {job.foods_created} foods, {job.meals_created} meals, "
+                                  f"{job.rows_skipped} skipped ({rate:.0f} rows/s)")
+
+            try:
+                run_import(job, source, file_format, options["batch_size"], on_progress=progress)
+            except ImportConflict as e:
+                raise CommandError(str(e))
+            except ValueError as e:
+                raise CommandError(f"Could not read {options['path']} after row {job.rows_done}: {e}")
+
+        for error in job.errors:
+            self.stderr.write(f"row {error['row']}: {error['error']}")
+        if job.rows_skipped > len(job.errors):
+            self.stderr.write(f"... and {job.rows_skipped - len(job.errors)} more bad rows")
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {job.foods_created} foods into {job.meals_created} new meals ({job.rows_skipped} rows skipped)"))
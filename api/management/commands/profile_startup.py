@@ -0,0 +1,90 @@
+import os
+import subprocess
+import sys
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# libraries that are only imported inside the code paths that use them; none of these should be
+# loaded just by starting a worker
+DEFERRED_MODULES = ["openai", "firebase_admin", "google.cloud.storage", "bs4", "PIL", "jwt", "twisted"]
+
+# generous on purpose: a cold worker currently imports everything in well under half of this,
+# so going over means something heavy crept back onto the startup path
+DEFAULT_BUDGET_MS = 1500
+
+
+@dataclass
+class ImportTiming:
+    module: str
+    self_us: int
+    cumulative_us: int
+    depth: int
+
+
+def startup_modules() -> list[str]:
+    # what a gunicorn worker loads before serving its first request
+    return ["food_tracker_backend.wsgi", settings.ROOT_URLCONF]
+
+
+def profile_imports(modules: list[str]) -> list[ImportTiming]:
+    """
+    Import the given modules in a fresh interpreter with -X importtime and return one entry per module it loaded.
+    A subprocess is the only way to get a cold start: everything is already imported in this one.
+    """
+    code = "import importlib\nfor module in %r:\n    importlib.import_module(module)\n" % (modules,)
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get("DJANGO_SETTINGS_MODULE", settings.SETTINGS_MODULE))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                            env=env, cwd=settings.BASE_DIR)
+    if result.returncode != 0:
+        raise CommandError("Importing %s failed:\n%s" % (", ".join(modules), result.stderr[-2000:]))
+
+    timings = []
+    for line in result.stderr.splitlines():
+        # "import time:       self [us] |  cumulative | imported package", nesting shown by indentation
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        timings.append(ImportTiming(name.strip(), int(self_us), int(cumulative_us), depth))
+    return timings
+
+
+def total_ms(timings: list[ImportTiming]) -> float:
+    return sum(t.cumulative_us for t in timings if t.depth == 0) / 1000
+
+
+def loaded_deferred_modules(timings: list[ImportTiming]) -> list[str]:
+    loaded = {t.module for t in timings}
+    return [module for module in DEFERRED_MODULES if module in loaded]
+
+
+class Command(BaseCommand):
+    help = "Report how long a fresh worker spends importing modules, and fail if it goes over budget."
+
+    def add_arguments(self, parser):
+        parser.add_argument("modules", nargs="*", help="modules to import (default: the wsgi app and the urlconf)")
+        parser.add_argument("--top", type=int, default=25, help="how many of the slowest modules to list")
+        parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+
+    def handle(self, *args, **options):
+        modules = options["modules"] or startup_modules()
+        timings = profile_imports(modules)
+
+        self.stdout.write(f"{'cumulative ms':>14}{'self ms':>10}  module")
+        for timing in sorted(timings, key=lambda t: t.cumulative_us, reverse=True)[:options["top"]]:
+            self.stdout.write(f"{timing.cumulative_us / 1000:>14.1f}{timing.self_us / 1000:>10.1f}  "
+                              f"{'  ' * timing.depth}{timing.module}")
+
+        total = total_ms(timings)
+        self.stdout.write(f"\n{len(timings)} modules imported in {total:.1f} ms (budget {options['budget_ms']:.0f} ms)")
+
+        errors = []
+        deferred = loaded_deferred_modules(timings)
+        if deferred:
+            errors.append("imported at startup but should be deferred: " + ", ".join(deferred))
+        if total > options["budget_ms"]:
+            errors.append(f"startup imports took {total:.1f} ms, over the {options['budget_ms']:.0f} ms budget")
+        if errors:
+            raise CommandError("; ".join(errors))
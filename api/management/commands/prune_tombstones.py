@@ -0,0 +1,16 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.cleanup import delete_old_tombstones
+
+
+class Command(BaseCommand):
+    help = ("Delete the records of deleted foods, meals and conversations kept for sync once they are older than "
+            "SYNC_TOKEN_MAX_AGE_DAYS, when every sync token that could need them has expired. "
+            "Meant to run on a schedule (e.g. daily).")
+
+    def handle(self, *args, **options):
+        deleted = delete_old_tombstones(timedelta(days=settings.SYNC_TOKEN_MAX_AGE_DAYS))
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} tombstones"))
@@ -0,0 +1,115 @@
+import json
+from threading import Lock
+from typing import Optional
+
+from cachetools import LRUCache
+from django.conf import settings
+from django.core.cache import caches
+from django.db import router
+
+from api.metrics import MEAL_CACHE_LOOKUPS, MEAL_CACHE_HIT_RATIO, MEAL_CACHE_LOCAL_BYTES, MEAL_CACHE_LOCAL_ENTRIES
+from api.models import Meal, UserProfile
+from api.renderers import FastJSONRenderer, orjson
+from api.serializers import MealSerializer
+
+# the shared tier, see CACHES in settings
+MEAL_CACHE_ALIAS = "meals"
+
+# (user_id, day) -> (data_version, payload); bounded by the total size of the payloads
+_local = LRUCache(maxsize=settings.MEAL_CACHE_LOCAL_BYTES, getsizeof=lambda entry: len(entry[1]))
+# cachetools caches aren't thread safe
+_local_lock = Lock()
+
+_decode = orjson.loads if orjson else json.loads
+
+
+def payload_key(user_id: int, day: str, data_version: int) -> str:
+    return f"payload:{user_id}:{day}:{data_version}"
+
+
+def current_data_version(user_id: int) -> Optional[int]:
+    # from the primary, like the rows (see serialize_meal_days)
+    return UserProfile.objects.using(router.db_for_write(UserProfile)).filter(user_id=user_id) \
+        .values_list("data_version", flat=True).first()
+
+
+def serialize_meal_days(user_id: int, days: list[str]) -> dict[str, list]:
+    # from the primary: rows read from a lagging replica would be cached under a data_version that's already current
+    meals = Meal.objects.using(router.db_for_write(Meal)).filter(user_id=user_id, date__in=days) \
+        .prefetch_related("meal_items")  # every total_* field walks meal_items
+    meals_by_day = {day: [] for day in days}
+    for meal in MealSerializer(meals, many=True).data:
+        meals_by_day[meal["date"]].append(meal)
+    return meals_by_day
+
+
+def cached_meal_days(user_id: int, days: list[str]) -> dict[str, list]:
+    """
+    MealSerializer output for each of the user's days ([] for a day without meals): from this process's LRU,
+    else the shared cache, else the database.
+
+    Entries are keyed on the user's data_version, which every write to their foods and meals bumps in the same
+    transaction (see touch_user_data) and which their ETag is made from (see api/conditional.py). A write makes
+    all of the user's entries unreachable at once, in every process and whatever the cache backend, so nothing
+    has to be invalidated; the old entries age out of the LRU and the shared cache. The version is read before
+    the rows, so an entry is never older than the version it's stored under.
+    """
+    days = list(dict.fromkeys(days))
+    if not days:
+        return {}
+    data_version = current_data_version(user_id)
+    if data_version is None:
+        # no profile to version the entries with
+        record_lookups(0, 0, len(days))
+        return serialize_meal_days(user_id, days)
+
+    payloads = {}
+    with _local_lock:
+        for day in days:
+            entry = _local.get((user_id, day))
+            if entry is not None and entry[0] == data_version:
+                payloads[day] = entry[1]
+    local_hits = len(payloads)
+
+    shared = caches[MEAL_CACHE_ALIAS]
+    wanted = {payload_key(user_id, day, data_version): day for day in days if day not in payloads}
+    shared_payloads = {wanted[key]: payload for key, payload in shared.get_many(wanted).items()}
+    payloads.update(shared_payloads)
+
+    missing = [day for day in days if day not in payloads]
+    fresh = serialize_meal_days(user_id, missing) if missing else {}
+    renderer = FastJSONRenderer()
+    new_payloads = {day: renderer.render(fresh[day]) for day in missing}
+    shared.set_many({payload_key(user_id, day, data_version): payload for day, payload in new_payloads.items()},
+                    settings.MEAL_CACHE_TTL)
+
+    with _local_lock:
+        for day, payload in {**shared_payloads, **new_payloads}.items():
+            _local[(user_id, day)] = (data_version, payload)
+        update_local_gauges()
+    record_lookups(local_hits, len(shared_payloads), len(missing))
+
+    return {day: fresh[day] if day in fresh else _decode(payloads[day]) for day in days}
+
+
+def record_lookups(local_hits: int, shared_hits: int, misses: int) -> None:
+    for result, count in (("local", local_hits), ("shared", shared_hits), ("miss", misses)):
+        if count:
+            MEAL_CACHE_LOOKUPS.inc((result,), count)
+    hits = MEAL_CACHE_LOOKUPS.get(("local",)) + MEAL_CACHE_LOOKUPS.get(("shared",))
+    total = hits + MEAL_CACHE_LOOKUPS.get(("miss",))
+    if total:
+        MEAL_CACHE_HIT_RATIO.set(value=hits / total)
+
+
+def update_local_gauges() -> None:
+    # with _local_lock held
+    MEAL_CACHE_LOCAL_BYTES.set(value=_local.currsize)
+    MEAL_CACHE_LOCAL_ENTRIES.set(value=len(_local))
+
+
+def clear() -> None:
+    caches[MEAL_CACHE_ALIAS].clear()
+    with _local_lock:
+        _local.clear()
+        update_local_gauges()
@@ -0,0 +1,223 @@
+import time
+from bisect import bisect_left
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from threading import Lock
+
+from django.db import connections
+
+# Every metric here lives in the memory of one worker process. With several gunicorn workers, a scrape of
+# /api/metrics/ through the router reaches one of them at random, so it only covers that worker's requests, and
+# consecutive scrapes can come from different workers, which makes counters look like they reset. Read the numbers
+# as a sample of one worker (rates and ratios hold up, totals don't), or give each worker its own scrape target;
+# exact totals across workers would need a shared store such as prometheus_client's multiprocess mode.
+
+# seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+# bytes
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram:
+    """
+    A minimal Prometheus-style histogram (cumulative buckets, sum and count per label set),
+    for this worker process only (see the note at the top).
+    """
+
+    def __init__(self, name: str, description: str, label_names: tuple, buckets: tuple):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        # label values -> [count per bucket (+Inf last), sum]
+        self.values = {}
+        self.lock = Lock()
+
+    def observe(self, label_values: tuple, value: float) -> None:
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def render(self) -> list[str]:
+        lines = ["# HELP " + self.name + " " + self.description, "# TYPE " + self.name + " histogram"]
+        with self.lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self.values.items()]
+        for label_values, counts, total in values:
+            labels = ",".join(f'{name}="{value}"' for name, value in zip(self.label_names, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+        return lines
+
+
+def render_labels(label_names: tuple, label_values: tuple) -> str:
+    labels = ",".join(f'{name}="{value}"' for name, value in zip(label_names, label_values))
+    return "{" + labels + "}" if labels else ""
+
+
+class Counter:
+    """
+    A Prometheus-style counter per label set, for this worker process only like Histogram.
+    """
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, label_names: tuple = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.values = {}
+        self.lock = Lock()
+
+    def inc(self, label_values: tuple = (), amount: float = 1) -> None:
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, label_values: tuple = ()) -> float:
+        with self.lock:
+            return self.values.get(label_values, 0)
+
+    def render(self) -> list[str]:
+        lines = ["# HELP " + self.name + " " + self.description, "# TYPE " + self.name + " " + self.kind]
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            lines.append(f"{self.name}{render_labels(self.label_names, label_values)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    """
+    A value that goes up and down (sizes, ratios); set by whoever owns it.
+    """
+    kind = "gauge"
+
+    def set(self, label_values: tuple = (), value: float = 0) -> None:
+        with self.lock:
+            self.values[label_values] = value
+
+
+REQUEST_DURATION = Histogram("api_request_duration_seconds", "Wall time per request.",
+                             ("view", "method", "status"), DURATION_BUCKETS)
+DB_QUERIES = Histogram("api_db_queries", "Database queries per request.", ("view",), QUERY_COUNT_BUCKETS)
+DB_DURATION = Histogram("api_db_duration_seconds", "Time spent in database queries per request.",
+                        ("view",), DURATION_BUCKETS)
+OUTBOUND_DURATION = Histogram("api_outbound_duration_seconds",
+                              "Time spent calling external services (openai, firebase, apple) per request.",
+                              ("view", "service"), DURATION_BUCKETS)
+RESPONSE_SIZE = Histogram("api_response_size_bytes", "Response body size.", ("view",), SIZE_BUCKETS)
+
+HISTOGRAMS = [REQUEST_DURATION, DB_QUERIES, DB_DURATION, OUTBOUND_DURATION, RESPONSE_SIZE]
+
+# the serialized meal cache (see api/meal_cache.py)
+MEAL_CACHE_LOOKUPS = Counter("api_meal_cache_lookups_total",
+                             "Meal cache lookups per (user, day), by the tier that had it (local, shared) or miss.",
+                             ("result",))
+MEAL_CACHE_HIT_RATIO = Gauge("api_meal_cache_hit_ratio",
+                             "Share of this worker's meal cache lookups answered by either tier.")
+MEAL_CACHE_LOCAL_BYTES = Gauge("api_meal_cache_local_bytes", "Size of the payloads in this worker's meal cache tier.")
+MEAL_CACHE_LOCAL_ENTRIES = Gauge("api_meal_cache_local_entries", "(user, day) entries in this worker's meal cache tier.")
+
+# OpenAI request coalescing (see api/coalesce.py)
+OPENAI_CALLS = Counter("api_openai_calls_total", "Chat completion requests this worker sent to OpenAI.")
+OPENAI_CALLS_COALESCED = Counter("api_openai_calls_coalesced_total",
+                                 "Chat completion requests answered by an identical call in flight, made by this "
+                                 "worker (local) or another one (shared).", ("source",))
+
+METRICS = HISTOGRAMS + [MEAL_CACHE_LOOKUPS, MEAL_CACHE_HIT_RATIO, MEAL_CACHE_LOCAL_BYTES,
+                        MEAL_CACHE_LOCAL_ENTRIES, OPENAI_CALLS, OPENAI_CALLS_COALESCED]
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.db_queries = 0
+        self.db_time = 0.0
+        # service -> seconds
+        self.outbound = {}
+
+    def db_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_queries += 1
+            self.db_time += time.perf_counter() - start
+
+
+_current_metrics = ContextVar("request_metrics", default=None)
+
+
+@contextmanager
+def track_outbound(service: str):
+    """
+    Time a call to an external service and attribute it to the current request (no-op outside a request).
+    """
+    metrics = _current_metrics.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.outbound[service] = metrics.outbound.get(service, 0.0) + time.perf_counter() - start
+
+
+def view_name(request) -> str:
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "unmatched"
+    view_class = getattr(match.func, "view_class", None) or getattr(match.func, "cls", None)
+    return view_class.__name__ if view_class else match.url_name or match.view_name
+
+
+class RequestMetricsMiddleware:
+    """
+    Records wall time, query count/time, outbound call time and response size for every request,
+    exposes them on metrics/ and adds a Server-Timing header so they show up in client tooling.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = _current_metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics.db_wrapper))
+                response = self.get_response(request)
+        finally:
+            _current_metrics.reset(token)
+        duration = time.perf_counter() - start
+
+        view = view_name(request)
+        REQUEST_DURATION.observe((view, request.method, str(response.status_code)), duration)
+        DB_QUERIES.observe((view,), metrics.db_queries)
+        DB_DURATION.observe((view,), metrics.db_time)
+        for service, seconds in metrics.outbound.items():
+            OUTBOUND_DURATION.observe((view, service), seconds)
+        if not response.streaming:
+            RESPONSE_SIZE.observe((view,), len(response.content))
+
+        timings = [f"total;dur={duration * 1000:.1f}",
+                   f'db;dur={metrics.db_time * 1000:.1f};desc="{metrics.db_queries} queries"']
+        timings += [f"{service};dur={seconds * 1000:.1f}" for service, seconds in metrics.outbound.items()]
+        response["Server-Timing"] = ", ".join(timings)
+        return response
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.3 on 2026-10-19 17:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_storedimage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='food',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='storedimage',
+            name='variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AlterField(
+            model_name='food',
+            name='image_url',
+            field=models.URLField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.3 on 2026-10-19 17:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_food_image_variants_storedimage_variants_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='data_version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.0.3 on 2026-10-19 17:33
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_userprofile_data_version'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FoodImport',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('source_hash', models.CharField(max_length=64)),
+                ('source_name', models.CharField(blank=True, default='', max_length=255)),
+                ('status', models.CharField(choices=[('running', 'running'), ('completed', 'completed')], default='running', max_length=20)),
+                ('rows_done', models.PositiveIntegerField(default=0)),
+                ('rows_skipped', models.PositiveIntegerField(default=0)),
+                ('foods_created', models.PositiveIntegerField(default=0)),
+                ('meals_created', models.PositiveIntegerField(default=0)),
+                ('errors', models.JSONField(blank=True, default=list)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'source_hash')},
+            },
+        ),
+    ]
@@ -0,0 +1,85 @@
+# Generated by Django 5.0.3 on 2026-10-19 17:39
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.conf import settings
+from django.contrib.postgres.operations import BtreeGinExtension, TrigramExtension
+from django.db import migrations
+from django.db.migrations.operations import AddIndex
+
+
+class AddPostgresIndex(AddIndex):
+    """
+    AddIndex for GIN indexes, which only exist on Postgres; elsewhere (the SQLite test database) it only updates the state.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+# must match SEARCH_CONFIG and the weights in api/search.py
+CREATE_SEARCH_TRIGGER = """
+CREATE FUNCTION api_food_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('english', coalesce(NEW.name, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(NEW.initial_description, '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER api_food_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF name, initial_description, search_vector ON api_food
+    FOR EACH ROW EXECUTE FUNCTION api_food_search_vector_update();
+
+-- fill in the existing rows (the trigger recomputes the value)
+UPDATE api_food SET search_vector = NULL;
+"""
+
+DROP_SEARCH_TRIGGER = """
+DROP TRIGGER IF EXISTS api_food_search_vector_trigger ON api_food;
+DROP FUNCTION IF EXISTS api_food_search_vector_update();
+"""
+
+
+def create_search_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(CREATE_SEARCH_TRIGGER)
+
+
+def drop_search_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(DROP_SEARCH_TRIGGER)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0018_foodimport'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # both are no-ops on databases other than Postgres
+        BtreeGinExtension(),
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='food',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_trigger, drop_search_trigger),
+        AddPostgresIndex(
+            model_name='food',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['user', 'search_vector'], name='food_user_search_gin'),
+        ),
+        AddPostgresIndex(
+            model_name='food',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['name'], name='food_name_trgm_gin', opclasses=['gin_trgm_ops']),
+        ),
+    ]
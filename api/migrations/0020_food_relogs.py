@@ -0,0 +1,30 @@
+# Generated by Django 5.0.3 on 2026-10-19 17:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0019_food_search'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='food',
+            name='logged_from',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='relogs', to='api.food'),
+        ),
+        migrations.AddField(
+            model_name='food',
+            name='times_logged',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddIndex(
+            model_name='food',
+            index=models.Index(condition=models.Q(('logged_from__isnull', True)), fields=['user', '-times_logged'], name='food_user_times_logged'),
+        ),
+    ]
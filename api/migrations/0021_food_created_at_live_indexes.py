@@ -0,0 +1,37 @@
+# Generated by Django 5.0.3 on 2026-10-19 17:42
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0020_food_relogs'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='food',
+            name='food_user_times_logged',
+        ),
+        migrations.AddField(
+            model_name='food',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='food',
+            index=models.Index(condition=models.Q(('archived', False), ('logged_from__isnull', True)), fields=['user', '-times_logged'], name='food_user_times_logged'),
+        ),
+        migrations.AddIndex(
+            model_name='food',
+            index=models.Index(condition=models.Q(('archived', False)), fields=['user'], name='food_user_live'),
+        ),
+        migrations.AddIndex(
+            model_name='food',
+            index=models.Index(condition=models.Q(('archived', True)), fields=['created_at'], name='food_archived_created'),
+        ),
+    ]
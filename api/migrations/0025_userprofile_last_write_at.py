@@ -0,0 +1,18 @@
+# Generated by Django 5.0.3 on 2026-10-19 18:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0024_completionrequest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='last_write_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,7 +1,14 @@
-from django.db import models
+from typing import Optional
+
+from django.db import connections, models, router, transaction
 import uuid
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F
+from django.utils import timezone
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
 from django.dispatch import receiver
 
 
@@ -13,13 +20,63 @@ class UserProfile(models.Model):
     weight = models.FloatField(default=0)
     # the user's age in years
     age = models.IntegerField(default=0)
+    # bumped whenever one of the user's Foods, Meals or Conversations changes; used for ETags (see api/conditional.py)
+    # and as the revision counter for sync (see SyncedModel)
+    data_version = models.PositiveBigIntegerField(default=0)
+    # when data_version was last bumped; the user's reads stay on the primary for a while after (see api/db_routers.py)
+    last_write_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return self.user.username + "'s profile"
 
 
 
-class Food(models.Model):
+class StoredImage(models.Model):
+    """
+    An image blob in Firebase storage, keyed by the sha256 of its content so identical uploads are only stored once.
+    reference_count is the number of Foods using the image; the blob is deleted when the last one goes away.
+    """
+    content_hash = models.CharField(max_length=64, primary_key=True)
+    filename = models.CharField(max_length=255)
+    url = models.URLField(max_length=500, unique=True)
+    reference_count = models.PositiveIntegerField(default=0)
+    # resized copies, e.g. {"small": "https://...", "medium": "https://..."}; filled in by a background task
+    variants = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.filename + " (" + str(self.reference_count) + " references)"
+
+
+class SyncedModel(models.Model):
+    """
+    A row clients keep an offline copy of (see api/sync.py). Every save stamps it with a new revision, the user's
+    bumped data_version, in the same transaction, so a client can ask for everything past the revision it last saw.
+    Writes that skip save() (update(), bulk_create(), raw SQL) have to set revision and updated_at themselves.
+
+    Bumping data_version locks the user's UserProfile row until the transaction commits, which serialises all of
+    a user's writes: a second one waits for the first to commit. That ordering is what makes revisions safe to sync
+    by, and writes for different users don't contend, but keep transactions that save synced rows short.
+    """
+    # a default rather than auto_now so rows written with COPY (api/bulk.py) get it too
+    updated_at = models.DateTimeField(default=timezone.now, editable=False)
+    revision = models.PositiveBigIntegerField(default=0, editable=False)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, update_fields=None, **kwargs):
+        using = kwargs.get("using") or router.db_for_write(type(self), instance=self)
+        # outside a transaction a sync could see the new data_version before the row that has it, and skip the row
+        with transaction.atomic(using=using, savepoint=False):
+            self.revision = touch_user_data(self.user_id)
+            self.updated_at = timezone.now()
+            if update_fields is not None:
+                update_fields = {*update_fields, "revision", "updated_at"}
+            super().save(*args, update_fields=update_fields, **kwargs)
+
+
+class Food(SyncedModel):
     """
     A "food" is a portion or serving of a food or drink that is consumed at a meal or snack.
     For example, a fish and rice dish, a cappuccino, or a slice of bread with butter would all constitute meal items.
@@ -32,7 +89,18 @@ class Food(models.Model):
     response = models.TextField(blank=True, null=True)
     follow_up = models.TextField(blank=True, null=True)
     archived = models.BooleanField(default=False)
-    image_url = models.URLField(blank=True, null=True)
+    image_url = models.URLField(blank=True, null=True, db_index=True)
+    # smaller copies of the image, keyed by size name (see api/image_storage.py IMAGE_VARIANT_SIZES)
+    image_variants = models.JSONField(default=dict, blank=True)
+    # name and initial_description for full-text search (see api/search.py); on Postgres a trigger
+    # keeps it up to date on every insert and update, including bulk ones
+    search_vector = SearchVectorField(null=True, editable=False)
+    # set on foods re-logged from an earlier one (see RelogFood), always pointing at the original
+    logged_from = models.ForeignKey("self", on_delete=models.SET_NULL, null=True, blank=True, related_name="relogs")
+    # on originals: how many times this food has been logged, counting the original
+    times_logged = models.PositiveIntegerField(default=1)
+    # a default rather than auto_now_add so rows written with COPY (api/bulk.py) get it too
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
     # the system with nutritional info is on a *range* of values, so we need to store the min and max values
     # all values are in grams
     calories_min = models.FloatField(default=0)
@@ -68,10 +136,45 @@ class Food(models.Model):
     @staticmethod
     def properties_to_calculate() -> list[str]:
         list_of_fields = [field.name for field in Food._meta.get_fields()]
-        for field in ["id", "name", "meal", "archived", "image_url"]:
+        for field in ["id", "name", "meal", "archived", "image_url", "image_variants", "search_vector", "logged_from",
+                      "times_logged", "relogs", "created_at", "updated_at", "revision"]:
             list_of_fields.remove(field)
         return list_of_fields
 
+    @staticmethod
+    def nutrient_fields() -> list[str]:
+        return [field.name for field in Food._meta.get_fields() if field.name.endswith(("_min", "_max"))]
+
+    def scaled_copy(self, portion: float) -> "Food":
+        """
+        A new, unsaved Food with the same description and image as this one and every nutrient range
+        multiplied by portion, linked back to the original food.
+        """
+        food = Food(user_id=self.user_id, name=self.name, initial_description=self.initial_description,
+                    response=self.response, image_url=self.image_url, image_variants=self.image_variants,
+                    logged_from_id=self.logged_from_id or self.id)
+        for field in Food.nutrient_fields():
+            setattr(food, field, getattr(self, field) * portion)
+        return food
+
+    class Meta:
+        indexes = [
+            # full-text search within one user's foods (the user column needs btree_gin)
+            GinIndex(fields=["user", "search_vector"], name="food_user_search_gin"),
+            # typo-tolerant autocomplete on names (pg_trgm)
+            GinIndex(fields=["name"], name="food_name_trgm_gin", opclasses=["gin_trgm_ops"]),
+            # a user's most frequent foods (RelogFood.get)
+            models.Index(fields=["user", "-times_logged"], name="food_user_times_logged",
+                         condition=models.Q(logged_from__isnull=True, archived=False)),
+            # LogFood creates foods archived until SaveFood keeps them, so queries for the user's real foods
+            # filter on archived=False; these leave the abandoned estimates out of the index
+            models.Index(fields=["user"], name="food_user_live", condition=models.Q(archived=False)),
+            # and this one finds the abandoned ones to clean up (api/cleanup.py)
+            models.Index(fields=["created_at"], name="food_archived_created", condition=models.Q(archived=True)),
+            # changes since a client's last sync (api/sync.py)
+            models.Index(fields=["user", "revision"], name="food_user_revision"),
+        ]
+
     def __str__(self):
         return self.name + " (" + str(self.calories_min) + " - " + str(self.calories_max) + " calories)"
 
@@ -84,7 +187,7 @@ class MealTypes(models.TextChoices):
     OTHER = "other"
     NA = "n/a"
 
-class Meal(models.Model):
+class Meal(SyncedModel):
     """
     A "meal" is a collection of meal items that are consumed at a specific time.
     For example, a breakfast, lunch, or dinner would all be considered meals.
@@ -101,6 +204,7 @@ class Meal(models.Model):
     description = models.TextField(blank=True, null=True)
     most_recent_follow_up = models.CharField(max_length=255, blank=True, null=True)
     date = models.CharField(max_length=10, blank=False, null=False) # YYYY-MM-DD "2024-05-12"
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
 
     @property
     def total_min_calories(self):
@@ -184,10 +288,56 @@ class Meal(models.Model):
 
     class Meta:
         unique_together = ["meal_type", "date", "user"]
+        indexes = [
+            models.Index(fields=["user", "revision"], name="meal_user_revision"),
+        ]
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
 
+    @classmethod
+    def add_food(cls, user, food: Food, meal_type: str, date: str, meal_name: Optional[str] = None) -> "Meal":
+        """
+        Add food to the user's meal_type meal on date, creating the meal if needed, and append the food's
+        description to the meal's. The meal row is written with a single INSERT ... ON CONFLICT DO UPDATE on the
+        (meal_type, date, user) key, and the append happens in SQL, so concurrent logs for the same meal neither
+        lose text nor hit an IntegrityError. Works on Postgres and SQLite (3.35+, for RETURNING).
+        """
+        connection = connections[router.db_for_write(cls)]
+        quote = connection.ops.quote_name
+        fields = cls._meta.concrete_fields
+        table = quote(cls._meta.db_table)
+        sql = f"""
+            INSERT INTO {table} ({", ".join(quote(field.column) for field in fields)})
+            VALUES ({", ".join(["%s"] * len(fields))})
+            ON CONFLICT ({quote("meal_type")}, {quote("date")}, {quote("user_id")}) DO UPDATE SET
+                {quote("name")} = COALESCE(NULLIF(EXCLUDED.{quote("name")}, ''), {table}.{quote("name")}),
+                {quote("description")} = CASE
+                    WHEN {table}.{quote("description")} IS NULL OR {table}.{quote("description")} = ''
+                        THEN EXCLUDED.{quote("description")}
+                    WHEN EXCLUDED.{quote("description")} IS NULL OR EXCLUDED.{quote("description")} = ''
+                        THEN {table}.{quote("description")}
+                    ELSE {table}.{quote("description")} || ' ' || EXCLUDED.{quote("description")}
+                END,
+                {quote("updated_at")} = EXCLUDED.{quote("updated_at")},
+                {quote("revision")} = EXCLUDED.{quote("revision")}
+            RETURNING {", ".join(quote(field.column) for field in fields)}
+        """
+        with transaction.atomic(using=connection.alias):
+            # neither the raw upsert nor bulk_create send signals or go through save()
+            new_meal = cls(user=user, meal_type=meal_type, date=date, name=meal_name or "",
+                           description=food.initial_description, revision=touch_user_data(user.id))
+            params = [field.get_db_prep_save(getattr(new_meal, field.attname), connection) for field in fields]
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                row = cursor.fetchone()
+            meal = cls.from_db(connection.alias, [field.attname for field in fields],
+                               [field.to_python(value) for field, value in zip(fields, row)])
+            MealItem = cls.meal_items.through
+            MealItem.objects.using(connection.alias).bulk_create([MealItem(meal_id=meal.id, food_id=food.id)],
+                                                                 ignore_conflicts=True)
+        return meal
+
     def __str__(self):
         return self.name + " (" + str(self.date) + " " + str(self.meal_type) +  ")"
 
@@ -195,16 +345,114 @@ class Meal(models.Model):
 
     #... etc. for other nutritional info properties
 
-class Conversation(models.Model):
+class Conversation(SyncedModel):
     """
     This model tracks any conversation (follow-up questions, etc.) between the user and the bot concerning a specific meal item
     """
     record_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, unique=True)
     meal = models.ForeignKey(Meal, on_delete=models.CASCADE) # this operates as a conversation id
+    # always the meal's user; kept here so sync can find a user's conversations by (user, revision)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, editable=False)
     text = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
     sender = models.CharField(max_length=100, null=False, blank=False, choices=[("user", "user"), ("bot", "bot")])
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "revision"], name="conversation_user_revision"),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.user_id is None:
+            self.user_id = self.meal.user_id
+        super().save(*args, **kwargs)
+
+
+class Tombstone(models.Model):
+    """
+    A deleted Food, Meal or Conversation, so clients that synced before the delete drop their copy (see api/sync.py).
+    Kept for SYNC_TOKEN_MAX_AGE_DAYS, after which the sync tokens that could still need it have expired.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # the model name: "food", "meal" or "conversation"
+    kind = models.CharField(max_length=20)
+    object_id = models.UUIDField()
+    revision = models.PositiveBigIntegerField()
+    deleted_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "revision"], name="tombstone_user_revision"),
+            models.Index(fields=["deleted_at"], name="tombstone_deleted_at"),
+        ]
+
+class FoodImport(models.Model):
+    """
+    A bulk import of food logs exported from another tracker (see api/food_import.py).
+    rows_done is the checkpoint: it is saved in the same transaction as each batch, so an interrupted
+    import picks up exactly where it stopped when the same file is sent again.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # sha256 of the uploaded file, sending the same file again resumes this import
+    source_hash = models.CharField(max_length=64)
+    source_name = models.CharField(max_length=255, blank=True, default="")
+    status = models.CharField(max_length=20, default="running", choices=[("running", "running"), ("completed", "completed")])
+    rows_done = models.PositiveIntegerField(default=0)
+    rows_skipped = models.PositiveIntegerField(default=0)
+    foods_created = models.PositiveIntegerField(default=0)
+    meals_created = models.PositiveIntegerField(default=0)
+    # the first few invalid rows, [{"row": 12, "error": "..."}]
+    errors = models.JSONField(default=list, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ["user", "source_hash"]
+
+
+class IdempotencyKey(models.Model):
+    """
+    A request sent with an Idempotency-Key header (see api/idempotency.py). The row is claimed before the view runs
+    and holds its response once it's done, so a retry with the same key gets that response instead of running again.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    key = models.CharField(max_length=255)
+    # sha256 of the request's method, path and data; a key can't be reused for a different request
+    fingerprint = models.CharField(max_length=64)
+    status = models.CharField(max_length=20, default="running", choices=[("running", "running"), ("completed", "completed")])
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_data = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # for a running request, when it was claimed (or taken over, see IDEMPOTENCY_STALE_SECONDS)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ["user", "key"]
+        indexes = [
+            # expired keys are deleted by created_at (api/cleanup.py)
+            models.Index(fields=["created_at"], name="idempotency_key_created"),
+        ]
+
+
+class CompletionRequest(models.Model):
+    """
+    An OpenAI request some worker is making (response is null) or has just made, so identical requests from other
+    workers wait for its response instead of making their own (see api/coalesce.py). Rows only live for seconds.
+    """
+    # sha256 of the whole request: model, messages (images by their content-addressed url), temperature, ...
+    fingerprint = models.CharField(max_length=64, unique=True)
+    response = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # while running, when it was started (or taken over); once done, when it finished
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # finished and abandoned rows are pruned by updated_at
+            models.Index(fields=["updated_at"], name="completion_request_updated"),
+        ]
+
 # class CurrentThread(models.Model):
 #     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
 #     user = models.ForeignKey(User, on_delete=models.CASCADE, unique=False, null=False, blank=False)
@@ -225,4 +473,84 @@ def create_user_profile(sender, instance, created, **kwargs):
 
 @receiver(post_save, sender=User)
 def save_user_profile(sender, instance, **kwargs):
-    instance.userprofile.save()
\ No newline at end of file
+    instance.userprofile.save()
+
+# ----------------------
+# SIGNALS TO REFERENCE COUNT STORED IMAGES
+@receiver(post_save, sender=Food)
+def retain_food_image(sender, instance, created, **kwargs):
+    if created and instance.image_url:
+        StoredImage.objects.filter(url=instance.image_url).update(reference_count=F("reference_count") + 1)
+        # a repeat image already has its variants, no need to wait for the background task
+        stored_image = StoredImage.objects.filter(url=instance.image_url).only("variants").first()
+        if stored_image and stored_image.variants and not instance.image_variants:
+            instance.image_variants = stored_image.variants
+            Food.objects.filter(pk=instance.pk).update(image_variants=stored_image.variants)
+
+@receiver(post_delete, sender=Food)
+def release_food_image(sender, instance, **kwargs):
+    if instance.image_url:
+        from api.image_storage import release_image
+        release_image(instance.image_url)
+
+# ----------------------
+# SIGNALS TO TRACK CHANGES TO A USER'S DATA
+def touch_user_data(user_id: int) -> int:
+    """
+    Bump the user's data_version and return it; it is also the revision for whatever is being written (see SyncedModel).
+    Also sets last_write_at, which keeps the user's reads on the primary for a while (see api/db_routers.py).
+    Call this in the same transaction as bulk writes that don't send signals (update(), bulk_create(), raw SQL).
+    """
+    connection = connections[router.db_for_write(UserProfile)]
+    quote = connection.ops.quote_name
+    now = UserProfile._meta.get_field('last_write_at').get_db_prep_save(timezone.now(), connection)
+    with connection.cursor() as cursor:
+        cursor.execute(f"UPDATE {quote(UserProfile._meta.db_table)} SET {quote('data_version')} = {quote('data_version')} + 1, "
+                       f"{quote('last_write_at')} = %s "
+                       f"WHERE {quote('user_id')} = %s RETURNING {quote('data_version')}", [now, user_id])
+        row = cursor.fetchone()
+    return row[0] if row else 0
+
+def deleting_user(origin) -> bool:
+    # the account is going away along with its tombstones, nobody is left to sync
+    return isinstance(origin, User) or (isinstance(origin, models.QuerySet) and origin.model is User)
+
+@receiver(post_delete, sender=Food)
+@receiver(post_delete, sender=Meal)
+@receiver(post_delete, sender=Conversation)
+def record_tombstone(sender, instance, origin, **kwargs):
+    if deleting_user(origin):
+        return
+    Tombstone.objects.create(user_id=instance.user_id, kind=sender._meta.model_name, object_id=instance.pk,
+                             revision=touch_user_data(instance.user_id))
+
+def touch_meals(user_id: int, meals: models.QuerySet, revision: Optional[int] = None) -> None:
+    """
+    Give meals a new revision, for changes that show up in their serialized form without saving them. The receivers
+    below are the one place that works out which meals a change touches; the meal cache needs no receivers of its
+    own since it is keyed on data_version (see api/meal_cache.py).
+    """
+    meals.update(revision=revision or touch_user_data(user_id), updated_at=timezone.now())
+
+@receiver(post_save, sender=Food)
+def food_saved(sender, instance, created, update_fields, **kwargs):
+    # a meal's total_* fields come from its foods' nutrients; a new food isn't in a meal yet
+    if created or (update_fields is not None and not set(update_fields) & set(Food.nutrient_fields())):
+        return
+    touch_meals(instance.user_id, Meal.objects.filter(meal_items=instance), instance.revision)
+
+@receiver(pre_delete, sender=Food)
+def food_deleting(sender, instance, origin, **kwargs):
+    # while its meal_items rows still exist
+    if not deleting_user(origin):
+        touch_meals(instance.user_id, Meal.objects.filter(meal_items=instance))
+
+@receiver(m2m_changed, sender=Meal.meal_items.through)
+def meal_items_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # reverse is food.meal_set.add(...); both sides belong to the same user
+    if not reverse and action in ("post_add", "post_remove", "post_clear"):
+        touch_meals(instance.user_id, Meal.objects.filter(pk=instance.pk))
+    elif reverse and action in ("post_add", "post_remove"):
+        touch_meals(instance.user_id, Meal.objects.filter(pk__in=pk_set))
+    elif reverse and action == "pre_clear":
+        touch_meals(instance.user_id, Meal.objects.filter(meal_items=instance))
@@ -1,18 +1,18 @@
 import base64
-import uuid
 from enum import Enum
 import os
 from io import BytesIO
 from typing import List, Dict, override, Optional
 from openai import OpenAI
 from openai import OpenAIError
-from bs4 import BeautifulSoup
-import requests
+from django.core.files.uploadedfile import UploadedFile
 from dotenv import load_dotenv
 from openai.lib.streaming import AssistantEventHandler
 from openai.types.beta import Thread
 
-from api.firebase_setup import upload_image_to_firebase
+from api.coalesce import coalesced, request_fingerprint
+from api.image_storage import store_image
+from api.metrics import track_outbound
 
 # get api key from .env
 load_dotenv()
@@ -138,12 +138,11 @@ class OpenAIConnect:
         img_data = base64.b64decode(base64_str)
         return BytesIO(img_data)
 
-    @staticmethod
-    def generate_image_filename() -> str:
-        return uuid.uuid4().hex + ".png"
-
     def get_response(self, prompt: str, previous_messages: list[str] = None, system_prompt: str = None,
-                     base64_image: str = None) -> str:
+                     base64_image: str = None, image_file: UploadedFile = None) -> str:
+        """
+        An image can be passed either as a base64 string or as an uploaded file (streamed multipart upload).
+        """
         if not system_prompt:
             system_prompt = self.system_prompt
 
@@ -163,10 +162,16 @@ class OpenAIConnect:
 
         # attach latest message
         messages.append({"role": "user", "content": prompt})
-        if base64_image:
+        if base64_image or image_file:
             # image included
-            bytesIO = self.decode_base64_image(base64_image)
-            firebase_image_url = upload_image_to_firebase(bytesIO, self.generate_image_filename())
+            # images are stored under their content hash, so a repeat photo is not uploaded again
+            if image_file:
+                extension = os.path.splitext(image_file.name or "")[1].lower() or ".png"
+                stored_image = store_image(image_file, extension, image_file.content_type)
+            else:
+                bytesIO = self.decode_base64_image(base64_image)
+                stored_image = store_image(bytesIO)
+            firebase_image_url = stored_image.url
             print("firebase_image_url: ", firebase_image_url)
             self.image_url = firebase_image_url
             messages.append(
@@ -184,21 +189,32 @@ class OpenAIConnect:
                 }
             )
 
-        try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=self.temperature,
-                max_tokens=self.max_tokens,
-                response_format={"type": "json_object"},
-                timeout=self.timeout
-            )
+        request = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens,
+            "response_format": {"type": "json_object"},
+        }
+
+        def create() -> str:
+            # only the caller that makes the call is charged for it, not the ones coalesced onto it
+            with track_outbound("openai"):
+                response = self.client.chat.completions.create(**request, timeout=self.timeout)
             return response.choices[0].message.content
+
+        try:
+            # identical requests made at the same time (everyone logging the day's special) share one call
+            return coalesced(request_fingerprint(request), create)
         except OpenAIError as e:
             raise ValueError("Error in OpenAIConnect.get_response: ", e)
 
     @staticmethod
     def get_recipe_details(url: str) -> str or None:
+        # only needed for recipe links, so keep them out of worker startup
+        import requests
+        from bs4 import BeautifulSoup
+
         response = requests.get(url)
         response.raise_for_status()
 
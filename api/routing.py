@@ -0,0 +1,7 @@
+from django.urls import path
+
+from api.consumers import MealUpdatesConsumer
+
+websocket_urlpatterns = [
+    path('ws/meals/', MealUpdatesConsumer.as_asgi(), name='meal_updates'),
+]
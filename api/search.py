@@ -0,0 +1,46 @@
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramWordSimilarity
+from django.db import connections
+from django.db.models import F, Max, Q, QuerySet
+
+from api.models import Food
+
+# text search configuration used by the search_vector trigger (migration 0019), queries have to use the same one
+SEARCH_CONFIG = "english"
+# name matches are weighted "A" and description matches "B" in search_vector; this is the scale SearchRank uses
+SEARCH_WEIGHTS = [0.1, 0.2, 0.4, 1.0]
+
+
+def uses_postgres_search(queryset: QuerySet) -> bool:
+    # tests run on SQLite, which has neither tsvector nor pg_trgm
+    return connections[queryset.db].vendor == "postgresql"
+
+
+def search_foods(user, query: str) -> QuerySet:
+    """
+    The user's foods matching query, best match first. On Postgres this is full-text search over the
+    name and initial_description (served by food_user_search_gin); elsewhere a plain substring match on the same fields.
+    query uses web search syntax: words, "quoted phrases", -excluded, or.
+    """
+    foods = Food.objects.filter(user=user, archived=False).defer("search_vector")
+    if uses_postgres_search(foods):
+        search_query = SearchQuery(query, search_type="websearch", config=SEARCH_CONFIG)
+        return foods.filter(search_vector=search_query) \
+            .annotate(rank=SearchRank(F("search_vector"), search_query, weights=SEARCH_WEIGHTS)) \
+            .order_by("-rank", "name", "id")
+    return foods.filter(Q(name__icontains=query) | Q(initial_description__icontains=query)).order_by("name", "id")
+
+
+def suggest_food_names(user, text: str, limit: int) -> list[str]:
+    """
+    Names of the user's foods for autocomplete, closest first. On Postgres this is typo tolerant: "chiken bur" still
+    finds "Chicken burrito" through word similarity on food_name_trgm_gin. Elsewhere it is a prefix match.
+    """
+    foods = Food.objects.filter(user=user, archived=False)
+    if uses_postgres_search(foods):
+        names = foods.filter(name__trigram_word_similar=text) \
+            .values("name") \
+            .annotate(similarity=Max(TrigramWordSimilarity(text, "name"))) \
+            .order_by("-similarity", "name")
+    else:
+        names = foods.filter(name__istartswith=text).values("name").distinct().order_by("name")
+    return [row["name"] for row in names[:limit]]
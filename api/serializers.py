@@ -1,10 +1,39 @@
 from rest_framework import serializers
-from .models import Food, Meal, UserProfile, Conversation
+from .image_storage import IMAGE_VARIANT_FORMATS, variant_name
+from .models import Food, Meal, UserProfile, Conversation, FoodImport
+
+class ImageVariantField(serializers.Field):
+    """
+    The url of the image variant asked for with ?image_size=small|medium|large, e.g. small thumbnails on list screens,
+    in WebP unless ?image_format=jpeg. Falls back to the full-size image_url when no size is requested or the
+    variant isn't ready yet.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs["source"] = "*"
+        kwargs["read_only"] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, food):
+        request = self.context.get("request")
+        size_name = request.query_params.get("image_size") if request else None
+        if size_name and food.image_variants:
+            image_format = request.query_params.get("image_format", "webp")
+            if image_format not in IMAGE_VARIANT_FORMATS:
+                image_format = "webp"
+            return food.image_variants.get(variant_name(size_name, image_format), food.image_url)
+        return food.image_url
+
 
 class FoodSerializer(serializers.ModelSerializer):
+    display_image_url = ImageVariantField()
+
     class Meta:
         model = Food
-        fields = '__all__'
+        # search_vector is an index column, not data
+        exclude = ['search_vector']
+        # filled in by api/image_storage.py, never by the client or the model's estimate
+        read_only_fields = ['image_variants']
 
 class MealSerializer(serializers.ModelSerializer):
     total_min_calories = serializers.SerializerMethodField()
@@ -103,6 +132,12 @@ class ConversationSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class FoodImportSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = FoodImport
+        exclude = ["user", "source_hash"]
+
+
 class CreateUserSerializer(serializers.Serializer):
     user_id = serializers.CharField(max_length=100)
     email = serializers.EmailField(required=True)
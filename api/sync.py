@@ -0,0 +1,83 @@
+from datetime import timedelta
+from typing import Optional
+
+from django.conf import settings
+from django.core import signing
+
+from api.models import Food, Meal, Conversation, Tombstone, UserProfile
+from api.serializers import FoodSerializer, MealSerializer, ConversationSerializer
+
+_signer = signing.TimestampSigner(salt="api.sync")
+
+
+def food_sync_queryset(user):
+    return Food.objects.filter(user=user).defer("search_vector")
+
+
+def meal_sync_queryset(user):
+    # every total_* field walks meal_items
+    return Meal.objects.filter(user=user).prefetch_related("meal_items")
+
+
+def conversation_sync_queryset(user):
+    return Conversation.objects.filter(user=user)
+
+
+SYNC_KINDS = {
+    "foods": (Food, food_sync_queryset, FoodSerializer),
+    "meals": (Meal, meal_sync_queryset, MealSerializer),
+    "conversations": (Conversation, conversation_sync_queryset, ConversationSerializer),
+}
+
+
+def make_token(user_id: int, revision: int) -> str:
+    return _signer.sign(f"{user_id}:{revision}")
+
+
+def read_token(user_id: int, token: str) -> Optional[int]:
+    """
+    The revision a sync token was issued at, or None if the client has to start over: the token is someone else's,
+    was tampered with, or is older than SYNC_TOKEN_MAX_AGE_DAYS, after which the tombstones it needs may be pruned.
+    """
+    try:
+        value = _signer.unsign(token, max_age=timedelta(days=settings.SYNC_TOKEN_MAX_AGE_DAYS))
+        token_user_id, revision = (int(part) for part in value.split(":"))
+    except (signing.BadSignature, ValueError):
+        return None
+    return revision if token_user_id == user_id else None
+
+
+def changes_since(request, since: Optional[int]) -> dict:
+    """
+    The user's foods, meals and conversations changed after revision since, the ids of the ones deleted since,
+    and a token for next time. With since None it's everything (and no deletes), flagged "reset" so the client
+    replaces its copy.
+
+    Rows are read up to the user's data_version as of the first query, served by the (user, revision) indexes.
+    Every write bumps data_version and stamps its rows in one transaction, and the bump holds the user's profile
+    row locked until commit, so every row at or below that revision is already visible; anything written
+    meanwhile has a higher one and comes with the next sync.
+    """
+    user = request.user
+    current = UserProfile.objects.filter(user=user).values_list("data_version", flat=True).first() or 0
+    reset = since is None
+    # rows from before revisions existed are at 0
+    since = -1 if reset else since
+    # a replica can be behind the revision a client already has from the primary
+    upto = max(current, since)
+
+    response = {"reset": reset, "token": make_token(user.id, max(upto, 0))}
+    for kind, (model, get_queryset, serializer_class) in SYNC_KINDS.items():
+        rows = get_queryset(user).filter(revision__gt=since, revision__lte=upto).order_by("revision") \
+            if upto > since else model.objects.none()
+        response[kind] = serializer_class(rows, many=True, context={"request": request}).data
+
+    deleted = {kind: [] for kind in SYNC_KINDS}
+    if not reset and upto > since:
+        kinds = {model._meta.model_name: kind for kind, (model, get_queryset, serializer_class) in SYNC_KINDS.items()}
+        tombstones = Tombstone.objects.filter(user=user, revision__gt=since, revision__lte=upto) \
+            .values_list("kind", "object_id")
+        for model_name, object_id in tombstones:
+            deleted[kinds[model_name]].append(object_id)
+    response["deleted"] = deleted
+    return response
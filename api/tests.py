@@ -1,3 +1,1417 @@
-from django.test import TestCase
+import base64
+import csv
+import datetime
+import gzip
+import io
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import jwt
+from asgiref.sync import async_to_sync
+from cachetools import TTLCache
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import OperationalError, connection, connections
+from django.db.models import F
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from openai import OpenAIError
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework.utils.serializer_helpers import ReturnDict, ReturnList
+
+from api import apple_auth, authentication, cleanup, coalesce, db_routers, events, firebase_setup, food_import, \
+    image_storage, meal_cache, metrics
+from api.management.commands import profile_startup
+from api.models import CompletionRequest, Conversation, Food, IdempotencyKey, Meal, StoredImage, Tombstone, \
+    UserProfile, touch_user_data
+from api.openai_connect import OpenAIConnect
+from api.renderers import FastJSONRenderer
+from api.routing import websocket_urlpatterns
+from api.serializers import FoodSerializer
+
+
+def make_rsa_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+@override_settings(APPLE_CLIENT_ID="com.example.munch")
+class VerifyAppleTokenTests(TestCase):
+    """
+    Identity tokens are signed with a local key set standing in for Apple's published keys.
+    """
+
+    def setUp(self):
+        self.signing_key = make_rsa_key()
+        self.keys = {"local-kid": self.signing_key.public_key()}
+        apple_auth._keys_cache.clear()
+        fetch_patcher = mock.patch.object(apple_auth, "fetch_apple_keys", side_effect=lambda: dict(self.keys))
+        self.fetch_apple_keys = fetch_patcher.start()
+        self.addCleanup(fetch_patcher.stop)
+
+        self.user = User.objects.create(username="apple-user-id")
+        Token.objects.create(user=self.user)
+        self.client = APIClient()
+
+    def make_token(self, kid="local-kid", key=None, **claims):
+        payload = {
+            "iss": apple_auth.APPLE_ISSUER,
+            "aud": "com.example.munch",
+            "sub": "apple-user-id",
+            "iat": int(time.time()),
+            "exp": int(time.time()) + 600,
+        }
+        payload.update(claims)
+        return jwt.encode(payload, key or self.signing_key, algorithm="RS256", headers={"kid": kid})
+
+    def verify(self, identity_token, user_id="apple-user-id"):
+        return self.client.post("/api/verify-apple-token/", {"user_id": user_id, "identity_token": identity_token})
+
+    def test_valid_token_returns_auth_token(self):
+        response = self.verify(self.make_token())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["token"], self.user.auth_token.key)
+
+    def test_keys_are_fetched_once(self):
+        for _ in range(3):
+            self.assertEqual(self.verify(self.make_token()).status_code, 200)
+        self.assertEqual(self.fetch_apple_keys.call_count, 1)
+
+    def test_rejects_bad_tokens(self):
+        self.assertEqual(self.verify(self.make_token(key=make_rsa_key())).status_code, 401)
+        self.assertEqual(self.verify(self.make_token(aud="com.someone.else")).status_code, 401)
+        self.assertEqual(self.verify(self.make_token(iss="https://example.com")).status_code, 401)
+        self.assertEqual(self.verify(self.make_token(exp=int(time.time()) - 10)).status_code, 401)
+        self.assertEqual(self.verify(self.make_token(), user_id="someone-else").status_code, 401)
+
+    def test_unknown_kid_refetches_rotated_keys(self):
+        self.verify(self.make_token())
+        rotated_key = make_rsa_key()
+        self.keys = {"rotated-kid": rotated_key.public_key()}
+        with mock.patch.object(apple_auth, "_last_fetch", 0.0):
+            response = self.verify(self.make_token(kid="rotated-kid", key=rotated_key))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.fetch_apple_keys.call_count, 2)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        self.verify(self.make_token())
+        self.assertEqual(self.verify(self.make_token(kid="made-up-kid")).status_code, 401)
+        self.assertEqual(self.fetch_apple_keys.call_count, 1)
+
+
+class ReplicaRoutingTests(TestCase):
+    """
+    The replica is a separate, empty test database here, so reads that reach it see no rows.
+    """
+    # the runner only sets up the replica when it's configured; otherwise setUpClass adds the stand-in
+    databases = {'default', db_routers.REPLICA_DB} if db_routers.replica_configured() else {'default'}
+
+    @classmethod
+    def setUpClass(cls):
+        # without DATABASE_REPLICA_URL, a second in-memory database stands in for the replica while this class runs
+        # (connections.settings is settings.DATABASES, so replica_configured() sees it too)
+        cls.stand_in_replica = not db_routers.replica_configured()
+        if cls.stand_in_replica:
+            connections.settings[db_routers.REPLICA_DB] = connections.configure_settings({
+                **connections.settings, db_routers.REPLICA_DB: {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"},
+            })[db_routers.REPLICA_DB]
+            connections[db_routers.REPLICA_DB].creation.create_test_db(verbosity=0, serialize=False)
+            cls.databases = {'default', db_routers.REPLICA_DB}
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        if cls.stand_in_replica:
+            connections[db_routers.REPLICA_DB].close()
+            del connections[db_routers.REPLICA_DB]
+            del connections.settings[db_routers.REPLICA_DB]
+
+    def setUp(self):
+        cache.clear()
+        meal_cache.clear()
+        self.user = User.objects.create(username="replica-user")
+        self.food = Food.objects.create(user=self.user, name="toast", archived=True)
+        Meal.objects.create(user=self.user, meal_type="lunch", date="2024-05-12")
+        # the writes above happened long ago
+        UserProfile.objects.update(last_write_at=timezone.now() - timedelta(hours=1))
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_list_reads_go_to_replica(self):
+        # only the check for a recent write
+        with self.assertNumQueries(1, using='default'):
+            response = self.client.get("/api/meals/")
+        self.assertEqual(response.data, [])
+
+    def test_reads_stick_to_primary_after_a_write(self):
+        # any write, served by any worker: the marker is on the user's profile, not in a per-process cache
+        self.client.get(f"/api/save-food/{self.food.id}")
+        with self.assertNumQueries(0, using='replica'):
+            response = self.client.get("/api/meals/")
+        self.assertEqual(len(response.data), 1)
+
+        UserProfile.objects.update(last_write_at=timezone.now() - timedelta(seconds=settings.REPLICA_STICKY_SECONDS + 1))
+        self.assertEqual(self.client.get("/api/meals/").data, [])
+
+    def test_a_failed_request_doesnt_leave_reads_on_the_replica(self):
+        # not a uuid, so the lookup raises instead of returning an error response
+        with self.assertRaises(ValidationError):
+            self.client.get("/api/food/not-a-uuid/")
+        self.assertFalse(db_routers._use_replica.get())
+        with self.assertNumQueries(0, using='replica'):
+            self.client.get(f"/api/save-food/{self.food.id}")
+
+    def test_writes_and_unmarked_views_use_primary(self):
+        self.assertEqual(Meal.objects.count(), 1)
+        self.assertEqual(Meal.objects.using('replica').count(), 0)
+        with self.assertNumQueries(0, using='replica'):
+            self.client.get("/api/bootstrap/replica-user/")
+
+
+def seed_meals(user, meal_count: int, foods_per_meal: int = 3):
+    """
+    meal_count meals on consecutive days (cycling through meal types), each with foods_per_meal foods.
+    """
+    meal_types = ["breakfast", "lunch", "dinner", "snack"]
+    meals = []
+    for i in range(meal_count):
+        meal = Meal.objects.create(user=user, meal_type=meal_types[i % 4], date=f"2024-{1 + i // 112:02d}-{1 + (i // 4) % 28:02d}")
+        foods = [Food.objects.create(user=user, name=f"food {i}-{j}", calories_min=100, calories_max=120,
+                                     initial_description="a food") for j in range(foods_per_meal)]
+        meal.meal_items.add(*foods)
+        # kept on the meal so tests can reach them without running queries
+        meal.foods = foods
+        meals.append(meal)
+    return meals
+
+
+class QueryCountTests(TestCase):
+    """
+    Every endpoint in api/urls.py runs a bounded number of queries, however much data the user has.
+    Each bound is checked at several data sizes, so an N+1 fails here as soon as it comes back.
+    """
+    SIZES = [1, 10, 40]
+
+    def setUp(self):
+        cache.clear()
+        meal_cache.clear()
+        self.client = APIClient()
+
+    def make_user(self, meal_count: int):
+        user = User.objects.create(username=f"user-{meal_count}-{User.objects.count()}")
+        user.set_unusable_password()
+        user.save()
+        Token.objects.create(user=user)
+        meals = seed_meals(user, meal_count)
+        return user, meals
+
+    def assert_bounded(self, max_queries, request):
+        for size in self.SIZES:
+            with self.subTest(size=size):
+                user, meals = self.make_user(size)
+                self.client.force_authenticate(user)
+                with self.assertNumQueriesAtMost(max_queries):
+                    response = request(user, meals)
+                self.assertLess(response.status_code, 400, None if response.streaming else response.content)
+
+    def assertNumQueriesAtMost(self, max_queries):
+        test_case = self
+
+        class Context(CaptureQueriesContext):
+            def __exit__(self, exc_type, exc_value, traceback):
+                super().__exit__(exc_type, exc_value, traceback)
+                if exc_type is None:
+                    test_case.assertLessEqual(len(self), max_queries, "\n".join(q["sql"] for q in self.captured_queries))
+
+        return Context(connection)
+
+    def test_meals_list(self):
+        # cold: ETag, the user's days, data_version, then the meals and their foods (see MealCacheTests for the warm path)
+        self.assert_bounded(5, lambda user, meals: self.client.get("/api/meals/"))
+
+    def test_meal_totals(self):
+        self.assert_bounded(2, lambda user, meals: self.client.post("/api/meals/", {"meal_id": str(meals[-1].id)}))
+
+    def test_foods_list(self):
+        self.assert_bounded(2, lambda user, meals: self.client.get("/api/get-foods/"))
+
+    def test_foods_by_id(self):
+        self.assert_bounded(1, lambda user, meals: self.client.post(
+            "/api/get-foods/", {"ids": [str(food.id) for food in meals[0].foods]}, format="json"))
+
+    def test_food_details(self):
+        self.assert_bounded(1, lambda user, meals: self.client.get(f"/api/food/{meals[0].foods[0].id}/"))
+
+    def test_save_food(self):
+        self.assert_bounded(3, lambda user, meals: self.client.get(f"/api/save-food/{meals[0].foods[0].id}"))
+
+    def test_bootstrap(self):
+        self.assert_bounded(5, lambda user, meals: self.client.get(f"/api/bootstrap/{user.username}/?date={meals[0].date}"))
+
+    def test_user_exists(self):
+        self.assert_bounded(1, lambda user, meals: self.client.get(f"/api/user-exists/{user.username}/"))
+
+    def test_apple_user_token(self):
+        self.assert_bounded(1, lambda user, meals: self.client.get(f"/api/get-apple-user-token/{user.username}/"))
+
+    def test_log_food(self):
+        estimate = {"response": "looks like toast", "follow_up": "butter?", "name": "toast",
+                    "calories_min": 80, "calories_max": 100}
+        with mock.patch("api.openai_connect.OpenAIConnect") as openai_connect:
+            openai_connect.return_value.get_response.return_value = json.dumps(estimate)
+            openai_connect.return_value.image_url = None
+            self.assert_bounded(10, lambda user, meals: self.client.post("/api/log-food/", {
+                "description": "toast", "meal_type": meals[0].meal_type, "date": meals[0].date}, format="json"))
+
+    def test_register_apple(self):
+        self.assert_bounded(7, lambda user, meals: self.client.post("/api/register-apple/", {
+            "user_id": user.username + "-new", "email": "new@example.com"}))
+
+    def test_obtain_token(self):
+        password_user = User.objects.create_user(username="password-user", password="correct horse battery")
+        Token.objects.create(user=password_user)
+        # a fresh client, the endpoint has to check the password itself
+        self.assert_bounded(2, lambda user, meals: APIClient().post("/api/get-reg-user-token/", {
+            "username": "password-user", "password": "correct horse battery"}))
+
+    def test_verify_apple_token(self):
+        with mock.patch("api.views.verify_apple_identity_token"):
+            self.assert_bounded(1, lambda user, meals: self.client.post("/api/verify-apple-token/", {
+                "user_id": user.username, "identity_token": "token"}))
+
+    def test_search_foods(self):
+        self.assert_bounded(1, lambda user, meals: self.client.get("/api/search-foods/", {"q": "food"}))
+
+    def test_suggest_foods(self):
+        self.assert_bounded(1, lambda user, meals: self.client.get("/api/suggest-foods/", {"q": "fo"}))
+
+    def test_relog_food(self):
+        self.assert_bounded(13, lambda user, meals: self.client.post("/api/relog-food/", {
+            "food_id": meals[0].foods[0].id, "portion": 1.5, "meal_type": "dinner", "date": "2024-06-01"}))
+
+    def test_frequent_foods(self):
+        self.assert_bounded(1, lambda user, meals: self.client.get("/api/relog-food/"))
+
+    def test_export(self):
+        def export(user, meals):
+            response = self.client.get("/api/export/meals.ndjson")
+            # the queries only run as the body is streamed
+            b"".join(response.streaming_content)
+            return response
+        # one query for the meals and one for their foods, per EXPORT_CHUNK_SIZE meals
+        self.assert_bounded(2, export)
+
+    def test_sync(self):
+        # the data_version, then foods, meals and their foods, conversations (and tombstones after the first sync)
+        self.assert_bounded(5, lambda user, meals: self.client.get("/api/sync/"))
+
+    def test_import(self):
+        def import_foods(user, meals):
+            # a row for every existing meal and one new meal each, all in one batch
+            rows = [{"date": meal.date, "meal_type": meal.meal_type, "name": "toast", "description": "toast",
+                     "calories": 90} for meal in meals]
+            rows += [{"date": "2023-01-01", "meal_type": "breakfast", "name": "egg", "calories": 70}]
+            upload = SimpleUploadedFile("history.json", json.dumps(rows).encode())
+            return self.client.post("/api/import/", {"file": upload}, format="multipart")
+        # one batch; sqlite splits an insert of more than 37 foods in two, Postgres doesn't
+        self.assert_bounded(17, import_foods)
+
+    @override_settings(METRICS_TOKEN="metrics-token")
+    def test_metrics(self):
+        self.assert_bounded(0, lambda user, meals: self.client.get("/api/metrics/",
+                                                                  HTTP_AUTHORIZATION="Bearer metrics-token"))
+
+
+class TokenCacheTests(TestCase):
+    def setUp(self):
+        authentication.clear()
+        self.auth = authentication.CachedTokenAuthentication()
+        self.users = [User.objects.create(username=f"token-user-{i}") for i in range(2)]
+        self.tokens = [Token.objects.create(user=user) for user in self.users]
+
+    def authenticate(self, token):
+        return self.auth.authenticate_credentials(token.key)
+
+    def test_repeat_requests_skip_the_lookup(self):
+        self.assertEqual(self.authenticate(self.tokens[0])[0], self.users[0])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.authenticate(self.tokens[0]), (self.users[0], self.tokens[0]))
+
+    def test_entries_expire(self):
+        now = [0]
+        with mock.patch.object(authentication, "_token_cache", TTLCache(maxsize=10, ttl=300, timer=lambda: now[0])):
+            self.authenticate(self.tokens[0])
+            now[0] = 299
+            with self.assertNumQueries(0):
+                self.authenticate(self.tokens[0])
+            now[0] = 300
+            with self.assertNumQueries(1):
+                self.authenticate(self.tokens[0])
+
+    def test_deleted_tokens_and_saved_users_are_dropped(self):
+        for token in self.tokens:
+            self.authenticate(token)
+
+        self.tokens[0].delete()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(self.tokens[0])
+
+        self.users[1].is_active = False
+        self.users[1].save()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(self.tokens[1])
+
+    def test_a_user_save_only_drops_that_users_tokens(self):
+        for token in self.tokens:
+            self.authenticate(token)
+        self.users[0].save()
+        with self.assertNumQueries(0):
+            self.authenticate(self.tokens[1])
+        with self.assertNumQueries(1):
+            self.authenticate(self.tokens[0])
+
+    def test_user_index_stays_bounded(self):
+        users = [User.objects.create(username=f"many-{i}") for i in range(10)]
+        tokens = [Token.objects.create(user=user) for user in users]
+        with mock.patch.object(authentication, "_token_cache", TTLCache(maxsize=2, ttl=300)):
+            for token in tokens:
+                self.authenticate(token)
+            self.assertLessEqual(len(authentication._user_token_keys), 4)
+            # the index still finds what's cached
+            users[-1].save()
+            self.assertNotIn(tokens[-1].key, authentication._token_cache)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="export-user")
+        self.meals = seed_meals(self.user, 5, foods_per_meal=2)
+        other = User.objects.create(username="someone-else")
+        seed_meals(other, 2)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def export(self, path, **extra):
+        response = self.client.get("/api/export/" + path, **extra)
+        self.assertEqual(response.status_code, 200)
+        return response, b"".join(response.streaming_content)
+
+    def test_ndjson(self):
+        response, body = self.export("foods.ndjson")
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        foods = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual(len(foods), 10)
+        self.assertEqual({food["user"] for food in foods}, {self.user.id})
+
+    @override_settings(EXPORT_CHUNK_SIZE=2)
+    def test_csv_across_chunks(self):
+        response, body = self.export("meals.csv")
+        rows = list(csv.DictReader(io.StringIO(body.decode())))
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(float(rows[0]["total_min_calories"]), 200)
+        self.assertEqual(len(rows[0]["meal_items"].split(";")), 2)
+
+    def test_gzip(self):
+        response, body = self.export("conversations.ndjson", HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(body), b"")
+        response, body = self.export("foods.csv", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(len(gzip.decompress(body).decode().splitlines()), 11)
+
+    def test_unknown_export(self):
+        self.assertEqual(self.client.get("/api/export/users.csv").status_code, 404)
+        self.assertEqual(self.client.get("/api/export/foods.xml").status_code, 404)
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        meal_cache.clear()
+        self.user = User.objects.create(username="etag-user")
+        self.meals = seed_meals(self.user, 2)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def assert_current(self, url):
+        """
+        Returns the ETag after checking that sending it back gets a 304 without running the view.
+        """
+        etag = self.client.get(url)["ETag"]
+        # just the data_version lookup
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        self.assertEqual(response.content, b"")
+        return etag
+
+    def test_unchanged_lists_are_not_modified(self):
+        for url in ("/api/meals/", "/api/get-foods/"):
+            with self.subTest(url=url):
+                etag = self.assert_current(url)
+                self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='"stale", ' + etag).status_code, 304)
+                self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='"stale"').status_code, 200)
+
+    def test_etag_depends_on_the_user_and_url(self):
+        etag = self.assert_current("/api/get-foods/")
+        self.assertNotEqual(self.client.get("/api/get-foods/?image_size=small")["ETag"], etag)
+        self.client.force_authenticate(User.objects.create(username="someone-else"))
+        self.assertEqual(self.client.get("/api/get-foods/", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_writes_change_the_etag(self):
+        estimate = {"response": "looks like toast", "follow_up": "butter?", "name": "toast",
+                    "calories_min": 80, "calories_max": 100}
+        food = self.meals[0].foods[0]
+        Food.objects.filter(id=food.id).update(archived=True)
+        writes = {
+            "log-food": lambda: self.client.post("/api/log-food/", {
+                "description": "toast", "meal_type": "lunch", "date": "2024-05-12"}, format="json"),
+            "save-food": lambda: self.client.get(f"/api/save-food/{food.id}"),
+            "meal_items": lambda: self.meals[1].meal_items.remove(self.meals[1].foods[0]),
+        }
+        with mock.patch("api.openai_connect.OpenAIConnect") as openai_connect:
+            openai_connect.return_value.get_response.return_value = json.dumps(estimate)
+            openai_connect.return_value.image_url = None
+            for name, write in writes.items():
+                with self.subTest(write=name):
+                    etags = {url: self.assert_current(url) for url in ("/api/meals/", "/api/get-foods/")}
+                    response = write()
+                    self.assertLess(getattr(response, "status_code", 200), 400)
+                    for url, etag in etags.items():
+                        changed = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                        self.assertEqual(changed.status_code, 200)
+                        self.assertNotEqual(changed["ETag"], etag)
+
+
+class MealCacheTests(TestCase):
+    def setUp(self):
+        meal_cache.clear()
+        self.user = User.objects.create(username="cache-user")
+        self.user.set_unusable_password()
+        self.user.save()
+        Token.objects.create(user=self.user)
+        self.meals = seed_meals(self.user, 8, foods_per_meal=2)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def lookups(self, result):
+        return metrics.MEAL_CACHE_LOOKUPS.get((result,))
+
+    def test_repeat_reads_skip_the_meal_queries(self):
+        first = self.client.get("/api/meals/").json()
+        local_hits = self.lookups("local")
+        # ETag, the list of days and data_version
+        with self.assertNumQueries(3):
+            second = self.client.get("/api/meals/").json()
+        self.assertEqual(second, first)
+        self.assertEqual(self.lookups("local"), local_hits + 2)
+
+        url = f"/api/bootstrap/{self.user.username}/?date={self.meals[0].date}"
+        self.assertEqual(self.client.get(url).json()["meals"], [meal for meal in first if meal["date"] == self.meals[0].date])
+
+    def test_other_workers_are_served_from_the_shared_tier(self):
+        first = self.client.get("/api/meals/").json()
+        shared_hits = self.lookups("shared")
+        # a process that has never seen the user starts with an empty LRU
+        meal_cache._local.clear()
+        self.assertEqual(self.client.get("/api/meals/").json(), first)
+        self.assertEqual(self.lookups("shared"), shared_hits + 2)
+
+    def test_changes_are_seen(self):
+        self.client.get("/api/meals/")
+        first_day, second_day = self.meals[0], self.meals[4]
+
+        def totals():
+            meals = self.client.get("/api/meals/").json()
+            return {(meal["date"], meal["meal_type"]): meal["total_max_calories"] for meal in meals}
+
+        first_day.foods[0].calories_max = 500
+        first_day.foods[0].save()
+        self.assertEqual(totals()[(first_day.date, first_day.meal_type)], 620)
+
+        second_day.meal_items.remove(second_day.foods[0])
+        self.assertEqual(totals()[(second_day.date, second_day.meal_type)], 120)
+
+        Meal.add_food(self.user, second_day.foods[0], "other", second_day.date)
+        self.assertEqual(totals()[(second_day.date, "other")], 120)
+
+        second_day.foods[1].delete()
+        self.assertEqual(totals()[(second_day.date, second_day.meal_type)], 0)
+
+        first_day.delete()
+        self.assertNotIn((first_day.date, first_day.meal_type), totals())
+
+    def test_a_write_by_another_worker_is_never_served_stale(self):
+        first = self.client.get("/api/meals/")
+        day = self.meals[0].date
+        # another worker (with its own LocMem tiers) renames the meal: nothing here hears about it but data_version
+        Meal.objects.filter(id=self.meals[0].id).update(name="Renamed", revision=touch_user_data(self.user.id))
+        second = self.client.get("/api/meals/", HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(second.status_code, 200)
+        self.assertNotEqual(second["ETag"], first["ETag"])
+        self.assertIn("Renamed", [meal["name"] for meal in second.json() if meal["date"] == day])
+
+    @override_settings(METRICS_TOKEN="metrics-token")
+    def test_metrics(self):
+        self.client.get("/api/meals/")
+        self.client.get("/api/meals/")
+        body = self.client.get("/api/metrics/", HTTP_AUTHORIZATION="Bearer metrics-token").content.decode()
+        self.assertIn('api_meal_cache_lookups_total{result="local"}', body)
+        self.assertIn("api_meal_cache_hit_ratio ", body)
+        self.assertRegex(body, r"api_meal_cache_local_bytes [1-9]")
+
+
+class SyncTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="sync-user")
+        self.meals = seed_meals(self.user, 3, foods_per_meal=2)
+        self.conversation = Conversation.objects.create(meal=self.meals[0], text="How big was it?", sender="bot")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def sync(self, token=None):
+        response = self.client.get("/api/sync/", {"since": token} if token else {})
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def ids(self, rows):
+        return {row.get("id") or row.get("record_id") for row in rows}
+
+    def test_first_sync_is_everything(self):
+        data = self.sync()
+        self.assertTrue(data["reset"])
+        self.assertEqual(len(data["foods"]), 6)
+        self.assertEqual(self.ids(data["meals"]), {str(meal.id) for meal in self.meals})
+        self.assertEqual(self.ids(data["conversations"]), {str(self.conversation.record_id)})
+        self.assertEqual(self.conversation.user_id, self.user.id)
+
+    def test_later_syncs_only_send_changes(self):
+        token = self.sync()["token"]
+        with self.assertNumQueries(1):
+            unchanged = self.sync(token)
+        self.assertEqual((unchanged["foods"], unchanged["meals"], unchanged["conversations"]), ([], [], []))
+        self.assertFalse(unchanged["reset"])
+
+        changed_food = self.meals[1].foods[0]
+        changed_food.calories_max = 400
+        changed_food.save()
+        removed_food_id, removed_meal_id = str(self.meals[2].foods[0].id), str(self.meals[0].id)
+        self.meals[2].foods[0].delete()
+        self.meals[0].delete()
+
+        data = self.sync(unchanged["token"])
+        self.assertFalse(data["reset"])
+        self.assertEqual(self.ids(data["foods"]), {str(changed_food.id)})
+        # the meals whose totals or meal_items changed
+        self.assertEqual(self.ids(data["meals"]), {str(self.meals[1].id), str(self.meals[2].id)})
+        self.assertEqual(data["deleted"], {"foods": [removed_food_id], "meals": [removed_meal_id],
+                                           "conversations": [str(self.conversation.record_id)]})
+
+        Meal.add_food(self.user, changed_food, "snack", "2024-06-01")
+        data = self.sync(data["token"])
+        self.assertEqual([meal["date"] for meal in data["meals"]], ["2024-06-01"])
+        self.assertEqual(data["deleted"], {"foods": [], "meals": [], "conversations": []})
+
+    def test_bad_tokens_start_over(self):
+        token = self.sync()["token"]
+        someone_else = User.objects.create(username="someone-else")
+        self.client.force_authenticate(someone_else)
+        self.assertTrue(self.sync(token)["reset"])
+        self.client.force_authenticate(self.user)
+        self.assertTrue(self.sync(token + "x")["reset"])
+        # older than the tombstones are kept
+        with mock.patch("time.time", return_value=time.time() + 91 * 24 * 60 * 60):
+            self.assertTrue(self.sync(token)["reset"])
+        self.assertFalse(self.sync(token)["reset"])
+
+    def test_tombstones_are_pruned_and_skipped_for_deleted_accounts(self):
+        self.meals[0].delete()
+        Tombstone.objects.update(deleted_at=timezone.now() - timedelta(days=100))
+        self.meals[1].delete()
+        self.assertEqual(cleanup.delete_old_tombstones(timedelta(days=90)), 2)
+        self.assertEqual(Tombstone.objects.count(), 1)
+
+        self.user.delete()
+        self.assertFalse(Tombstone.objects.exists())
+
+
+class RelogFoodTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="relog-user")
+        self.oatmeal = Food.objects.create(user=self.user, name="Oatmeal", initial_description="oatmeal with berries",
+                                           calories_min=200, calories_max=250, protein_min=6, protein_max=8)
+        self.coffee = Food.objects.create(user=self.user, name="Coffee", initial_description="black coffee",
+                                          calories_min=2, calories_max=5)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def relog(self, food, **data):
+        return self.client.post("/api/relog-food/", {"food_id": food.id, "meal_type": "breakfast",
+                                                     "date": "2024-06-01", **data})
+
+    def test_relog_scales_the_copy_without_calling_the_model(self):
+        with mock.patch("api.openai_connect.OpenAIConnect") as openai_connect:
+            response = self.relog(self.oatmeal, portion=1.5)
+        openai_connect.assert_not_called()
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.data["calories_min"], 300)
+        self.assertEqual(response.data["protein_max"], 12)
+
+        meal = Meal.objects.get(user=self.user, meal_type="breakfast", date="2024-06-01")
+        self.assertEqual([str(food.id) for food in meal.meal_items.all()], [response.data["id"]])
+        self.assertEqual(meal.description, "oatmeal with berries")
+        self.oatmeal.refresh_from_db()
+        self.assertEqual(self.oatmeal.times_logged, 2)
+        self.assertEqual(self.oatmeal.calories_min, 200)
+
+    def test_relog_of_a_relog_counts_for_the_original(self):
+        copy = Food.objects.get(id=self.relog(self.coffee).data["id"])
+        self.relog(copy, portion=2, date="2024-06-02")
+        self.relog(copy, date="2024-06-03")
+        self.coffee.refresh_from_db()
+        self.assertEqual(self.coffee.times_logged, 4)
+        self.assertEqual(Food.objects.filter(logged_from=self.coffee).count(), 3)
+
+        frequent = self.client.get("/api/relog-food/").data
+        self.assertEqual([food["name"] for food in frequent], ["Coffee", "Oatmeal"])
+
+    def test_relog_rejects_bad_input(self):
+        someone_else = User.objects.create(username="someone-else")
+        their_food = Food.objects.create(user=someone_else, name="Toast")
+        self.assertEqual(self.relog(their_food).status_code, 404)
+        self.assertEqual(self.relog(self.coffee, portion=0).status_code, 400)
+        self.assertEqual(self.relog(self.coffee, meal_type="brunch").status_code, 400)
+        self.assertEqual(self.relog(self.coffee, date="June 1st").status_code, 400)
+        for food_id in ["not-a-uuid", "1234", str(self.coffee.id) + "0"]:
+            with self.subTest(food_id=food_id):
+                response = self.client.post("/api/relog-food/", {"food_id": food_id, "meal_type": "breakfast",
+                                                                 "date": "2024-06-01"})
+                self.assertEqual(response.status_code, 400)
+        self.assertFalse(Meal.objects.exists())
+
+
+class IdempotencyTests(TestCase):
+    ESTIMATE = {"response": "looks like toast", "follow_up": "butter?", "name": "toast",
+                "calories_min": 80, "calories_max": 100}
+
+    def setUp(self):
+        self.user = User.objects.create(username="retrying-user")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        patcher = mock.patch("api.openai_connect.OpenAIConnect")
+        self.openai_connect = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.openai_connect.return_value.get_response.return_value = json.dumps(self.ESTIMATE)
+        self.openai_connect.return_value.image_url = None
+
+    def log_food(self, key="key-1", description="toast"):
+        return self.client.post("/api/log-food/", {"description": description, "meal_type": "breakfast",
+                                                   "date": "2024-06-01"}, format="json", HTTP_IDEMPOTENCY_KEY=key)
+
+    @property
+    def model_calls(self):
+        return self.openai_connect.return_value.get_response.call_count
+
+    def test_retry_gets_the_stored_response(self):
+        first = self.log_food()
+        retry = self.log_food()
+        self.assertEqual(first.status_code, 200, first.content)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertEqual(retry.data["id"], str(first.data["id"]))
+        self.assertEqual(self.model_calls, 1)
+        self.assertEqual(Food.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(Meal.objects.get(user=self.user).meal_items.count(), 1)
+
+        # without a key (or with a new one) it's a new request
+        self.log_food(key="key-2")
+        self.client.post("/api/log-food/", {"description": "toast", "meal_type": "breakfast", "date": "2024-06-01"},
+                         format="json")
+        self.assertEqual(self.model_calls, 3)
+
+    def test_key_cannot_be_reused_for_another_request(self):
+        self.log_food()
+        response = self.log_food(description="jam on toast")
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(self.model_calls, 1)
+
+    def test_retry_waits_for_the_original(self):
+        self.log_food()
+        IdempotencyKey.objects.update(status="running")
+
+        def original_finishes(seconds):
+            IdempotencyKey.objects.update(status="completed")
+
+        with mock.patch("api.idempotency.time.sleep", side_effect=original_finishes) as sleep:
+            retry = self.log_food()
+        sleep.assert_called_once()
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertEqual(self.model_calls, 1)
+
+    @override_settings(IDEMPOTENCY_WAIT_SECONDS=0)
+    def test_retry_of_a_running_request_conflicts_after_waiting(self):
+        self.log_food()
+        IdempotencyKey.objects.update(status="running")
+        self.assertEqual(self.log_food().status_code, 409)
+        self.assertEqual(self.model_calls, 1)
+
+    def test_stale_and_failed_requests_run_again(self):
+        self.log_food()
+        # the worker running it died
+        IdempotencyKey.objects.update(status="running", updated_at=timezone.now() - timedelta(hours=1))
+        response = self.log_food()
+        self.assertNotIn("Idempotent-Replayed", response)
+        self.assertEqual(self.model_calls, 2)
+
+        self.openai_connect.return_value.get_response.side_effect = RuntimeError("model unavailable")
+        with self.assertRaises(RuntimeError):
+            self.log_food(key="key-2")
+        self.assertFalse(IdempotencyKey.objects.filter(key="key-2").exists())
+
+    def test_expired_keys_are_cleaned_up(self):
+        self.log_food()
+        IdempotencyKey.objects.update(created_at=timezone.now() - timedelta(days=2))
+        self.assertEqual(cleanup.delete_expired_idempotency_keys(timedelta(hours=24)), 1)
+        self.assertEqual(self.log_food().status_code, 200)
+        self.assertEqual(self.model_calls, 2)
+
+
+class AddFoodToMealTests(TransactionTestCase):
+    """
+    Real transactions and threads: every writer logs into the same (meal_type, date, user) meal at once.
+    """
+    WRITERS = 8
+
+    def setUp(self):
+        self.user = User.objects.create(username="busy-user")
+
+    def test_parallel_writers_share_one_meal(self):
+        foods = [Food.objects.create(user=self.user, name=f"bite {i}", initial_description=f"bite{i}")
+                 for i in range(self.WRITERS)]
+        barrier = threading.Barrier(self.WRITERS)
+        errors = []
+
+        def log(food):
+            try:
+                barrier.wait()
+                for attempt in range(50):
+                    try:
+                        Meal.add_food(self.user, food, "lunch", "2024-05-12")
+                        return
+                    except OperationalError:
+                        # sqlite allows one writer at a time ("database is locked"); Postgres just waits
+                        time.sleep(0.01)
+                raise AssertionError("could not get the database lock")
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=log, args=(food,)) for food in foods]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        meal = Meal.objects.get(user=self.user, meal_type="lunch", date="2024-05-12")
+        self.assertEqual(meal.meal_items.count(), self.WRITERS)
+        # every description made it in exactly once, in whatever order the writers committed
+        self.assertEqual(sorted(meal.description.split(" ")), sorted(f"bite{i}" for i in range(self.WRITERS)))
+
+    def test_existing_meal_keeps_its_name_unless_given_one(self):
+        food = Food.objects.create(user=self.user, name="toast", initial_description="toast")
+        Meal.objects.create(user=self.user, meal_type="breakfast", date="2024-05-12", name="Brunch", description="")
+        meal = Meal.add_food(self.user, food, "breakfast", "2024-05-12")
+        self.assertEqual((meal.name, meal.description), ("Brunch", "toast"))
+        meal = Meal.add_food(self.user, food, "breakfast", "2024-05-12", "Late breakfast")
+        self.assertEqual((meal.name, meal.description), ("Late breakfast", "toast toast"))
+        self.assertEqual(meal.meal_items.count(), 1)
+
+
+class CoalesceTests(TransactionTestCase):
+    """
+    Identical OpenAI requests in flight at the same time, from threads of this process or from other workers
+    (simulated with CompletionRequest rows).
+    """
+    CALLERS = 8
+
+    def coalesced_count(self, source):
+        return metrics.OPENAI_CALLS_COALESCED.get((source,))
+
+    def test_concurrent_identical_requests_share_one_call(self):
+        def slow_create(**kwargs):
+            # long enough for every caller to arrive while it's in flight
+            time.sleep(0.3)
+            return mock.Mock(choices=[mock.Mock(message=mock.Mock(content='{"name": "pasta"}'))])
+
+        with mock.patch("api.openai_connect.OpenAI") as openai:
+            create = openai.return_value.chat.completions.create
+            create.side_effect = slow_create
+            from api.openai_connect import OpenAIConnect
+            barrier = threading.Barrier(self.CALLERS)
+            results, errors = [], []
+            coalesced_before = self.coalesced_count("local")
+
+            def log_special():
+                try:
+                    barrier.wait()
+                    results.append(OpenAIConnect(system_prompt="estimate").get_response("pasta special"))
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    connection.close()
+
+            threads = [threading.Thread(target=log_special) for _ in range(self.CALLERS)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(errors, [])
+            self.assertEqual(len(results), self.CALLERS)
+            self.assertEqual(len(set(results)), 1)
+            # calls saved: every caller but one
+            self.assertEqual(create.call_count, 1)
+            self.assertEqual(self.coalesced_count("local") - coalesced_before, self.CALLERS - 1)
+
+            # a different prompt is a different call
+            OpenAIConnect(system_prompt="estimate").get_response("soup of the day")
+            self.assertEqual(create.call_count, 2)
+
+    def test_waits_for_another_workers_call(self):
+        CompletionRequest.objects.create(fingerprint="special")
+        call = mock.Mock(return_value="own answer")
+        coalesced_before = self.coalesced_count("shared")
+
+        def other_worker_finishes(seconds):
+            CompletionRequest.objects.update(response="their answer", updated_at=timezone.now())
+
+        with mock.patch("api.coalesce.time.sleep", side_effect=other_worker_finishes) as sleep:
+            self.assertEqual(coalesce.coalesced("special", call), "their answer")
+        sleep.assert_called_once()
+        call.assert_not_called()
+        self.assertEqual(self.coalesced_count("shared") - coalesced_before, 1)
+
+        # just finished: shared without waiting, until OPENAI_COALESCE_RESULT_SECONDS have passed
+        self.assertEqual(coalesce.coalesced("special", call), "their answer")
+        CompletionRequest.objects.update(updated_at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(coalesce.coalesced("special", call), "own answer")
+        self.assertEqual(call.call_count, 1)
+
+    def test_dead_and_failed_calls_are_made_again(self):
+        # the worker making it died long ago
+        CompletionRequest.objects.create(fingerprint="special")
+        CompletionRequest.objects.update(updated_at=timezone.now() - timedelta(minutes=5))
+        call = mock.Mock(return_value="answer")
+        self.assertEqual(coalesce.coalesced("special", call), "answer")
+        self.assertEqual(CompletionRequest.objects.get().response, "answer")
+
+        failing = mock.Mock(side_effect=RuntimeError("model unavailable"))
+        with self.assertRaises(RuntimeError):
+            coalesce.coalesced("soup", failing)
+        self.assertFalse(CompletionRequest.objects.filter(fingerprint="soup").exists())
+
+
+class CleanupTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="cleanup-user")
+        self.meal = Meal.objects.create(user=self.user, meal_type="lunch", date="2024-05-12")
+        long_ago = timezone.now() - timedelta(days=40)
+        self.abandoned = [Food.objects.create(user=self.user, name=f"estimate {i}", archived=True, created_at=long_ago)
+                          for i in range(5)]
+        self.recent = Food.objects.create(user=self.user, name="still deciding", archived=True)
+        self.kept = Food.objects.create(user=self.user, name="kept", archived=False, created_at=long_ago)
+        self.meal.meal_items.add(self.abandoned[0], self.kept)
+
+    def test_deletes_abandoned_foods_in_batches(self):
+        batches = []
+        deleted = cleanup.delete_abandoned_foods(timedelta(days=30), batch_size=2, on_batch=batches.append)
+        self.assertEqual(deleted, 5)
+        self.assertEqual(batches, [2, 2, 1])
+        self.assertEqual(set(Food.objects.values_list("name", flat=True)), {"still deciding", "kept"})
+        self.assertEqual(list(self.meal.meal_items.all()), [self.kept])
+
+    def test_releases_stored_images(self):
+        url = "https://storage.googleapis.com/bucket/abc.png"
+        StoredImage.objects.create(content_hash="abc", filename="abc.png", url=url, reference_count=0,
+                                   variants={"small": url})
+        Food.objects.filter(id__in=[self.abandoned[0].id, self.abandoned[1].id]).update(image_url=url)
+        StoredImage.objects.filter(url=url).update(reference_count=2)
+
+        with mock.patch("api.image_storage.delete_image_from_firebase") as delete_blob, \
+                self.captureOnCommitCallbacks(execute=True):
+            cleanup.delete_abandoned_foods(timedelta(days=30), batch_size=10)
+        self.assertFalse(StoredImage.objects.exists())
+        self.assertEqual(sorted(call.args[0] for call in delete_blob.call_args_list), ["abc.png", "abc_small.webp"])
+
+
+class ImageStorageTests(TestCase):
+    """
+    Firebase is mocked out; StoredImage rows are the index of what's in the bucket.
+    """
+    PHOTO = b"\x89PNG pretend photo"
+
+    def setUp(self):
+        self.user = User.objects.create(username="photo-user")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.uploads = []
+        self.deleted = []
+        for target, side_effect in [
+            ("upload_image_to_firebase",
+             lambda image_file, filename, content_type=None: self.uploads.append(filename) or f"https://storage.example.com/{filename}"),
+            ("image_exists_in_firebase", lambda filename: filename in self.uploads),
+            ("delete_image_from_firebase", self.deleted.append),
+            # variants are covered separately
+            ("run_in_background", lambda *args, **kwargs: None),
+        ]:
+            patcher = mock.patch(f"api.image_storage.{target}", side_effect=side_effect)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def store(self, content=PHOTO):
+        return image_storage.store_image(io.BytesIO(content))
+
+    def test_identical_images_are_stored_once_and_counted(self):
+        first, second = self.store(), self.store()
+        self.assertEqual(first.url, second.url)
+        self.assertEqual(len(self.uploads), 1)
+        self.assertEqual(StoredImage.objects.get().reference_count, 2)
+        self.assertNotEqual(self.store(b"another photo").url, first.url)
+
+    def test_last_release_deletes_the_image_after_commit(self):
+        stored_image = self.store()
+        Food.objects.create(user=self.user, name="toast", image_url=stored_image.url)
+        image_storage.release_image(stored_image.url)
+        self.assertEqual(StoredImage.objects.get().reference_count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Food.objects.get().delete()
+        self.assertFalse(StoredImage.objects.exists())
+        self.assertEqual(self.deleted, [stored_image.filename])
+
+    def test_a_reference_taken_before_the_delete_keeps_the_image(self):
+        url = self.store().url
+        with self.captureOnCommitCallbacks(execute=True):
+            image_storage.release_image(url)
+            # the same photo comes in again before the delete runs
+            self.store()
+        self.assertEqual(StoredImage.objects.get().reference_count, 1)
+        self.assertEqual(self.deleted, [])
+
+        # a worker that died before its delete ran leaves the row at zero
+        StoredImage.objects.update(reference_count=0)
+        self.assertEqual(cleanup.delete_unreferenced_images(), 1)
+        self.assertFalse(StoredImage.objects.exists())
+
+    def test_variants_are_made_in_each_size_and_format(self):
+        from PIL import Image
+
+        original = io.BytesIO()
+        Image.new("RGBA", (2000, 1000), (200, 100, 50, 128)).save(original, "PNG")
+        stored_image = self.store(original.getvalue())
+        food = Food.objects.create(user=self.user, name="toast", image_url=stored_image.url)
+        blobs = {}
+
+        def upload(image_file, filename, content_type=None):
+            blobs[filename] = (Image.open(io.BytesIO(image_file.getvalue())), content_type)
+            return f"https://storage.example.com/{filename}"
+
+        with mock.patch("api.image_storage.download_image_from_firebase",
+                        side_effect=lambda filename, destination: destination.write(original.getvalue())), \
+                mock.patch("api.image_storage.upload_image_to_firebase", side_effect=upload):
+            variants = image_storage.generate_image_variants(stored_image.content_hash)
+
+        self.assertEqual(set(variants), {"small", "medium", "large", "small_jpeg", "medium_jpeg", "large_jpeg"})
+        for name, url in variants.items():
+            image, content_type = blobs[url.rsplit("/", 1)[1]]
+            longest_edge = image_storage.IMAGE_VARIANT_SIZES[name.partition("_")[0]]
+            self.assertEqual(image.size, (longest_edge, longest_edge // 2))
+            self.assertEqual((image.format, content_type), ("JPEG", "image/jpeg") if name.endswith("_jpeg")
+                             else ("WEBP", "image/webp"))
+        self.assertEqual(StoredImage.objects.get().variants, variants)
+        food.refresh_from_db()
+        self.assertEqual(food.image_variants, variants)
+
+        # the blobs go with the image
+        self.assertEqual(sorted(image_storage.image_filenames(StoredImage.objects.get())),
+                         sorted([stored_image.filename, *blobs]))
+
+    def test_lists_pick_the_variant_asked_for(self):
+        variants = {"small": "https://storage.example.com/x_small.webp",
+                    "small_jpeg": "https://storage.example.com/x_small_jpeg.jpeg"}
+        Food.objects.create(user=self.user, name="toast", image_url="https://storage.example.com/x.png",
+                            image_variants=variants)
+
+        def display_url(query=""):
+            return self.client.get("/api/get-foods/" + query).json()[0]["display_image_url"]
+
+        self.assertEqual(display_url(), "https://storage.example.com/x.png")
+        self.assertEqual(display_url("?image_size=small"), variants["small"])
+        self.assertEqual(display_url("?image_size=small&image_format=jpeg"), variants["small_jpeg"])
+        self.assertEqual(display_url("?image_size=small&image_format=gif"), variants["small"])
+        # not made yet
+        self.assertEqual(display_url("?image_size=large"), "https://storage.example.com/x.png")
+
+    def test_clients_cant_set_variants(self):
+        serializer = FoodSerializer(data={"user": self.user.id, "name": "toast",
+                                          "image_variants": {"small": "https://example.com/evil.webp"}})
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        self.assertNotIn("image_variants", serializer.validated_data)
+
+    def log_food(self, create):
+        with mock.patch("api.openai_connect.OpenAI") as openai:
+            openai.return_value.chat.completions.create.side_effect = create
+            return self.client.post("/api/log-food/", {
+                "description": "toast", "meal_type": "breakfast", "date": "2024-06-01",
+                "image": SimpleUploadedFile("toast.png", self.PHOTO, content_type="image/png")}, format="multipart")
+
+    def test_log_food_hands_its_reference_to_the_food(self):
+        estimate = {"response": "toast", "follow_up": "butter?", "name": "toast", "calories_min": 80}
+        response = self.log_food(lambda **kwargs: mock.Mock(
+            choices=[mock.Mock(message=mock.Mock(content=json.dumps(estimate)))]))
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(StoredImage.objects.get().reference_count, 1)
+        self.assertEqual(Food.objects.get().image_url, StoredImage.objects.get().url)
+
+    def test_log_food_streams_the_upload_to_disk(self):
+        estimate = {"response": "toast", "follow_up": "butter?", "name": "toast", "calories_min": 80}
+        with mock.patch("api.openai_connect.store_image", wraps=image_storage.store_image) as store_image:
+            response = self.log_food(lambda **kwargs: mock.Mock(
+                choices=[mock.Mock(message=mock.Mock(content=json.dumps(estimate)))]))
+        self.assertEqual(response.status_code, 200, response.content)
+        # Django's default handlers would keep a photo this small in memory
+        self.assertIsInstance(store_image.call_args.args[0], TemporaryUploadedFile)
+
+    def test_oversized_uploads_are_rejected(self):
+        create = mock.Mock()
+        # caught on the Content-Length, then as the chunks arrive (the limit leaves room for the form fields)
+        for max_size, photo in [(1024, self.PHOTO * 10000), (8, self.PHOTO)]:
+            with self.subTest(max_size=max_size), override_settings(MAX_IMAGE_UPLOAD_SIZE=max_size), \
+                    mock.patch.object(self, "PHOTO", photo):
+                response = self.log_food(create)
+                self.assertEqual(response.status_code, 413, response.content)
+        create.assert_not_called()
+        self.assertEqual(self.uploads, [])
+
+    def test_failed_log_food_releases_the_upload(self):
+        with self.captureOnCommitCallbacks(execute=True), self.assertRaises(ValueError):
+            self.log_food(mock.Mock(side_effect=OpenAIError("model unavailable")))
+        self.assertFalse(StoredImage.objects.exists())
+        self.assertEqual(len(self.deleted), 1)
+
+
+class MealUpdatesConsumerTests(TestCase):
+    """
+    Runs the consumer in the test's event loop; the sync parts (token lookup, the write) run on the test's thread,
+    so they see its transaction.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username="socket-user")
+        self.token = Token.objects.create(user=self.user)
+        self.food = Food.objects.create(user=self.user, name="toast", calories_max=100)
+
+    def connect(self, key=None):
+        headers = [(b"authorization", f"Token {key}".encode())] if key else []
+        return WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/meals/", headers=headers)
+
+    def write(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            meal = Meal.add_food(self.user, self.food, "lunch", "2024-05-12")
+            events.food_changed(self.food, meal)
+        return meal
+
+    def test_devices_hear_about_their_users_changes(self):
+        other_user = User.objects.create(username="someone-else")
+        other_token = Token.objects.create(user=other_user)
+
+        async def scenario():
+            device = self.connect(self.token.key)
+            other_device = self.connect(other_token.key)
+            self.assertTrue((await device.connect())[0])
+            self.assertTrue((await other_device.connect())[0])
+
+            meal = await database_sync_to_async(self.write)()
+            food_event = await device.receive_json_from(timeout=1)
+            meal_event = await device.receive_json_from(timeout=1)
+            self.assertTrue(await other_device.receive_nothing())
+            await device.disconnect()
+            await other_device.disconnect()
+            return meal, food_event, meal_event
+
+        meal, food_event, meal_event = async_to_sync(scenario)()
+        self.assertEqual((food_event["type"], food_event["food"]["id"]), ("food.changed", str(self.food.id)))
+        self.assertEqual(meal_event, {"type": "meal.changed", "meal": {
+            "id": str(meal.id), "date": "2024-05-12", "meal_type": "lunch", "revision": meal.revision}})
+
+    def test_needs_a_token(self):
+        async def scenario():
+            results = []
+            for key in (None, "not-a-token"):
+                communicator = self.connect(key)
+                results.append(await communicator.connect())
+                await communicator.disconnect()
+            return results
+
+        self.assertEqual(async_to_sync(scenario)(), [(False, 4401), (False, 4401)])
+
+
+class SearchFoodsTests(TestCase):
+    """
+    Runs the SQLite fallback; the Postgres full-text path is exercised against a real database.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username="search-user")
+        for i in range(25):
+            Food.objects.create(user=self.user, name=f"Chicken dish {i:02d}", initial_description="grilled")
+        Food.objects.create(user=self.user, name="Rice bowl", initial_description="rice with chicken")
+        Food.objects.create(user=self.user, name="Chicken soup", archived=True)
+        Food.objects.create(user=User.objects.create(username="someone-else"), name="Chicken wrap")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_search_is_paginated(self):
+        first = self.client.get("/api/search-foods/", {"q": "chicken"}).data
+        second = self.client.get("/api/search-foods/", {"q": "chicken", "page": 2}).data
+        self.assertEqual(len(first["results"]), 20)
+        self.assertTrue(first["has_next"])
+        self.assertEqual(len(second["results"]), 6)
+        self.assertFalse(second["has_next"])
+        names = [food["name"] for food in first["results"] + second["results"]]
+        self.assertIn("Rice bowl", names)
+        self.assertNotIn("Chicken soup", names)
+        self.assertNotIn("Chicken wrap", names)
+        self.assertNotIn("search_vector", first["results"][0])
+
+    def test_search_needs_a_query(self):
+        self.assertEqual(self.client.get("/api/search-foods/").status_code, 400)
+
+    def test_suggest(self):
+        names = self.client.get("/api/suggest-foods/", {"q": "chick"}).data["names"]
+        self.assertEqual(names, [f"Chicken dish {i:02d}" for i in range(10)])
+
+
+class GenerateDatasetTests(TestCase):
+    def test_generates_every_kind_of_row(self):
+        # every meal gets a conversation and a snack, so each model's bulk write runs
+        call_command("generate_dataset", users=2, days=2, snack_rate=1, conversation_rate=1, stdout=io.StringIO())
+        self.assertEqual(User.objects.filter(username__startswith="synthetic-").count(), 2)
+        self.assertEqual(UserProfile.objects.count(), 2)
+        self.assertEqual(Meal.objects.count(), 2 * 2 * 4)
+        self.assertEqual(Conversation.objects.count(), 2 * Meal.objects.count())
+        self.assertFalse(Conversation.objects.exclude(user_id=F("meal__user_id")).exists())
+        self.assertFalse(Meal.objects.filter(meal_items__isnull=True).exists())
+
+
+class ImportFoodsTests(TestCase):
+    CSV = (b"date,meal_type,name,description,calories,protein_min,protein_max\n"
+           b"2024-05-12,Lunch,burrito,chicken burrito,650,30,35\n"
+           # unpadded, still the same day's lunch
+           b"2024-5-12,lunch,chips,tortilla chips,200,,\n"
+           b"2024-05-13,brunch,waffle,,300,,\n"
+           b"2024-05-13,dinner,,,,,\n"
+           b"2024-05-13,dinner,pasta,pasta,abc,,\n"
+           b"2024-05-14,dinner,soup,tomato soup,180,5,4\n"
+           b"2024-05-14,snack,apple,an apple,95,0,1\n")
+
+    def setUp(self):
+        self.user = User.objects.create(username="import-user")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def post(self, content, name="history.csv"):
+        return self.client.post("/api/import/", {"file": SimpleUploadedFile(name, content)}, format="multipart")
+
+    def test_csv_import(self):
+        existing = Meal.objects.create(user=self.user, meal_type="lunch", date="2024-05-12", description="salad")
+        version = self.user.userprofile.data_version
+
+        response = self.post(self.CSV)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.data["status"], "completed")
+        self.assertEqual(response.data["rows_done"], 7)
+        self.assertEqual(response.data["foods_created"], 3)
+        self.assertEqual(response.data["meals_created"], 1)
+        self.assertEqual([error["row"] for error in response.data["errors"]], [3, 4, 5, 6])
+
+        existing.refresh_from_db()
+        self.assertEqual(existing.description, "salad chicken burrito tortilla chips")
+        self.assertEqual(set(Meal.objects.values_list("date", flat=True)), {"2024-05-12", "2024-05-14"})
+        self.assertEqual(existing.total_min_calories, 850)
+        self.assertEqual(existing.total_max_protein, 35)
+        self.assertEqual(Meal.objects.get(user=self.user, meal_type="snack").total_max_protein, 1)
+        self.user.userprofile.refresh_from_db()
+        self.assertGreater(self.user.userprofile.data_version, version)
+
+        progress = self.client.get(f"/api/import/{response.data['id']}/")
+        self.assertEqual(progress.data["foods_created"], 3)
+
+    @override_settings(IMPORT_BATCH_SIZE=2)
+    def test_resumes_from_checkpoint(self):
+        rows = "\n".join(json.dumps({"date": f"2024-06-{day:02d}", "meal_type": "dinner", "name": f"dinner {day}",
+                                     "calories": 500}) for day in range(1, 8)).encode()
+        real_import_batch = food_import.import_batch
+        calls = []
+
+        def flaky_import_batch(job, batch):
+            calls.append(batch)
+            if len(calls) == 3:
+                raise ValueError("connection lost")
+            real_import_batch(job, batch)
+
+        with mock.patch.object(food_import, "import_batch", flaky_import_batch):
+            self.assertEqual(self.post(rows, "history.ndjson").status_code, 400)
+        self.assertEqual(Food.objects.filter(user=self.user).count(), 4)
+
+        response = self.post(rows, "history.ndjson")
+        self.assertEqual(response.data["status"], "completed")
+        self.assertEqual(response.data["rows_done"], 7)
+        self.assertEqual(Food.objects.filter(user=self.user).count(), 7)
+        self.assertEqual(Meal.objects.filter(user=self.user).count(), 7)
+
+        # a finished file is not imported twice
+        self.post(rows, "history.ndjson")
+        self.assertEqual(Food.objects.filter(user=self.user).count(), 7)
+
+    def test_unreadable_file(self):
+        self.assertEqual(self.post(b'{"date": "2024-05-12"}', "history.json").status_code, 400)
+        self.assertEqual(self.post(b"date,meal_type\n\xff\xfe", "history.csv").status_code, 400)
+
+
+class FastJSONRendererTests(SimpleTestCase):
+    def assert_same_as_drf(self, data):
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+    def test_output_matches_drf(self):
+        utc = datetime.timezone.utc
+        cases = {
+            "serializer output": ReturnDict({"id": uuid.uuid4(), "meals": ReturnList([{"n": 1.5}], serializer=None)},
+                                            serializer=None),
+            "utc datetime": datetime.datetime(2024, 5, 12, 8, 30, 15, 123456, tzinfo=utc),
+            "whole second": datetime.datetime(2024, 5, 12, 8, 30, tzinfo=utc),
+            "other offset": datetime.datetime(2024, 5, 12, 8, 30, tzinfo=datetime.timezone(timedelta(hours=2))),
+            "naive datetime": datetime.datetime(2024, 5, 12, 8, 30),
+            "date and time": [datetime.date(2024, 5, 12), datetime.time(8, 30, 0, 5)],
+            "encoder types": [Decimal("1.25"), timedelta(minutes=3), gettext_lazy("breakfast"), b"bytes", {1, 2}],
+            "non-string keys": {1: "one", None: "none"},
+            "big int": 2 ** 70,
+            "line separators": "a\u2028b\u2029c",
+            "unicode": "crème brûlée 🍮",
+            "null": [None, {"image_url": None}],
+        }
+        for name, data in cases.items():
+            with self.subTest(name):
+                self.assert_same_as_drf(data)
+
+    def test_non_finite_floats_are_rejected(self):
+        for value in [math.nan, math.inf, -math.inf]:
+            for data in [value, {"calories": [1.0, value]}]:
+                with self.subTest(data=data):
+                    with self.assertRaises(ValueError):
+                        JSONRenderer().render(data)
+                    with self.assertRaises(ValueError):
+                        FastJSONRenderer().render(data)
+
+
+class MetricsTests(SimpleTestCase):
+    def test_histogram_renders_cumulative_buckets(self):
+        histogram = metrics.Histogram("test_seconds", "Test.", ("view",), (0.1, 1))
+        for value in (0.05, 0.1, 0.5, 5):
+            histogram.observe(("Meals",), value)
+        self.assertEqual(histogram.render(), [
+            "# HELP test_seconds Test.",
+            "# TYPE test_seconds histogram",
+            # le is inclusive, like Prometheus
+            'test_seconds_bucket{view="Meals",le="0.1"} 2',
+            'test_seconds_bucket{view="Meals",le="1"} 3',
+            'test_seconds_bucket{view="Meals",le="+Inf"} 4',
+            'test_seconds_sum{view="Meals"} 5.65',
+            'test_seconds_count{view="Meals"} 4',
+        ])
+
+    def test_outbound_time_is_only_charged_to_the_caller_making_the_call(self):
+        def run(coalesced):
+            request_metrics = metrics.RequestMetrics()
+            token = metrics._current_metrics.set(request_metrics)
+            try:
+                with mock.patch("api.openai_connect.OpenAI") as openai, \
+                        mock.patch("api.openai_connect.coalesced", side_effect=coalesced):
+                    openai.return_value.chat.completions.create.return_value.choices[0].message.content = "{}"
+                    OpenAIConnect().get_response("toast")
+            finally:
+                metrics._current_metrics.reset(token)
+            return request_metrics.outbound
+
+        self.assertIn("openai", run(lambda fingerprint, call: call()))
+        # served the response of an identical call someone else made
+        self.assertNotIn("openai", run(lambda fingerprint, call: "{}"))
+
+    def test_endpoint_needs_the_token(self):
+        client = APIClient()
+        self.assertEqual(client.get("/api/metrics/").status_code, 404)
+        with override_settings(METRICS_TOKEN="metrics-token"):
+            self.assertEqual(client.get("/api/metrics/").status_code, 404)
+            self.assertEqual(client.get("/api/metrics/", HTTP_AUTHORIZATION="Bearer wrong").status_code, 404)
+            response = client.get("/api/metrics/", HTTP_AUTHORIZATION="Bearer metrics-token")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("# TYPE api_request_duration_seconds histogram", response.content.decode())
+
+
+class StartupImportTests(SimpleTestCase):
+    """
+    Imports the wsgi app and urlconf in a fresh interpreter, the way a new worker does.
+    """
+
+    def test_startup_stays_lean(self):
+        # which modules get loaded, not how long they take: wall time depends on the machine running the tests
+        # (the profile_startup command still reports it against a budget)
+        timings = profile_startup.profile_imports(profile_startup.startup_modules())
+        # the urlconf's views really were imported, so an empty list below means something
+        self.assertIn("api.views", {timing.module for timing in timings})
+        self.assertEqual(profile_startup.loaded_deferred_modules(timings), [])
+
+
+class FirebaseSetupTests(SimpleTestCase):
+    def test_the_app_is_initialized_once(self):
+        import firebase_admin
+
+        apps = []
+
+        def get_app():
+            if not apps:
+                raise ValueError("The default Firebase app does not exist.")
+            return apps[0]
+
+        service_account = base64.b64encode(json.dumps({"type": "service_account"}).encode()).decode()
+        with mock.patch.object(firebase_admin, "get_app", side_effect=get_app), \
+                mock.patch.object(firebase_admin, "initialize_app", side_effect=lambda *args: apps.append(args)) \
+                as initialize_app, \
+                mock.patch("firebase_admin.credentials.Certificate"), \
+                mock.patch("firebase_admin.storage.bucket") as bucket, \
+                mock.patch.dict(os.environ, FIREBASE_SERVICE_ACCOUNT=service_account):
+            self.assertEqual(firebase_setup._bucket(), bucket.return_value)
+            self.assertEqual(firebase_setup._bucket(), bucket.return_value)
+        initialize_app.assert_called_once()
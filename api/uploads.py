@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from rest_framework.exceptions import APIException
+
+
+class ImageTooLarge(APIException):
+    status_code = 413
+    default_detail = "Uploaded file is too large."
+    default_code = 'image_too_large'
+
+
+class LimitedTemporaryFileUploadHandler(TemporaryFileUploadHandler):
+    """
+    Streams multipart uploads to a temporary file chunk by chunk, so memory stays flat no matter the photo size.
+    The size limit is checked as each chunk arrives, so an oversized upload is rejected before it is fully read.
+    """
+
+    def __init__(self, request=None, max_size=None):
+        super().__init__(request)
+        self.max_size = max_size or settings.MAX_IMAGE_UPLOAD_SIZE
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        # the whole body can't be bigger than the file it carries (plus a little form overhead)
+        if content_length and content_length > self.max_size + 64 * 1024:
+            raise ImageTooLarge()
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > self.max_size:
+            # the parser only cleans up files it has finished, so drop the partial one here
+            self.upload_interrupted()
+            raise ImageTooLarge()
+        return super().receive_data_chunk(raw_data, start)
@@ -1,17 +1,28 @@
 from django.urls import path
-from rest_framework.authtoken.views import obtain_auth_token
 
 from api.views import LogFood, GetMealsAndDetails, GetFoodDetails, Apple_CreateAccount, UserExists, \
-    Apple_GetUserToken, SaveFood, GetFoods
+    Apple_GetUserToken, SaveFood, GetFoods, ObtainToken, VerifyAppleToken, Bootstrap, Metrics, \
+    Export, ImportFoods, SearchFoods, SuggestFoods, \
+    RelogFood, Sync
 
 urlpatterns = [
-    path('get-reg-user-token/', obtain_auth_token, name="api_token_auth"),
+    path('get-reg-user-token/', ObtainToken.as_view(), name="api_token_auth"),
     path('register-apple/', Apple_CreateAccount.as_view(), name='create_account'),
     path('get-apple-user-token/<str:user_id>/', Apple_GetUserToken.as_view(), name='apple_user_token'),
+    path('verify-apple-token/', VerifyAppleToken.as_view(), name='verify_apple_token'),
+    path('bootstrap/<str:user_id>/', Bootstrap.as_view(), name='bootstrap'),
     path('user-exists/<str:user_id>/', UserExists.as_view(), name='user_exists'),
     path('log-food/', LogFood.as_view(), name='get_text_response'),
+    path('relog-food/', RelogFood.as_view(), name='relog_food'),
     path('save-food/<str:id>', SaveFood.as_view(), name='save_food'),
     path('meals/', GetMealsAndDetails.as_view(), name='get_meal_info'),
     path('food/<str:id>/', GetFoodDetails.as_view(), name='get_food_details'),
-    path('get-foods/', GetFoods.as_view(), name='get_foods_from_ids')
+    path('get-foods/', GetFoods.as_view(), name='get_foods_from_ids'),
+    path('search-foods/', SearchFoods.as_view(), name='search_foods'),
+    path('suggest-foods/', SuggestFoods.as_view(), name='suggest_foods'),
+    path('export/<str:kind>.<str:file_format>', Export.as_view(), name='export'),
+    path('sync/', Sync.as_view(), name='sync'),
+    path('import/', ImportFoods.as_view(), name='import_foods'),
+    path('import/<uuid:import_id>/', ImportFoods.as_view(), name='import_progress'),
+    path('metrics/', Metrics.as_view(), name='metrics'),
 ]
@@ -1,9 +1,17 @@
+import csv
+import hmac
+import uuid
 from typing import Optional
 
-import requests
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F, Max
+from django.http import HttpResponse
 from rest_framework import status
+from rest_framework.authentication import BasicAuthentication
 from rest_framework.authtoken.models import Token
+from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.exceptions import APIException, ParseError, NotFound
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.permissions import IsAuthenticated
@@ -11,13 +19,27 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from dataclasses import dataclass, asdict
 
-from api.firebase_setup import upload_image_to_firebase
-from api.openai_connect import OpenAIConnect
-from api.models import MealTypes, Food, Meal, UserProfile
+from api.apple_auth import verify_apple_identity_token, InvalidAppleToken
+from api.conditional import ConditionalGetMixin
+from api.db_routers import ReplicaReadMixin
+from api.events import food_changed
+from api.exports import EXPORT_KINDS, EXPORT_FORMATS, export_response
+from api.food_import import start_import, run_import, import_format_for, ImportConflict, \
+    IMPORT_FORMATS
+from api.idempotency import IdempotentMixin
+from api.image_storage import release_image
+from api.meal_cache import cached_meal_days
+from api.metrics import render_metrics
+from api.renderers import FastJSONParser
+from api.search import search_foods, suggest_food_names
+from api.sync import changes_since, read_token
+from api.uploads import LimitedTemporaryFileUploadHandler
+from api.models import MealTypes, Food, Meal, UserProfile, FoodImport
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from api.serializers import FoodSerializer, MealSerializer, CreateUserSerializer
+from api.serializers import FoodSerializer, MealSerializer, CreateUserSerializer, UserProfileSerializer, \
+    FoodImportSerializer
 
 
 class InvalidMealType(APIException):
@@ -32,7 +54,43 @@ class ErrorMessage(APIException):
     default_code = 'error'
 
 
-class UserExists(APIView):
+class ImportInProgress(APIException):
+    status_code = 409
+    default_detail = "This file is already being imported."
+    default_code = 'import_in_progress'
+
+
+class ObtainToken(ObtainAuthToken):
+    """
+    Trades a username and password for a token, either in the body or as an HTTP Basic header.
+    This is the only endpoint that accepts Basic auth; everything else uses the token.
+    """
+    authentication_classes = [BasicAuthentication]
+
+    def post(self, request, *args, **kwargs):
+        if request.user and request.user.is_authenticated:
+            token, created = Token.objects.get_or_create(user=request.user)
+            return Response({'token': token.key})
+        return super().post(request, *args, **kwargs)
+
+
+class Metrics(APIView):
+    """
+    Prometheus scrape endpoint for the per-request histograms in api/metrics.py, as seen by the worker that
+    answers (see the note there on multiple workers).
+    Needs "Authorization: Bearer <METRICS_TOKEN>", and doesn't exist while METRICS_TOKEN is unset.
+    """
+    authentication_classes = []
+    permission_classes = []
+
+    def get(self, request, *args, **kwargs):
+        expected = "Bearer " + settings.METRICS_TOKEN
+        if not settings.METRICS_TOKEN or not hmac.compare_digest(request.headers.get("Authorization", ""), expected):
+            raise NotFound()
+        return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4")
+
+
+class UserExists(ReplicaReadMixin, APIView):
     def get(self, request, *args, **kwargs):
         print("Checking if user exists...")
         user_id: str = self.kwargs.get('user_id')
@@ -52,28 +110,26 @@ class SaveFood(APIView):
         try:
             food = Food.objects.get(id=food_id)
             food.archived = False
-            food.save()
+            food.save(update_fields=['archived'])
         except Food.DoesNotExist:
             raise NotFound(detail="Food item not found")
+        food_changed(food)
         return Response({'message': 'Food item saved successfully.'}, status=status.HTTP_200_OK)
 
 
-class LogFood(APIView):
+class LogFood(IdempotentMixin, APIView):
     permission_classes = [IsAuthenticated]
+    # images can be sent as a multipart upload (streamed to disk) or as base64 inside a JSON body
+    parser_classes = [FastJSONParser, MultiPartParser]
+
+    def initial(self, request, *args, **kwargs):
+        # photos are streamed to disk with a size limit; set before IdempotentMixin reads the body
+        request._request.upload_handlers = [LimitedTemporaryFileUploadHandler(request._request)]
+        super().initial(request, *args, **kwargs)
 
     @staticmethod
     def add_food_to_meal(user, food: Food, meal_type: str, date: str, meal_name=None) -> Meal:
-        meal, created = Meal.objects.get_or_create(meal_type=meal_type, date=date, user=user)
-        meal.meal_items.add(food)
-        if meal_name:
-            meal.name = meal_name
-
-        if not meal.description:
-            meal.description = food.initial_description
-        else:
-            meal.description += " " + food.initial_description
-        meal.save()
-        return meal
+        return Meal.add_food(user, food, meal_type, date, meal_name)
 
     def post(self, request):
         user = request.user
@@ -93,7 +149,8 @@ class LogFood(APIView):
                 raise ErrorMessage("Invalid date format. Please use YYYY-MM-DD format.")
 
         name = request.data.get("name")
-        image = request.data.get("image", None)
+        image_file = request.FILES.get("image")
+        image = None if image_file else request.data.get("image", None)
 
 
         temperature = 0.1
@@ -116,39 +173,48 @@ class LogFood(APIView):
             In order to maximize the accuracy of the estimates, subtract 10% from the minimum and add 10% to the maximum.
             Use these properties: {Food.properties_to_calculate()}
             """
+        # the openai client takes a few hundred ms to import, so only the workers that log food pay for it
+        from api.openai_connect import OpenAIConnect
         openai_connect = OpenAIConnect(system_prompt=system_prompt, temperature=temperature, json_format=json_format)
 
         # specific params for response
         if meal_type.lower() not in MealTypes.values:
             raise InvalidMealType()
 
-        if image:
-            response = openai_connect.get_response(description, base64_image=image)
-        else:
-            response = openai_connect.get_response(description)
+        try:
+            if image_file:
+                response = openai_connect.get_response(description, image_file=image_file)
+            elif image:
+                response = openai_connect.get_response(description, base64_image=image)
+            else:
+                response = openai_connect.get_response(description)
 
-        response = json.loads(response)
+            response = json.loads(response)
 
 
 
-        # serialize into database
-        # add extra properties
-        if image:
-            response["image_url"] = openai_connect.image_url
-        response["name"] = name if name else response["name"]
-        response["archived"] = True
-        response["user"] = user.id
+            # serialize into database
+            # add extra properties
+            if image or image_file:
+                response["image_url"] = openai_connect.image_url
+            response["name"] = name if name else response["name"]
+            response["archived"] = True
+            response["user"] = user.id
 
-        food_serializer = FoodSerializer(data=response)
-        if food_serializer.is_valid():
-            food = food_serializer.save()
-            food.initial_description = description
-            food.save()
-        else:
-            print(food_serializer.errors)
-            raise ErrorMessage("Error saving food data to database")
+            food_serializer = FoodSerializer(data=response)
+            if food_serializer.is_valid():
+                food = food_serializer.save(initial_description=description)
+            else:
+                print(food_serializer.errors)
+                raise ErrorMessage("Error saving food data to database")
+        finally:
+            if openai_connect.image_url:
+                # the food took its own reference to the image (see retain_food_image), or there is no food:
+                # either way, drop the one store_image took for the upload
+                release_image(openai_connect.image_url)
 
-        self.add_food_to_meal(user, food, meal_type, date_str, name)
+        meal = self.add_food_to_meal(user, food, meal_type, date_str, name)
+        food_changed(food, meal)
 
         # before returning, add the db id to the response json
         response["id"] = food.id
@@ -156,14 +222,74 @@ class LogFood(APIView):
         return Response(response)
 
 
-class GetFoods(APIView):
+class RelogFood(APIView):
+    """
+    Log a food the user has had before again, without going back to the model. POST clones the food
+    with every nutrient range scaled by "portion" and adds it to the meal; GET lists the user's most
+    frequent foods to pick from.
+    """
     permission_classes = [IsAuthenticated]
+    FREQUENT_FOOD_LIMIT = 20
+    MAX_PORTION = 20
+
+    def get(self, request):
+        # an index scan on food_user_times_logged
+        foods = Food.objects.filter(user=request.user, logged_from__isnull=True, archived=False) \
+            .order_by("-times_logged")[:self.FREQUENT_FOOD_LIMIT]
+        return Response(FoodSerializer(foods, many=True, context={"request": request}).data)
+
+    def post(self, request):
+        user = request.user
+        food_id = request.data.get("food_id")
+        if not food_id:
+            raise ErrorMessage("Please provide a food id")
+        try:
+            food_id = uuid.UUID(str(food_id))
+        except ValueError:
+            raise ErrorMessage("Invalid food id")
+        meal_type = (request.data.get("meal_type") or "").lower()
+        if meal_type not in MealTypes.values:
+            raise InvalidMealType()
+        date_str = request.data.get("date")
+        try:
+            datetime.strptime(date_str or "", "%Y-%m-%d")
+        except ValueError:
+            raise ErrorMessage("Invalid date format. Please use YYYY-MM-DD format.")
+        try:
+            portion = float(request.data.get("portion", 1))
+        except (TypeError, ValueError):
+            raise ErrorMessage("portion must be a number")
+        if not 0 < portion <= self.MAX_PORTION:
+            raise ErrorMessage(f"portion must be more than 0 and at most {self.MAX_PORTION}")
+        name = request.data.get("name")
+
+        with transaction.atomic():
+            source = Food.objects.filter(id=food_id, user=user).first()
+            if not source:
+                raise NotFound("Food item not found")
+            food = source.scaled_copy(portion)
+            if name:
+                food.name = name
+            food.save()
+            # same transaction as the copy, so the original can share its revision
+            Food.objects.filter(id=food.logged_from_id).update(times_logged=F("times_logged") + 1,
+                                                              revision=food.revision, updated_at=food.updated_at)
+            meal = LogFood.add_food_to_meal(user, food, meal_type, date_str, name)
+
+        food_changed(food, meal)
+        return Response(FoodSerializer(food, context={"request": request}).data)
+
+
+class GetFoods(ConditionalGetMixin, ReplicaReadMixin, APIView):
+    permission_classes = [IsAuthenticated]
+    # post only looks foods up by id
+    replica_methods = ('GET', 'POST')
 
     @staticmethod
     def get(request):
         user = request.user
         all_foods = Food.objects.filter(user=user)
-        food_serializer = FoodSerializer(all_foods, many=True)
+        food_serializer = FoodSerializer(all_foods, many=True, context={"request": request})
         return Response(food_serializer.data)
 
 
@@ -174,11 +300,11 @@ class GetFoods(APIView):
         if not ids_arr:
             raise ErrorMessage("Please provide an array of ids")
         foods = Food.objects.filter(id__in=ids_arr)
-        food_serializer = FoodSerializer(foods, many=True)
+        food_serializer = FoodSerializer(foods, many=True, context={"request": request})
         return Response(food_serializer.data)
 
 
-class GetFoodDetails(APIView):
+class GetFoodDetails(ReplicaReadMixin, APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, *args, **kwargs):
@@ -190,11 +316,51 @@ class GetFoodDetails(APIView):
             food = Food.objects.get(id=food_id)
         except Food.DoesNotExist:
             raise NotFound(detail="Food item not found")
-        food_serializer = FoodSerializer(food)
+        food_serializer = FoodSerializer(food, context={"request": request})
         return Response(food_serializer.data)
 
 
-class GetMealsAndDetails(APIView):
+class SearchFoods(ReplicaReadMixin, APIView):
+    """
+    Full-text search over the user's foods: GET search-foods/?q=chicken burrito&page=2, ranked best match first.
+    """
+    permission_classes = [IsAuthenticated]
+    PAGE_SIZE = 20
+
+    def get(self, request):
+        query = request.query_params.get("q", "").strip()
+        if not query:
+            raise ErrorMessage("Please provide a search query")
+        try:
+            page = max(int(request.query_params.get("page", 1)), 1)
+        except ValueError:
+            raise ErrorMessage("page must be a number")
+
+        start = (page - 1) * self.PAGE_SIZE
+        # one extra row tells us whether there is a next page, without counting every match
+        foods = list(search_foods(request.user, query)[start:start + self.PAGE_SIZE + 1])
+        return Response({
+            "results": FoodSerializer(foods[:self.PAGE_SIZE], many=True, context={"request": request}).data,
+            "page": page,
+            "has_next": len(foods) > self.PAGE_SIZE,
+        })
+
+
+class SuggestFoods(ReplicaReadMixin, APIView):
+    """
+    Autocomplete for food names: GET suggest-foods/?q=chiken. Tolerates typos on Postgres.
+    """
+    permission_classes = [IsAuthenticated]
+    LIMIT = 10
+
+    def get(self, request):
+        text = request.query_params.get("q", "").strip()
+        if not text:
+            return Response({"names": []})
+        return Response({"names": suggest_food_names(request.user, text, self.LIMIT)})
+
+
+class GetMealsAndDetails(ConditionalGetMixin, ReplicaReadMixin, APIView):
     permission_classes = [IsAuthenticated]
 
     @staticmethod
@@ -202,11 +368,11 @@ class GetMealsAndDetails(APIView):
         # return Meal[] serialized
         user = request.user
         # make sure date is descending
-        all_meals = Meal.objects.filter(user=user, date__lte=datetime.now()).order_by('-date')
-
-        meal_serializer = MealSerializer(all_meals, many=True)
+        days = list(Meal.objects.filter(user=user, date__lte=datetime.now().strftime("%Y-%m-%d")).order_by('-date')
+                    .values_list('date', flat=True).distinct())
+        meals_by_day = cached_meal_days(user.id, days)
 
-        return Response(meal_serializer.data)
+        return Response([meal for day in days for meal in meals_by_day[day]])
 
     @staticmethod
     def post(request):
@@ -285,13 +451,144 @@ class GetMealsAndDetails(APIView):
         return Response(response)
 
 
+class Export(ReplicaReadMixin, APIView):
+    """
+    Streams the user's whole history of one kind (foods, meals or conversations) as NDJSON or CSV,
+    gzipped if the client accepts it. Memory use doesn't grow with the size of the history.
+    """
+    permission_classes = [IsAuthenticated]
+
+    @staticmethod
+    def get(request, kind, file_format):
+        if kind not in EXPORT_KINDS or file_format not in EXPORT_FORMATS:
+            raise NotFound("Unknown export, expected export/<foods|meals|conversations>.<ndjson|csv>")
+        return export_response(request, kind, file_format)
+
+
+class Sync(ReplicaReadMixin, APIView):
+    """
+    Delta sync for offline clients. GET sync/ returns everything with a token; GET sync/?since=<token> then returns
+    only the foods, meals and conversations changed since, and the ids of those deleted. "reset": true means the
+    token was too old (or invalid) and the response is a full copy that replaces the client's.
+    """
+    permission_classes = [IsAuthenticated]
+
+    @staticmethod
+    def get(request):
+        token = request.query_params.get("since")
+        since = read_token(request.user.id, token) if token else None
+        return Response(changes_since(request, since))
+
+
+class ImportFoods(APIView):
+    """
+    Bulk import of food logs from another tracker: a CSV, JSON or NDJSON file that already has the nutrients,
+    so no LLM call is made. Rows are written IMPORT_BATCH_SIZE at a time, each batch checkpointed; if the request
+    dies part way, posting the same file again resumes where it stopped. GET import/<id>/ reports progress.
+    """
+    permission_classes = [IsAuthenticated]
+    parser_classes = [MultiPartParser]
+
+    def post(self, request):
+        # history files are allowed to be bigger than photos
+        request._request.upload_handlers = [
+            LimitedTemporaryFileUploadHandler(request._request, max_size=settings.MAX_IMPORT_UPLOAD_SIZE)]
+        source = request.FILES.get("file")
+        if not source:
+            raise ErrorMessage("Please provide a file")
+        file_format = request.data.get("format") or import_format_for(source.name)
+        if file_format not in IMPORT_FORMATS:
+            raise ErrorMessage("format must be one of " + ", ".join(IMPORT_FORMATS))
+
+        job = start_import(request.user, source, source.name)
+        try:
+            run_import(job, source, file_format, settings.IMPORT_BATCH_SIZE)
+        except ImportConflict:
+            raise ImportInProgress()
+        except (ValueError, csv.Error) as e:
+            # the file itself is unreadable (not a JSON array, not utf-8...), rows already written stay written
+            raise ErrorMessage("Could not read the file: " + str(e))
+        return Response(FoodImportSerializer(job).data)
+
+    @staticmethod
+    def get(request, import_id):
+        job = FoodImport.objects.filter(id=import_id, user=request.user).first()
+        if not job:
+            raise NotFound("No import found with that id")
+        return Response(FoodImportSerializer(job).data)
+
+
+class Bootstrap(APIView):
+    """
+    Everything the app needs on launch in one round trip: auth state, token, profile,
+    the day's meals (with totals) and recently eaten foods, from a fixed number of queries.
+    Replaces calling user-exists/, get-apple-user-token/, meals/ and get-foods/ in sequence.
+    """
+    RECENT_FOOD_DAYS = 14
+    RECENT_FOOD_LIMIT = 20
+
+    def get(self, request, *args, **kwargs):
+        user_id: str = self.kwargs.get('user_id')
+        if not user_id:
+            return Response({'message': 'Please provide a user_id'}, status=status.HTTP_400_BAD_REQUEST)
+
+        date_str = request.query_params.get("date", datetime.now().strftime("%Y-%m-%d"))
+        try:
+            date = datetime.strptime(date_str, "%Y-%m-%d")
+        except ValueError:
+            raise ErrorMessage("Invalid date format. Please use YYYY-MM-DD format.")
+
+        # query 1: user, profile and token together
+        user = User.objects.select_related('userprofile', 'auth_token').filter(username=user_id).first()
+        if not user:
+            return Response({'exists': False, 'authenticated': False}, status=status.HTTP_200_OK)
+
+        authenticated = request.user.is_authenticated and request.user.id == user.id
+        # same rule as Apple_GetUserToken: password users have to sign in instead
+        token = None
+        if authenticated or not user.has_usable_password():
+            token = user.auth_token.key if hasattr(user, 'auth_token') else None
+
+        response = {
+            'exists': True,
+            'authenticated': authenticated,
+            'token': token,
+        }
+        if not token:
+            return Response(response, status=status.HTTP_200_OK)
+
+        # query 2: data_version for the meal cache; 3 + 4: the day's meals and their foods, unless they're cached
+        meals_data = cached_meal_days(user.id, [date_str])[date_str]
+        totals = {}
+        for meal_data in meals_data:
+            for key, value in meal_data.items():
+                if key.startswith("total_"):
+                    totals[key] = totals.get(key, 0) + value
+
+        # query 5: foods from recent meals, most recently eaten first
+        since = (date - timedelta(days=self.RECENT_FOOD_DAYS)).strftime("%Y-%m-%d")
+        recent_foods = Food.objects.filter(user=user, archived=False) \
+            .annotate(last_eaten=Max('meal__date')) \
+            .filter(last_eaten__gte=since) \
+            .order_by('-last_eaten')[:self.RECENT_FOOD_LIMIT]
+
+        response.update({
+            'profile': UserProfileSerializer(user.userprofile).data,
+            'date': date_str,
+            'meals': meals_data,
+            'totals': totals,
+            'recent_foods': FoodSerializer(recent_foods, many=True, context={"request": request}).data,
+        })
+        return Response(response, status=status.HTTP_200_OK)
+
+
 class Apple_GetUserToken(APIView):
     def get(self, request, *args, **kwargs):
         user_id: str = self.kwargs.get('user_id')
         if not user_id:
             return Response({'message': 'Please provide a user_id'}, status=status.HTTP_400_BAD_REQUEST)
-        if User.objects.filter(username=user_id).exists():
-            user = User.objects.get(username=user_id)
+        user = User.objects.select_related('auth_token').filter(username=user_id).first()
+        if user:
             if user.has_usable_password():
                 return Response({'message': 'User has a password. Use Sign In endpoint.'},
                                 status=status.HTTP_400_BAD_REQUEST)
@@ -345,29 +642,15 @@ class VerifyAppleToken(APIView):
         if not user_id or not identity_token:
             return Response({'message': 'Missing user_id or identity_token'}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Validate the token with Apple
-        client_id = "YOUR_CLIENT_ID"
-        client_secret = "YOUR_CLIENT_SECRET"
-
-        response = requests.post(
-            'https://appleid.apple.com/auth/token',
-            data={
-                'client_id': client_id,
-                'client_secret': client_secret,
-                'code': identity_token,
-                'grant_type': 'authorization_code',
-            }
-        )
-
-        if response.status_code != 200:
-            return Response({'message': 'Invalid token'}, status=response.status_code)
-
-        response_data = response.json()
-        # TODO: finish this
+        # Validate the token locally against Apple's public keys
+        try:
+            verify_apple_identity_token(identity_token, user_id)
+        except InvalidAppleToken:
+            return Response({'message': 'Invalid token'}, status=status.HTTP_401_UNAUTHORIZED)
 
         # Check if the user exists in the database
         try:
-            user = User.objects.get(username=user_id)
+            user = User.objects.select_related('auth_token').get(username=user_id)
         except User.DoesNotExist:
             return Response({'message': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
 
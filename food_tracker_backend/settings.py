@@ -44,18 +44,26 @@ ALLOWED_HOSTS = ['*']
 # Application definition
 
 INSTALLED_APPS = [
+    # daphne's runserver serves websockets (Channels) alongside regular HTTP.
+    # Only needed for local development: the app imports twisted, which adds ~0.4s to every worker's startup.
+    *(['daphne'] if DEBUG else []),
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    # full-text and trigram search lookups (api/search.py)
+    'django.contrib.postgres',
     'rest_framework',
     'rest_framework.authtoken',
+    'channels',
     "api.apps.ApiConfig",
 ]
 
 MIDDLEWARE = [
+    # first, so its timings cover all the other middleware
+    'api.metrics.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -66,12 +74,34 @@ MIDDLEWARE = [
 ]
 
 REST_FRAMEWORK = {
+    # Basic auth (a full password hash per request) is only accepted by the token-obtain endpoint
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.BasicAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
+    ],
+    # orjson-backed JSON (see api/renderers.py); falls back to the stdlib if orjson isn't installed
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'api.renderers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
     ],
 }
 
+# Bearer token for scraping /api/metrics/; the endpoint 404s while this is unset
+METRICS_TOKEN = env('METRICS_TOKEN', default='')
+
+# In-process cache of authenticated tokens (see api/authentication.py)
+TOKEN_CACHE_SIZE = env.int('TOKEN_CACHE_SIZE', default=10000)
+TOKEN_CACHE_TTL = env.int('TOKEN_CACHE_TTL', default=300)  # seconds
+
+# Sign in with Apple (see api/apple_auth.py)
+# the app's bundle id, which Apple puts in the identity token's audience
+APPLE_CLIENT_ID = env('APPLE_CLIENT_ID', default='')
+APPLE_KEYS_TTL = env.int('APPLE_KEYS_TTL', default=24 * 60 * 60)  # seconds
+
 ROOT_URLCONF = 'food_tracker_backend.urls'
 
 TEMPLATES = [
@@ -91,6 +121,47 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'food_tracker_backend.wsgi.application'
+ASGI_APPLICATION = 'food_tracker_backend.asgi.application'
+
+# Channel layer for websocket pushes (see api/events.py)
+# The in-memory layer only reaches sockets in the same process, which is fine for local runs.
+# With several workers, set REDIS_URL so events reach every worker (channels-redis, in requirements.txt).
+REDIS_URL = env('REDIS_URL', default='')
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {'hosts': [REDIS_URL]},
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
+
+# Caches
+# "meals" is the shared tier of the serialized meal cache (see api/meal_cache.py). Like the channel layer it is
+# per process unless REDIS_URL is set. Entries are keyed on the user's data_version, so either is correct; with
+# Redis, a day one worker has serialized doesn't have to be serialized again by the others.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'meals': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'KEY_PREFIX': 'meals',
+    } if REDIS_URL else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'meals',
+        'OPTIONS': {'MAX_ENTRIES': env.int('MEAL_CACHE_SHARED_ENTRIES', default=10000)},
+    },
+}
+# The in-process tier in front of it, bounded by the size of the cached payloads
+MEAL_CACHE_LOCAL_BYTES = env.int('MEAL_CACHE_LOCAL_BYTES', default=32 * 1024 * 1024)
+MEAL_CACHE_TTL = env.int('MEAL_CACHE_TTL', default=24 * 60 * 60)  # seconds
 
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
@@ -107,7 +178,32 @@ DATABASES = {
 }
 
 if IS_HEROKU:
-    DATABASES['default'] = dj_database_url.config(conn_max_age=600, ssl_require=True)
+    DATABASES['default'] = dj_database_url.config(ssl_require=True)
+
+# Connection reuse, applied to both the Heroku and the Docker/compose database
+# Keep connections open between requests instead of reconnecting every time (0 closes after each request),
+# and check they are still alive before reusing them.
+DATABASES['default']['CONN_MAX_AGE'] = env.int('DB_CONN_MAX_AGE', default=600)  # seconds
+DATABASES['default']['CONN_HEALTH_CHECKS'] = env.bool('DB_CONN_HEALTH_CHECKS', default=True)
+DATABASES['default'].setdefault('OPTIONS', {})
+DATABASES['default']['OPTIONS']['connect_timeout'] = env.int('DB_CONNECT_TIMEOUT', default=5)  # seconds
+
+# Behind pgbouncer in transaction mode, a server-side cursor can't outlive its transaction,
+# so they have to be turned off (persistent connections to pgbouncer itself are fine)
+if env.bool('DB_PGBOUNCER_TRANSACTION_MODE', default=False):
+    DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+
+# Optional read replica for read-only endpoints (see api/db_routers.py)
+DATABASE_REPLICA_URL = env('DATABASE_REPLICA_URL', default='')
+if DATABASE_REPLICA_URL:
+    DATABASES['replica'] = dj_database_url.parse(
+        DATABASE_REPLICA_URL,
+        conn_max_age=DATABASES['default']['CONN_MAX_AGE'],
+        conn_health_checks=DATABASES['default']['CONN_HEALTH_CHECKS'],
+    )
+DATABASE_ROUTERS = ['api.db_routers.ReplicaRouter']
+# after a user writes (UserProfile.last_write_at), their reads stay on the primary for this long
+REPLICA_STICKY_SECONDS = env.int('REPLICA_STICKY_SECONDS', default=10)
 
 
 # Password validation
@@ -144,6 +240,50 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Image uploads
+# LogFood streams multipart images to a temporary file in chunks rather than holding them in memory, and rejects
+# them with a 413 past this size (see api/uploads.py). Other views keep Django's default upload handlers.
+MAX_IMAGE_UPLOAD_SIZE = env.int('MAX_IMAGE_UPLOAD_SIZE', default=10 * 1024 * 1024)  # bytes
+# history files for the import/ endpoint are allowed to be bigger
+MAX_IMPORT_UPLOAD_SIZE = env.int('MAX_IMPORT_UPLOAD_SIZE', default=100 * 1024 * 1024)  # bytes
+
+# Bulk imports (see api/food_import.py)
+# Rows validated and written per transaction; each batch is also a resume checkpoint.
+IMPORT_BATCH_SIZE = env.int('IMPORT_BATCH_SIZE', default=1000)
+
+# Background tasks (see api/background.py)
+# Set to True to run them synchronously in the request thread, e.g. in tests.
+BACKGROUND_TASKS_INLINE = env.bool('BACKGROUND_TASKS_INLINE', default=False)
+
+# Cleanup of abandoned LogFood estimates (see api/cleanup.py and the cleanup_archived_foods command)
+# Foods still archived (never kept with SaveFood) this many days after they were logged are deleted.
+ARCHIVED_FOOD_RETENTION_DAYS = env.int('ARCHIVED_FOOD_RETENTION_DAYS', default=30)
+ARCHIVED_FOOD_CLEANUP_BATCH_SIZE = env.int('ARCHIVED_FOOD_CLEANUP_BATCH_SIZE', default=500)
+
+# Exports (see api/exports.py)
+# Rows fetched from the database per round trip while streaming an export.
+EXPORT_CHUNK_SIZE = env.int('EXPORT_CHUNK_SIZE', default=2000)
+
+# Delta sync (see api/sync.py)
+# Sync tokens older than this get a full resync instead, and tombstones of deleted rows are pruned at the same age
+# (prune_tombstones command).
+SYNC_TOKEN_MAX_AGE_DAYS = env.int('SYNC_TOKEN_MAX_AGE_DAYS', default=90)
+
+# Idempotency-Key handling for LogFood (see api/idempotency.py)
+# How long a retry waits for the original request to finish before getting a 409. The wait holds a sync worker,
+# so keep it well under gunicorn's worker timeout (30s by default, see Procfile), or the worker is killed first
+IDEMPOTENCY_WAIT_SECONDS = env.int('IDEMPOTENCY_WAIT_SECONDS', default=15)
+# A request still "running" after this long is assumed to have died with its worker, and a retry takes over
+IDEMPOTENCY_STALE_SECONDS = env.int('IDEMPOTENCY_STALE_SECONDS', default=300)
+# Completed keys are replayed for this long, then deleted (cleanup_idempotency_keys command)
+IDEMPOTENCY_KEY_TTL_HOURS = env.int('IDEMPOTENCY_KEY_TTL_HOURS', default=24)
+
+# Identical OpenAI requests made at the same time share one upstream call (see api/coalesce.py)
+# A call still running after this long (the client timeout is 20s) died with its worker, and a waiting caller takes over
+OPENAI_COALESCE_STALE_SECONDS = env.int('OPENAI_COALESCE_STALE_SECONDS', default=30)
+# Identical requests arriving this soon after a call finished get its response as well
+OPENAI_COALESCE_RESULT_SECONDS = env.int('OPENAI_COALESCE_RESULT_SECONDS', default=5)
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 